@@ -125,6 +125,33 @@ def find_tasks_to_kill(tasks, hostports):
     return list(tasks_to_kill)
 
 
+def get_haproxy_pids(url):
+    """Returns the list of HAProxy PIDs on the instance at `url`, along with
+    the number of connections still held by the old (draining) processes.
+
+    Falls back to the plain text PID list for marathon-lb instances which
+    don't support the JSON format yet, in which case the connection count
+    is unknown (None).
+    """
+    response = requests.get(url + "/_haproxy_getpids",
+                            params={'format': 'json'})
+    response.raise_for_status()
+    try:
+        state = response.json()
+    except ValueError:
+        state = None
+    # A single PID in the plain text format parses as JSON too
+    if not isinstance(state, dict) or 'pids' not in state or \
+            'processes' not in state:
+        return (response.text.split(), None)
+
+    old_conns = 0
+    for process in state['processes']:
+        if not process['current'] and process['conns'] is not None:
+            old_conns += process['conns']
+    return (state['pids'], old_conns)
+
+
 def check_if_tasks_drained(args, app, existing_app, step_started_at):
     time.sleep(args.step_delay)
     url = args.marathon + "/v2/apps" + existing_app['id']
@@ -162,13 +189,12 @@ def check_if_tasks_drained(args, app, existing_app, step_started_at):
             response.raise_for_status()
             csv_data = csv_data + response.text
 
-            response = requests.get(nexturl + "/_haproxy_getpids")
-            response.raise_for_status()
-            pids = response.text.split()
+            pids, old_conns = get_haproxy_pids(nexturl)
             if len(pids) > 1 and time.time() - step_started_at < args.max_wait:
                 # HAProxy has not finished reloading
-                logger.info("Waiting for {} pids on {}"
-                            .format(len(pids), nexturl))
+                logger.info("Waiting for {} pids on {} ({} connections "
+                            "remaining on old processes)"
+                            .format(len(pids), nexturl, old_conns))
                 return check_if_tasks_drained(args,
                                               app,
                                               existing_app,
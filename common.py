@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-from logging.handlers import SysLogHandler
-
 import sys
 import logging
 
@@ -16,6 +14,7 @@ def setup_logging(logger, syslog_socket, log_format):
     logger.addHandler(consoleHandler)
 
     if syslog_socket != '/dev/null':
+        from logging.handlers import SysLogHandler
         syslogHandler = SysLogHandler(syslog_socket)
         syslogHandler.setFormatter(formatter)
         logger.addHandler(syslogHandler)
@@ -2,6 +2,7 @@
 
 import os
 import logging
+import re
 
 logger = logging.getLogger('marathon_lb')
 
@@ -16,6 +17,49 @@ class ConfigTemplate:
         self.description = description
 
 
+def blank_prefix_or_empty(s):
+    if s:
+        return ' ' + s
+    else:
+        return s
+
+
+class TemplateProfile(object):
+    """The effective value of each template for services with a given set
+    of `HAPROXY_{n}_...` template overrides.
+
+    Services with the same overrides share a profile, so looking up their
+    templates doesn't need to go through their labels, and anything
+    derived from the templates only needs working out once per profile.
+    A profile is only valid for the templater generation it was made in.
+    """
+
+    def __init__(self, templater, overrides):
+        self.templater = templater
+        self.generation = templater.generation
+        # ((name, value), ...) of the overridden templates
+        self.overrides = overrides
+        self.values = dict((name, template.value)
+                           for name, template in templater.t.items())
+        self.values.update(overrides)
+        for name in ['BACKEND_SERVER_HTTP_HEALTHCHECK_OPTIONS',
+                     'BACKEND_SERVER_TCP_HEALTHCHECK_OPTIONS']:
+            self.values[name] = \
+                blank_prefix_or_empty(self.values[name].strip())
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __hash__(self):
+        return hash(self.overrides)
+
+    def __eq__(self, other):
+        return self.overrides == other.overrides
+
+    def __ne__(self, other):
+        return not self == other
+
+
 class ConfigTemplater(object):
     def add_template(self, template):
         self.t[template.name] = template
@@ -54,7 +98,7 @@ DHE-RSA-AES256-SHA:ECDHE-ECDSA-DES-CBC3-SHA:ECDHE-RSA-DES-CBC3-SHA:\
 EDH-RSA-DES-CBC3-SHA:AES128-GCM-SHA256:AES256-GCM-SHA384:AES128-SHA256:\
 AES256-SHA256:AES128-SHA:AES256-SHA:DES-CBC3-SHA:!DSS
   ssl-default-server-options no-sslv3 no-tls-tickets
-  stats socket /var/run/haproxy/socket
+  stats socket /var/run/haproxy/socket expose-fd listeners
   server-state-file global
   server-state-base /var/state/haproxy/
   lua-load /marathon-lb/getpids.lua
@@ -86,11 +130,14 @@ listen stats
   http-request use-service lua.getpids if getpid
   acl getconfig path /_haproxy_getconfig
   http-request use-service lua.getconfig if getconfig
+  acl getconfighash path /_haproxy_getconfighash
+  http-request use-service lua.getconfighash if getconfighash
 ''',
                            overridable=False,
                            description='''\
 The head of the HAProxy config. This contains global settings
-and defaults.
+and defaults. The stats socket exposes the listening sockets, so that
+HAProxy can be reloaded seamlessly with `-x`.
 '''))
 
         self.add_template(
@@ -473,24 +520,198 @@ Example:
 This option glues the backend to the frontend.
     '''))
 
+        self.add_template(
+            ConfigTemplate(name='MAP_HTTP_FRONTEND_ACL',
+                           value='''\
+  use_backend %[req.hdr(host),lower,regsub(:.*$,,),map_str({hostMap})] \
+if {{ req.hdr(host),lower,regsub(:.*$,,),map_str({hostMap}) -m found }}
+''',
+                           overridable=False,
+                           description='''\
+With `--haproxy-map`, routes the virtual hosts of the
+`HAPROXY_HTTP_FRONTEND_HEAD` to their backends by looking the Host header
+up in the `{hostMap}` map file, instead of with an ACL per virtual host.
+'''))
+
+        self.add_template(
+            ConfigTemplate(name='MAP_HTTP_FRONTEND_ACL_WITH_PATH',
+                           value='''\
+  use_backend %[base,lower,regsub(:[0-9]+/,/),map_beg({pathMap})] \
+if {{ base,lower,regsub(:[0-9]+/,/),map_beg({pathMap}) -m found }}
+''',
+                           overridable=False,
+                           description='''\
+With `--haproxy-map`, routes the virtual hosts with a `HAPROXY_{n}_PATH`
+of both the `HAPROXY_HTTP_FRONTEND_HEAD` and the
+`HAPROXY_HTTPS_FRONTEND_HEAD` to their backends by looking the Host header
+and path up in the `{pathMap}` map file, which lists the longest paths
+first. Both are lowercased, so unlike with ACLs, paths match regardless
+of case.
+'''))
+
+        self.add_template(
+            ConfigTemplate(name='MAP_HTTPS_FRONTEND_ACL',
+                           value='''\
+  use_backend %[ssl_fc_sni,lower,map_str({hostMap})] \
+if {{ ssl_fc_sni,lower,map_str({hostMap}) -m found }}
+''',
+                           overridable=False,
+                           description='''\
+With `--haproxy-map`, routes the virtual hosts of the
+`HAPROXY_HTTPS_FRONTEND_HEAD` to their backends by looking the SNI
+hostname up in the `{hostMap}` map file, instead of with an ACL per
+virtual host.
+'''))
+
+        self.add_template(
+            ConfigTemplate(name='SHARED_FRONTEND_HEAD',
+                           value='''
+frontend {frontend}
+  mode {mode}
+''',
+                           overridable=False,
+                           description='''\
+With `--shared-frontends`, the head of the frontend which TCP services
+bound to the same address share, instead of having a
+`HAPROXY_FRONTEND_HEAD` each.
+'''))
+
+        self.add_template(
+            ConfigTemplate(name='SHARED_FRONTEND_BIND',
+                           value='''\
+  bind {binds}
+''',
+                           overridable=False,
+                           description='''\
+With `--shared-frontends`, binds a shared frontend to the service ports of
+the services which share it. `{binds}` is a comma-separated list of
+`address:port` or `address:first-last` port ranges, and there are as many
+bind lines as are needed to keep them short.
+'''))
+
+        self.add_template(
+            ConfigTemplate(name='SHARED_FRONTEND_BACKEND_GLUE',
+                           value='''\
+  use_backend {backend} if {{ dst_port {servicePort} }}
+''',
+                           overridable=False,
+                           description='''\
+With `--shared-frontends`, glues each service's backend to the shared
+frontend, by the port the connection was made to.
+'''))
+
+        self.add_template(
+            ConfigTemplate(name='HARD_STOP_AFTER',
+                           value='''
+global
+  hard-stop-after {hardStopAfter}
+''',
+                           overridable=False,
+                           description='''\
+With `--old-worker-max-age`, a further `global` section which makes
+HAProxy close the connections of the processes a reload left behind once
+they've been draining for `{hardStopAfter}`.
+'''))
+
     def __init__(self, directory='templates'):
         self.__template_directory = directory
         self.t = dict()
+        # Bumped whenever reload_templates() changes a template
+        self.generation = 0
         self.load()
         self.__load_templates()
+        # Label -> name of the template it overrides
+        self.__override_labels = dict(
+            ('HAPROXY_{0}_' + name, name)
+            for name, template in self.t.items() if template.overridable)
+        # overrides -> TemplateProfile
+        self.__profiles = dict()
+
+    def profile(self, app):
+        """Returns the TemplateProfile of a service, from its labels. It's
+        kept on the service, so its labels are only looked at once."""
+        profile = app.template_profile
+        if profile is not None and profile.templater is self and \
+                profile.generation == self.generation:
+            return profile
+        overrides = tuple(sorted(
+            (self.__override_labels[key], value)
+            for key, value in app.labels.items()
+            if key in self.__override_labels))
+        profile = self.__profiles.get(overrides)
+        if profile is None or profile.generation != self.generation:
+            profile = TemplateProfile(self, overrides)
+            self.__profiles[overrides] = profile
+        app.template_profile = profile
+        return profile
+
+    def prune_profiles(self, apps):
+        """Drops the profiles none of the given services have, so the
+        cache doesn't grow as services' labels change."""
+        keep = frozenset(app.template_profile.overrides for app in apps
+                         if app.template_profile is not None)
+        self.__profiles = dict(
+            (overrides, profile)
+            for overrides, profile in self.__profiles.items()
+            if overrides in keep)
+
+    def cached_profiles(self):
+        return len(self.__profiles)
 
-    def __load_templates(self):
-        '''Loads template files if they exist, othwerwise it sets defaults'''
-
-        for template in self.t:
-            name = self.t[template].full_name
+    @property
+    def directory(self):
+        return self.__template_directory
+
+    def __list_overrides(self):
+        # List the directory once, rather than trying to open a file for
+        # each template
+        try:
+            return frozenset(os.listdir(self.__template_directory))
+        except OSError:
+            return frozenset()
+
+    def __load_template(self, template, overrides):
+        """Sets a template to its override, if there is one, or its default
+        value, returning whether that changed it."""
+        name = template.full_name
+        value = template.default_value
+        if name in overrides:
             try:
                 filename = os.path.join(self.__template_directory, name)
                 with open(filename) as f:
-                    logger.info('overriding %s from %s', name, filename)
-                    self.t[template].value = f.read()
+                    value = f.read()
             except IOError:
-                logger.debug("setting default value for %s", name)
+                pass
+        if value == template.value:
+            return False
+        if value is template.default_value:
+            logger.info("setting default value for %s", name)
+        else:
+            logger.info('overriding %s from %s', name, filename)
+        template.value = value
+        return True
+
+    def __load_templates(self):
+        '''Loads template files if they exist, othwerwise it sets defaults'''
+        overrides = self.__list_overrides()
+        for template in self.t.values():
+            self.__load_template(template, overrides)
+
+    def reload_templates(self, names=None):
+        """Reads the overrides of the templates with the given full names
+        (e.g. HAPROXY_HEAD) again, or of all of them, returning the names
+        (e.g. HEAD) of the templates which changed."""
+        overrides = self.__list_overrides()
+        changed = []
+        for template in self.t.values():
+            if names is not None and template.full_name not in names:
+                continue
+            if self.__load_template(template, overrides):
+                changed.append(template.name)
+        if changed:
+            self.generation += 1
+            self.__profiles = dict()
+        return sorted(changed)
 
     def get_descriptions(self):
         descriptions = '''\
@@ -577,138 +798,102 @@ May be specified as {specifiedAs}.
     def haproxy_https_frontend_head(self):
         return self.t['HTTPS_FRONTEND_HEAD'].value
 
+    @property
+    def haproxy_map_http_frontend_acl(self):
+        return self.t['MAP_HTTP_FRONTEND_ACL'].value
+
+    @property
+    def haproxy_map_http_frontend_acl_with_path(self):
+        return self.t['MAP_HTTP_FRONTEND_ACL_WITH_PATH'].value
+
+    @property
+    def haproxy_map_https_frontend_acl(self):
+        return self.t['MAP_HTTPS_FRONTEND_ACL'].value
+
+    @property
+    def haproxy_hard_stop_after(self):
+        return self.t['HARD_STOP_AFTER'].value
+
+    @property
+    def haproxy_shared_frontend_head(self):
+        return self.t['SHARED_FRONTEND_HEAD'].value
+
+    @property
+    def haproxy_shared_frontend_bind(self):
+        return self.t['SHARED_FRONTEND_BIND'].value
+
+    @property
+    def haproxy_shared_frontend_backend_glue(self):
+        return self.t['SHARED_FRONTEND_BACKEND_GLUE'].value
+
     def haproxy_frontend_head(self, app):
-        if 'FRONTEND_HEAD' in app.labels:
-            return app.labels['HAPROXY_{0}_FRONTEND_HEAD']
-        return self.t['FRONTEND_HEAD'].value
+        return self.profile(app)['FRONTEND_HEAD']
 
     def haproxy_backend_redirect_http_to_https(self, app):
-        if 'HAPROXY_{0}_BACKEND_REDIRECT_HTTP_TO_HTTPS' in app.labels:
-            return app.labels['HAPROXY_{0}_BACKEND_REDIRECT_HTTP_TO_HTTPS']
-        return self.t['BACKEND_REDIRECT_HTTP_TO_HTTPS'].value
+        return self.profile(app)['BACKEND_REDIRECT_HTTP_TO_HTTPS']
 
     def haproxy_backend_redirect_http_to_https_with_path(self, app):
-        if 'HAPROXY_{0}_BACKEND_REDIRECT_HTTP_TO_HTTPS_WITH_PATH' in\
-          app.labels:
-            return app.\
-                labels['HAPROXY_{0}_BACKEND_REDIRECT_HTTP_TO_HTTPS_WITH_PATH']
-        return self.t['BACKEND_REDIRECT_HTTP_TO_HTTPS_WITH_PATH'].value
+        return self.profile(app)['BACKEND_REDIRECT_HTTP_TO_HTTPS_WITH_PATH']
 
     def haproxy_backend_hsts_options(self, app):
-        if 'HAPROXY_{0}_BACKEND_HSTS_OPTIONS' in app.labels:
-            return app.labels['HAPROXY_{0}_BACKEND_HSTS_OPTIONS']
-        return self.t['BACKEND_HSTS_OPTIONS'].value
+        return self.profile(app)['BACKEND_HSTS_OPTIONS']
 
     def haproxy_backend_head(self, app):
-        if 'HAPROXY_{0}_BACKEND_HEAD' in app.labels:
-            return app.labels['HAPROXY_{0}_BACKEND_HEAD']
-        return self.t['BACKEND_HEAD'].value
+        return self.profile(app)['BACKEND_HEAD']
 
     def haproxy_http_frontend_acl(self, app):
-        if 'HAPROXY_{0}_HTTP_FRONTEND_ACL' in app.labels:
-            return app.labels['HAPROXY_{0}_HTTP_FRONTEND_ACL']
-        return self.t['HTTP_FRONTEND_ACL'].value
+        return self.profile(app)['HTTP_FRONTEND_ACL']
 
     def haproxy_http_frontend_acl_only(self, app):
-        if 'HAPROXY_{0}_HTTP_FRONTEND_ACL_ONLY' in app.labels:
-            return app.labels['HAPROXY_{0}_HTTP_FRONTEND_ACL_ONLY']
-        return self.t['HTTP_FRONTEND_ACL_ONLY'].value
+        return self.profile(app)['HTTP_FRONTEND_ACL_ONLY']
 
     def haproxy_http_frontend_routing_only(self, app):
-        if 'HAPROXY_{0}_HTTP_FRONTEND_ROUTING_ONLY' in app.labels:
-            return app.labels['HAPROXY_{0}_HTTP_FRONTEND_ROUTING_ONLY']
-        return self.t['HTTP_FRONTEND_ROUTING_ONLY'].value
+        return self.profile(app)['HTTP_FRONTEND_ROUTING_ONLY']
 
     def haproxy_http_frontend_acl_with_path(self, app):
-        if 'HAPROXY_{0}_HTTP_FRONTEND_ACL_WITH_PATH' in app.labels:
-            return app.labels['HAPROXY_{0}_HTTP_FRONTEND_ACL_WITH_PATH']
-        return self.t['HTTP_FRONTEND_ACL_WITH_PATH'].value
+        return self.profile(app)['HTTP_FRONTEND_ACL_WITH_PATH']
 
     def haproxy_http_frontend_acl_only_with_path(self, app):
-        if 'HAPROXY_{0}_HTTP_FRONTEND_ACL_ONLY_WITH_PATH' in app.labels:
-            return app.labels['HAPROXY_{0}_HTTP_FRONTEND_ACL_ONLY_WITH_PATH']
-        return self.t['HTTP_FRONTEND_ACL_ONLY_WITH_PATH'].value
+        return self.profile(app)['HTTP_FRONTEND_ACL_ONLY_WITH_PATH']
 
     def haproxy_https_frontend_acl_only_with_path(self, app):
-        if 'HAPROXY_{0}_HTTPS_FRONTEND_ACL_ONLY_WITH_PATH' in app.labels:
-            return app.labels['HAPROXY_{0}_HTTPS_FRONTEND_ACL_ONLY_WITH_PATH']
-        return self.t['HTTPS_FRONTEND_ACL_ONLY_WITH_PATH'].value
+        return self.profile(app)['HTTPS_FRONTEND_ACL_ONLY_WITH_PATH']
 
     def haproxy_http_frontend_routing_only_with_path(self, app):
-        if 'HAPROXY_{0}_HTTP_FRONTEND_ROUTING_ONLY_WITH_PATH' in app.labels:
-            return \
-                app.labels['HAPROXY_{0}_HTTP_FRONTEND_ROUTING_ONLY_WITH_PATH']
-        return self.t['HTTP_FRONTEND_ROUTING_ONLY_WITH_PATH'].value
+        return self.profile(app)['HTTP_FRONTEND_ROUTING_ONLY_WITH_PATH']
 
     def haproxy_http_frontend_appid_acl(self, app):
-        if 'HAPROXY_{0}_HTTP_FRONTEND_APPID_ACL' in app.labels:
-            return app.labels['HAPROXY_{0}_HTTP_FRONTEND_APPID_ACL']
-        return self.t['HTTP_FRONTEND_APPID_ACL'].value
+        return self.profile(app)['HTTP_FRONTEND_APPID_ACL']
 
     def haproxy_https_frontend_acl(self, app):
-        if 'HAPROXY_{0}_HTTPS_FRONTEND_ACL' in app.labels:
-            return app.labels['HAPROXY_{0}_HTTPS_FRONTEND_ACL']
-        return self.t['HTTPS_FRONTEND_ACL'].value
+        return self.profile(app)['HTTPS_FRONTEND_ACL']
 
     def haproxy_https_frontend_acl_with_path(self, app):
-        if 'HAPROXY_{0}_HTTPS_FRONTEND_ACL_WITH_PATH' in app.labels:
-            return app.labels['HAPROXY_{0}_HTTPS_FRONTEND_ACL_WITH_PATH']
-        return self.t['HTTPS_FRONTEND_ACL_WITH_PATH'].value
+        return self.profile(app)['HTTPS_FRONTEND_ACL_WITH_PATH']
 
     def haproxy_backend_http_options(self, app):
-        if 'HAPROXY_{0}_BACKEND_HTTP_OPTIONS' in app.labels:
-            return app.labels['HAPROXY_{0}_BACKEND_HTTP_OPTIONS']
-        return self.t['BACKEND_HTTP_OPTIONS'].value
+        return self.profile(app)['BACKEND_HTTP_OPTIONS']
 
     def haproxy_backend_http_healthcheck_options(self, app):
-        if 'HAPROXY_{0}_BACKEND_HTTP_HEALTHCHECK_OPTIONS' in app.labels:
-            return app.labels['HAPROXY_{0}_BACKEND_HTTP_HEALTHCHECK_OPTIONS']
-        return self.t['BACKEND_HTTP_HEALTHCHECK_OPTIONS'].value
+        return self.profile(app)['BACKEND_HTTP_HEALTHCHECK_OPTIONS']
 
     def haproxy_backend_tcp_healthcheck_options(self, app):
-        if 'HAPROXY_{0}_BACKEND_TCP_HEALTHCHECK_OPTIONS' in app.labels:
-            return app.labels['HAPROXY_{0}_BACKEND_TCP_HEALTHCHECK_OPTIONS']
-        return self.t['BACKEND_TCP_HEALTHCHECK_OPTIONS'].value
+        return self.profile(app)['BACKEND_TCP_HEALTHCHECK_OPTIONS']
 
     def haproxy_backend_sticky_options(self, app):
-        if 'HAPROXY_{0}_BACKEND_STICKY_OPTIONS' in app.labels:
-            return app.labels['HAPROXY_{0}_BACKEND_STICKY_OPTIONS']
-        return self.t['BACKEND_STICKY_OPTIONS'].value
+        return self.profile(app)['BACKEND_STICKY_OPTIONS']
 
     def haproxy_backend_server_options(self, app):
-        if 'HAPROXY_{0}_BACKEND_SERVER_OPTIONS' in app.labels:
-            return app.labels['HAPROXY_{0}_BACKEND_SERVER_OPTIONS']
-        return self.t['BACKEND_SERVER_OPTIONS'].value
+        return self.profile(app)['BACKEND_SERVER_OPTIONS']
 
     def haproxy_backend_server_http_healthcheck_options(self, app):
-        if 'HAPROXY_{0}_BACKEND_SERVER_HTTP_HEALTHCHECK_OPTIONS' in \
-                app.labels:
-            return self.__blank_prefix_or_empty(
-                app.labels['HAPROXY_{0}_BACKEND' +
-                           '_SERVER_HTTP_HEALTHCHECK_OPTIONS']
-                .strip())
-        return self.__blank_prefix_or_empty(
-            self.t['BACKEND_SERVER_HTTP_HEALTHCHECK_OPTIONS'].value.strip())
+        return self.profile(app)['BACKEND_SERVER_HTTP_HEALTHCHECK_OPTIONS']
 
     def haproxy_backend_server_tcp_healthcheck_options(self, app):
-        if 'HAPROXY_{0}_BACKEND_SERVER_TCP_HEALTHCHECK_OPTIONS' in app.labels:
-            return self.__blank_prefix_or_empty(
-                app.labels['HAPROXY_{0}_BACKEND_'
-                           'SERVER_TCP_HEALTHCHECK_OPTIONS']
-                .strip())
-        return self.__blank_prefix_or_empty(
-            self.t['BACKEND_SERVER_TCP_HEALTHCHECK_OPTIONS'].value.strip())
+        return self.profile(app)['BACKEND_SERVER_TCP_HEALTHCHECK_OPTIONS']
 
     def haproxy_frontend_backend_glue(self, app):
-        if 'HAPROXY_{0}_FRONTEND_BACKEND_GLUE' in app.labels:
-            return app.labels['HAPROXY_{0}_FRONTEND_BACKEND_GLUE']
-        return self.t['FRONTEND_BACKEND_GLUE'].value
-
-    def __blank_prefix_or_empty(self, s):
-        if s:
-            return ' ' + s
-        else:
-            return s
+        return self.profile(app)['FRONTEND_BACKEND_GLUE']
 
 
 def string_to_bool(s):
@@ -998,3 +1183,33 @@ for label in labels:
     if not label.func:
         continue
     label_keys[label.full_name] = label.func
+
+# Per service port labels which have a setter, keyed by their name
+# (e.g. 'VHOST'), so that an app's labels can be dispatched with a single
+# pass over the labels the app actually has.
+service_port_labels = {}
+for label in labels:
+    if label.func and label.perServicePort:
+        service_port_labels[label.name] = label
+
+service_port_label_re = re.compile(r'^HAPROXY_(\d+)_(.+)$')
+
+
+def get_service_port_labels(app_labels):
+    """Parses the `HAPROXY_{n}_...` labels of an app.
+
+    Returns a dict of service port index -> list of (key, func, value)
+    tuples, where key is the unformatted label name (as used in
+    `label_keys`), ready to be applied to the service for that port.
+    """
+    service_labels = {}
+    for key, value in app_labels.items():
+        match = service_port_label_re.match(key)
+        if not match:
+            continue
+        label = service_port_labels.get(match.group(2))
+        if not label:
+            continue
+        service_labels.setdefault(int(match.group(1)), []).append(
+            (label.full_name, label.func, value))
+    return service_labels
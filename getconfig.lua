@@ -1,5 +1,13 @@
 -- A simple Lua script which serves up the HAProxy
 -- config as it was at init time.
+--
+-- marathon-lb writes the config's hash next to it, in <config>.hash, which
+-- is read at init, so that HAProxy doesn't hash multi-megabyte configs
+-- itself. If it's missing or for another config, the config is hashed on
+-- the first request instead. The hash is used as an ETag so that pollers
+-- can send `If-None-Match` and get a `304 Not Modified` back instead of the
+-- full config. A single `Range: bytes=...` is also honoured. The
+-- `getconfighash` service only returns the hash.
 
 function read_config_file(cmdline)
   local found = false
@@ -16,7 +24,7 @@ function read_config_file(cmdline)
   local f = io.open(filename, "rb")
   local config = f:read("*all")
   f:close()
-  return config
+  return config, filename
 end
 
 function load_config()
@@ -26,14 +34,135 @@ function load_config()
   return read_config_file(cmdline)
 end
 
+-- 64 bit FNV-1a, relying on Lua 5.3 integer wrap around.
+function hash_config(s)
+  local h = 0xcbf29ce484222325
+  local prime = 0x100000001b3
+  local chunk = 4096
+  for i = 1, #s, chunk do
+    local bytes = {string.byte(s, i, i + chunk - 1)}
+    for j = 1, #bytes do
+      h = (h ~ bytes[j]) * prime
+    end
+  end
+  return string.format("%016x", h)
+end
+
+function get_header(applet, name)
+  local values = applet.headers[name]
+  if values == nil then
+    return nil
+  end
+  return values[0]
+end
+
+-- Parses a single `bytes=first-last` range (either end may be omitted)
+-- and returns the 1-based inclusive bounds, or nil if it's not usable.
+function parse_range(range, length)
+  local first, last = string.match(range, "^bytes=(%d*)-(%d*)$")
+  if first == nil or (first == '' and last == '') then
+    return nil
+  end
+  if first == '' then
+    first = math.max(length - tonumber(last), 0)
+    last = length - 1
+  else
+    first = tonumber(first)
+    last = last == '' and length - 1 or math.min(tonumber(last), length - 1)
+  end
+  if first > last or first >= length then
+    return nil
+  end
+  return first + 1, last + 1
+end
+
+-- Reads the hash marathon-lb wrote for the config, `<hash> <length>`,
+-- and returns it if the length is the config's, or nil.
+function read_config_hash(filename, config)
+  local f = io.open(filename .. ".hash", "rb")
+  if f == nil then
+    return nil
+  end
+  local line = f:read("*line")
+  f:close()
+  if line == nil then
+    return nil
+  end
+  local hash, length = string.match(line, "^(%x+) (%d+)$")
+  if hash == nil or tonumber(length) ~= string.len(config) then
+    return nil
+  end
+  return hash
+end
+
+-- Hashes the config the first time it's needed, unless marathon-lb has.
+function config_etag()
+  if haproxy_config_hash == nil then
+    haproxy_config_hash = hash_config(haproxy_config)
+    haproxy_config_etag = '"' .. haproxy_config_hash .. '"'
+  end
+  return haproxy_config_etag
+end
+
+function etag_matches(applet)
+  local if_none_match = get_header(applet, "if-none-match")
+  if if_none_match == nil then
+    return false
+  end
+  return if_none_match == '*' or
+    string.find(if_none_match, config_etag(), 1, true) ~= nil
+end
+
 core.register_init(function()
-  haproxy_config = load_config()
+  local filename
+  haproxy_config, filename = load_config()
+  haproxy_config_hash = read_config_hash(filename, haproxy_config)
+  if haproxy_config_hash ~= nil then
+    haproxy_config_etag = '"' .. haproxy_config_hash .. '"'
+  end
 end)
 
 core.register_service("getconfig", "http", function(applet)
+  local body = haproxy_config
+  applet:add_header("etag", config_etag())
+  applet:add_header("accept-ranges", "bytes")
+  applet:add_header("content-type", "text/plain")
+
+  if etag_matches(applet) then
+    applet:set_status(304)
+    applet:add_header("content-length", 0)
+    applet:start_response()
+    return
+  end
+
+  local range = get_header(applet, "range")
+  if range ~= nil then
+    local first, last = parse_range(range, string.len(body))
+    if first == nil then
+      applet:set_status(416)
+      applet:add_header("content-range", "bytes */" .. string.len(body))
+      applet:add_header("content-length", 0)
+      applet:start_response()
+      return
+    end
+    applet:set_status(206)
+    applet:add_header("content-range", string.format(
+      "bytes %d-%d/%d", first - 1, last - 1, string.len(body)))
+    body = string.sub(body, first, last)
+  else
+    applet:set_status(200)
+  end
+
+  applet:add_header("content-length", string.len(body))
+  applet:start_response()
+  applet:send(body)
+end)
+
+core.register_service("getconfighash", "http", function(applet)
   applet:set_status(200)
-  applet:add_header("content-length", string.len(haproxy_config))
+  applet:add_header("etag", config_etag())
+  applet:add_header("content-length", string.len(haproxy_config_hash))
   applet:add_header("content-type", "text/plain")
   applet:start_response()
-  applet:send(haproxy_config)
+  applet:send(haproxy_config_hash)
 end)
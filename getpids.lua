@@ -1,23 +1,149 @@
 -- A simple Lua module for HAProxy which returns
--- a list of all the current HAProxy PIDs by using
--- the unix `pidof` command.
--- :)
+-- a list of all the current HAProxy PIDs.
+--
+-- Rather than forking `pidof` for every request, each HAProxy process
+-- appends its PID to a registry file when it starts, and periodically
+-- records its current connection count in a file of its own. Old
+-- processes keep doing so while they drain, so the endpoint can be
+-- polled cheaply from a cached response, without forking.
+--
+-- The registry is only ever appended to, a line at a time, so processes
+-- starting at the same time can't lose each other's entries, and a
+-- process's line number is its reload generation. service/haproxy/run
+-- clears it when no HAProxy is running.
+--
+-- `/_haproxy_getpids` returns the space separated PIDs, as before.
+-- `/_haproxy_getpids?format=json` returns something like:
+--
+--   {"generation":3,"pid":123,"pids":[123,97],
+--    "processes":[{"pid":123,"generation":3,"current":true,"conns":7},
+--                 {"pid":97,"generation":2,"current":false,"conns":1}]}
 
-function os.capture(cmd)
-  local f = assert(io.popen(cmd, 'r'))
-  local s = assert(f:read('*a'))
+local state_dir = "/var/run/haproxy"
+local registry_file = state_dir .. "/pids"
+local conns_interval = 1
+local cache_ttl = 1
+
+local my_pid = nil
+local my_generation = 0
+local cache = {expires = 0, text = "", json = ""}
+-- Registry lines (generations) of processes known to have exited
+local exited = {}
+
+local function pid_alive(pid)
+  local f = io.open("/proc/" .. pid .. "/stat", "r")
+  if f == nil then
+    return false
+  end
+  f:close()
+  return true
+end
+
+local function conns_file(pid)
+  return state_dir .. "/conns." .. pid
+end
+
+-- Returns the registered processes as a list of {pid=, generation=}
+-- tables, newest first, removing the connection counts of those that
+-- have exited.
+local function read_registry()
+  local entries = {}
+  local f = io.open(registry_file, "r")
+  if f == nil then
+    return entries
+  end
+  local generation = 0
+  for line in f:lines() do
+    generation = generation + 1
+    local pid = string.match(line, "^(%d+)$")
+    if pid ~= nil and not exited[generation] then
+      if pid_alive(pid) then
+        table.insert(entries, 1, {pid = pid, generation = generation})
+      else
+        exited[generation] = true
+        os.remove(conns_file(pid))
+      end
+    end
+  end
+  f:close()
+  return entries
+end
+
+local function read_conns(pid)
+  local f = io.open(conns_file(pid), "r")
+  if f == nil then
+    return nil
+  end
+  local conns = tonumber(f:read("*l"))
   f:close()
-  s = string.gsub(s, '^%s+', '')
-  s = string.gsub(s, '%s+$', '')
-  s = string.gsub(s, '[\n\r]+', ' ')
-  return s
+  return conns
+end
+
+local function build_responses()
+  local entries = read_registry()
+  local pids = {}
+  local processes = {}
+  for _, entry in ipairs(entries) do
+    local conns = read_conns(entry.pid)
+    table.insert(pids, entry.pid)
+    table.insert(processes, string.format(
+      '{"pid":%s,"generation":%d,"current":%s,"conns":%s}',
+      entry.pid, entry.generation, tostring(entry.pid == my_pid),
+      conns and tostring(conns) or "null"))
+  end
+  cache.text = table.concat(pids, " ")
+  cache.json = string.format(
+    '{"generation":%d,"pid":%s,"pids":[%s],"processes":[%s]}',
+    my_generation, my_pid, table.concat(pids, ","),
+    table.concat(processes, ","))
 end
 
+-- Registration happens in a task rather than at init time, since
+-- HAProxy only forks into the background (and gets its final PID) after
+-- the init functions have run.
+local function register()
+  my_pid = tostring(core.get_info().Pid)
+  -- A single short write in append mode, so it can't interleave with
+  -- another process's
+  local f = assert(io.open(registry_file, "a"))
+  f:write(my_pid .. "\n")
+  f:close()
+  for _, entry in ipairs(read_registry()) do
+    if entry.pid == my_pid then
+      my_generation = entry.generation
+      break
+    end
+  end
+end
+
+core.register_task(function()
+  register()
+  while true do
+    local f = io.open(conns_file(my_pid), "w")
+    if f ~= nil then
+      f:write(tostring(core.get_info().CurrConns) .. "\n")
+      f:close()
+    end
+    core.sleep(conns_interval)
+  end
+end)
+
 core.register_service("getpids", "http", function(applet)
-  local response = os.capture("pidof haproxy", false)
+  local now = core.now().sec
+  if now >= cache.expires then
+    build_responses()
+    cache.expires = now + cache_ttl
+  end
+
+  local response = cache.text
+  local content_type = "text/plain"
+  if string.find(applet.qs or "", "format=json", 1, true) then
+    response = cache.json
+    content_type = "application/json"
+  end
   applet:set_status(200)
   applet:add_header("content-length", string.len(response))
-  applet:add_header("content-type", "text/plain")
+  applet:add_header("content-type", content_type)
   applet:start_response()
   applet:send(response)
 end)
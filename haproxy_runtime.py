@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+
+"""Runtime access to HAProxy through its stats socket and its master CLI,
+and a reconciler which repairs drift between the servers marathon-lb has
+configured and the servers HAProxy is actually running with.
+"""
+
+import csv
+import logging
+import os
+import re
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger('marathon_lb')
+
+# A process in `show proc`: <PID> <type> <relative PID> <reloads> <uptime>,
+# where old workers' relative PIDs are shown as `[was: N]`, and HAProxy 2.1
+# and later add a <version>
+PROC_LINE = re.compile(r'^(\d+)\s+(\S+)\s+(?:\[was:\s*)?(\d+)\s*\]?\s+'
+                       r'(-?\d+)\s+(\S+)')
+
+# Where service/haproxy/run has HAProxy write its workers' pids
+HAPROXY_PID_FILE = '/tmp/haproxy.pid'
+
+
+def process_rss(pid):
+    """Returns a process's resident set size in bytes, or None if it's
+    gone."""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class HAProxySocket(object):
+
+    # `set server ... addr` replies when it succeeds too, with what it
+    # changed, so only these replies mean it failed
+    SET_ADDR_ERRORS = ('No such', 'Require', 'Invalid', 'Permission denied',
+                       'requires', 'Could not', "Can't", 'must be',
+                       'not an integer', 'only supported')
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+
+    def command(self, cmd):
+        """Runs a single command and returns its output."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            sock.sendall((cmd + '\n').encode('utf-8'))
+            chunks = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+        finally:
+            sock.close()
+        return b''.join(chunks).decode('utf-8')
+
+    def show_servers_state(self):
+        """Returns {backend: {server: fields}} from `show servers state`,
+        where fields are named after the columns of its header."""
+        servers = dict()
+        columns = None
+        for line in self.command('show servers state').splitlines():
+            if line.startswith('#'):
+                columns = line[1:].split()
+                continue
+            values = line.split()
+            if columns is None or len(values) < len(columns):
+                # The format version line, or a blank line
+                continue
+            fields = dict(zip(columns, values))
+            servers.setdefault(fields['be_name'], dict())[
+                fields['srv_name']] = fields
+        return servers
+
+    def show_stat(self):
+        """Returns a dict per proxy, frontend, backend and server row of
+        `show stat`, keyed by the CSV column names."""
+        lines = self.command('show stat').splitlines()
+        if not lines or not lines[0].startswith('# '):
+            return []
+        lines[0] = lines[0][2:]
+        return list(csv.DictReader(line for line in lines if line))
+
+    def run(self, cmd):
+        """Runs a command which prints nothing when it succeeds, returning
+        whether it did."""
+        output = self.command(cmd).strip()
+        if output:
+            logger.warning("'%s' failed: %s", cmd, output)
+            return False
+        return True
+
+    def set_server_addr(self, backend, server, addr):
+        """Sets a server's address, and port if `addr` is followed by
+        `port <port>`, returning whether it worked."""
+        cmd = 'set server %s/%s addr %s' % (backend, server, addr)
+        output = self.command(cmd).strip()
+        if any(error in output for error in self.SET_ADDR_ERRORS):
+            logger.warning("'%s' failed: %s", cmd, output)
+            return False
+        logger.debug("'%s': %s", cmd, output)
+        return True
+
+    def set_server_state(self, backend, server, state):
+        """Sets a server's admin state to one of ready, drain or maint."""
+        return self.run('set server %s/%s state %s' %
+                        (backend, server, state))
+
+    def save_servers_state(self, path):
+        """Writes `show servers state` to `path`, for the next HAProxy
+        process to load with `load-server-state-from-file`."""
+        state = self.command('show servers state')
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(state)
+        os.rename(tmp, path)
+
+    def add_map(self, map_file, key, value):
+        return self.run('add map %s %s %s' % (map_file, key, value))
+
+    def set_map(self, map_file, key, value):
+        return self.run('set map %s %s %s' % (map_file, key, value))
+
+    def del_map(self, map_file, key):
+        return self.run('del map %s %s' % (map_file, key))
+
+
+class HAProxyMaster(HAProxySocket):
+    """The master CLI (`-S`) of an HAProxy running in master-worker mode
+    (`-W`, HAProxy 1.9 or later), which starts and reloads the workers.
+
+    A reload re-executes the master with the new config. The workers it
+    had become old workers, which keep serving their connections until
+    they close, and new ones are started, unless the new config fails to
+    load, in which case the master waits with only the old workers.
+    """
+
+    def show_proc(self):
+        """Returns the master, worker and old worker processes, as dicts
+        with their pid, type, relative_pid, reloads and uptime, and
+        whether they're old."""
+        processes = []
+        section = None
+        for line in self.command('show proc').splitlines():
+            if line.startswith('#'):
+                section = line[1:].strip()
+                continue
+            match = PROC_LINE.match(line)
+            if match is None or match.group(2) not in ('master', 'worker'):
+                continue
+            processes.append({
+                'pid': int(match.group(1)),
+                'type': match.group(2),
+                'relative_pid': int(match.group(3)),
+                'reloads': int(match.group(4)),
+                'uptime': match.group(5),
+                'old': section == 'old workers'
+            })
+        return processes
+
+    def reload(self, timeout=30):
+        """Reloads HAProxy, returning its processes once the new workers
+        have started, or None if the new config didn't load or they didn't
+        start within `timeout` seconds."""
+        masters = [p for p in self.show_proc() if p['type'] == 'master']
+        if not masters:
+            logger.error("HAProxy's master isn't in show proc, not reloading")
+            return None
+        reloads = masters[0]['reloads']
+        try:
+            self.command('reload')
+        except socket.error:
+            # The master may close the connection as it re-executes
+            pass
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                processes = self.show_proc()
+            except socket.error:
+                # Still re-executing
+                time.sleep(0.1)
+                continue
+            masters = [p for p in processes if p['type'] == 'master']
+            if not masters or masters[0]['reloads'] <= reloads:
+                time.sleep(0.1)
+                continue
+            if any(p['type'] == 'worker' and not p['old']
+                   for p in processes):
+                return processes
+            logger.error("HAProxy didn't start new workers - is the config "
+                         "valid?")
+            return None
+        logger.error("HAProxy didn't reload within %ss", timeout)
+        return None
+
+
+def process_start_time(pid):
+    """Returns when a process started, in clock ticks since boot, or None
+    if it's gone."""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # The command may contain spaces, but is in parentheses
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def is_config_check(pid):
+    """Returns whether a process is `haproxy -c` checking a config, rather
+    than serving."""
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as f:
+            return b'-c' in f.read().split(b'\0')[1:]
+    except IOError:
+        return False
+
+
+def read_pid_file(pid_file):
+    """Returns the set of pids in a pid file, empty if it can't be
+    read."""
+    try:
+        with open(pid_file) as f:
+            return set(int(pid) for pid in f.read().split())
+    except (IOError, ValueError):
+        return set()
+
+
+def list_haproxy_processes(master=None, pid_file=HAPROXY_PID_FILE):
+    """Returns the HAProxy worker processes as (pid, old) tuples, from the
+    master CLI if there is one. Otherwise they're found with pidof, and the
+    ones in `pid_file` are the current ones, or if it lists none of them,
+    the ones started last. `haproxy -c` config checks are left out, as
+    they're often the last started."""
+    if master is not None:
+        return [(p['pid'], p['old']) for p in master.show_proc()
+                if p['type'] == 'worker']
+    try:
+        output = subprocess.check_output(['pidof', 'haproxy'])
+    except (subprocess.CalledProcessError, OSError):
+        return []
+    started = dict((int(pid), process_start_time(int(pid)))
+                   for pid in output.split())
+    started = dict((pid, started_at) for pid, started_at in started.items()
+                   if started_at is not None and not is_config_check(pid))
+    if not started:
+        return []
+    current = read_pid_file(pid_file) & set(started) if pid_file else None
+    if not current:
+        newest = max(started.values())
+        current = set(pid for pid, started_at in started.items()
+                      if started_at == newest)
+    return [(pid, pid not in current) for pid in sorted(started)]
+
+
+class OldWorkerReaper(object):
+    """Bounds the HAProxy processes left behind by reloads.
+
+    Every reload leaves the previous workers serving their connections
+    until these close, which for websockets or TCP streams may be never,
+    and each holds its own copy of the config and TLS contexts. check()
+    counts the old workers and the memory they hold, and stops them
+    (with SIGTERM, which closes their connections) when there are more
+    than `max_old_workers` of them, oldest first, or when they have been
+    old for over `max_age` seconds.
+
+    With `max_age`, render() adds `hard-stop-after` to the config, so
+    HAProxy closes old workers' connections itself when
+    they reach it; the reaper only stops the ones which outlive it by more
+    than `interval`. Either limit is off when 0.
+    """
+
+    def __init__(self, master=None, max_old_workers=0, max_age=0,
+                 interval=5, pid_file=HAPROXY_PID_FILE):
+        self.master = master
+        self.pid_file = pid_file
+        self.max_old_workers = max_old_workers
+        self.max_age = max_age
+        self.interval = interval
+        self.stats = dict(old_workers=0, old_rss=0, reaped=0, errors=0)
+        # pid -> when it was first seen as an old worker
+        self.__old_since = dict()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def render(self, templater):
+        if not self.max_age:
+            return ''
+        return templater.haproxy_hard_stop_after.format(
+            hardStopAfter='%ds' % self.max_age)
+
+    def check(self, now=None):
+        """Stops the old workers over the limits, returning their pids."""
+        if now is None:
+            now = time.time()
+        processes = list_haproxy_processes(self.master, self.pid_file)
+        old = [pid for pid, is_old in processes if is_old]
+        self.__old_since = dict((pid, self.__old_since.get(pid, now))
+                                for pid in old)
+        # Oldest first
+        old.sort(key=lambda pid: (self.__old_since[pid], pid))
+
+        reap = []
+        if self.max_age:
+            reap = [pid for pid in old if now - self.__old_since[pid] >
+                    self.max_age + self.interval]
+        if self.max_old_workers:
+            excess = old[:max(0, len(old) - self.max_old_workers)]
+            reap += [pid for pid in excess if pid not in reap]
+        for pid in reap:
+            logger.warning("stopping old HAProxy worker %d, old for %ds",
+                           pid, now - self.__old_since[pid])
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                logger.warning("couldn't stop HAProxy worker %d: %s",
+                               pid, e)
+            old.remove(pid)
+
+        old_rss = sum(process_rss(pid) or 0 for pid in old)
+        if old or reap or self.stats['old_workers']:
+            logger.info("%d old HAProxy workers using %.1fMB", len(old),
+                        old_rss / 1048576.0)
+        self.stats.update(old_workers=len(old), old_rss=old_rss)
+        self.stats['reaped'] += len(reap)
+        return reap
+
+    def start(self):
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run,
+                                         args=(self.__stop,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def __run(self, stop):
+        logger.info("starting old worker reaper, running every %ss",
+                    self.interval)
+        while not stop.wait(self.interval):
+            try:
+                self.check()
+            except (IOError, OSError) as e:
+                self.stats['errors'] += 1
+                logger.warning("couldn't check the old HAProxy workers: %s",
+                               e)
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception("Unexpected error checking old workers")
+
+
+class ServerStateReconciler(object):
+    """Periodically compares the live servers in each backend, from `show
+    servers state` and `show stat`, with the ones marathon-lb last
+    generated, and repairs the drift it finds:
+
+      * a server with the wrong address or port gets `set server ...
+        addr` (the port is only compared when `show servers state` has a
+        `srv_port` column, as from HAProxy 1.8)
+      * a server which should be draining (`disabled` in the config) but
+        isn't, is put into maintenance, as `disabled` does
+      * a server stuck in maintenance or drain which shouldn't be, is set
+        back to ready
+      * a server which is no longer wanted is put into maintenance
+      * a missing server can't be added at runtime, so the config is
+        reloaded instead
+
+    Drift is only acted on once it has been seen on two consecutive runs
+    against the same desired state, so a reload in progress isn't
+    mistaken for drift. The counts of the last run are in `last_drift`,
+    and the totals in `stats`.
+
+    `desired` is a callable returning a (generation, servers) tuple, with
+    servers as returned by marathon_lb.get_desired_servers, and the
+    generation changing whenever they do. `reload` is called to force a
+    reload of the config.
+    """
+
+    DRIFT_KINDS = ('missing', 'extra', 'address', 'state')
+
+    def __init__(self, haproxy_socket, interval):
+        self.socket = haproxy_socket
+        self.interval = interval
+        self.stats = dict((kind, 0) for kind in self.DRIFT_KINDS)
+        self.stats.update(runs=0, repairs=0, failed_repairs=0, reloads=0,
+                          errors=0)
+        self.last_drift = dict((kind, 0) for kind in self.DRIFT_KINDS)
+        self.__pending = frozenset()
+        self.__generation = None
+        self.__reloaded_generation = None
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self, desired, reload):
+        # Each event processor starts the reconciler afresh, with its own
+        # desired state
+        self.__generation = None
+        self.__reloaded_generation = None
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run,
+                                         args=(desired, reload, self.__stop))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def __run(self, desired, reload, stop):
+        logger.info("starting reconciler, running every %ss", self.interval)
+        while not stop.wait(self.interval):
+            generation, servers = desired()
+            if servers is None:
+                continue
+            try:
+                self.reconcile(generation, servers, reload)
+            except (IOError, OSError) as e:
+                self.stats['errors'] += 1
+                logger.warning("couldn't reconcile with HAProxy: %s", e)
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception("Unexpected error while reconciling")
+
+    def find_drift(self, servers):
+        """Returns the drift between the desired and live servers, as a
+        list of (kind, backend, server, repair) tuples, where repair is
+        the runtime command which fixes it (None if there is none)."""
+        live = self.socket.show_servers_state()
+        status = dict(((row['pxname'], row['svname']), row['status'])
+                      for row in self.socket.show_stat())
+        drift = []
+        for backend, wanted in servers.items():
+            live_servers = live.get(backend, dict())
+            for name, (addr, port, draining) in wanted.items():
+                if name not in live_servers:
+                    drift.append(('missing', backend, name, None))
+                    continue
+                live_port = live_servers[name].get('srv_port')
+                wrong_port = live_port is not None and live_port != str(port)
+                if wrong_port:
+                    drift.append(('address', backend, name,
+                                  ('addr', '%s port %d' % (addr, port))))
+                elif live_servers[name].get('srv_addr') != addr:
+                    drift.append(('address', backend, name,
+                                  ('addr', addr)))
+                state = status.get((backend, name), '')
+                idle = state.startswith('MAINT') or state == 'DRAIN'
+                if draining and not idle:
+                    drift.append(('state', backend, name,
+                                  ('state', 'maint')))
+                elif not draining and idle:
+                    drift.append(('state', backend, name,
+                                  ('state', 'ready')))
+            for name in live_servers:
+                state = status.get((backend, name), '')
+                if name not in wanted and not state.startswith('MAINT'):
+                    drift.append(('extra', backend, name,
+                                  ('state', 'maint')))
+        return drift
+
+    def reconcile(self, generation, servers, reload):
+        """Runs a single reconciliation, returning the drift counts."""
+        self.stats['runs'] += 1
+        if generation != self.__generation:
+            self.__generation = generation
+            self.__pending = frozenset()
+
+        drift = self.find_drift(servers)
+        counts = dict((kind, 0) for kind in self.DRIFT_KINDS)
+        for kind, _, _, _ in drift:
+            counts[kind] += 1
+            self.stats[kind] += 1
+        self.last_drift = counts
+
+        if drift:
+            logger.info("reconciler found drift: %s", ", ".join(
+                "%d %s" % (counts[kind], kind) for kind in self.DRIFT_KINDS
+                if counts[kind]))
+
+        # Only act on drift which was there last time too
+        seen = frozenset(item[:3] for item in drift)
+        confirmed = [item for item in drift if item[:3] in self.__pending]
+        self.__pending = seen
+
+        needs_reload = False
+        for kind, backend, name, repair in confirmed:
+            if repair is None:
+                needs_reload = True
+                continue
+            what, value = repair
+            logger.info("reconciler setting %s/%s %s to %s",
+                        backend, name, what, value)
+            if what == 'addr':
+                ok = self.socket.set_server_addr(backend, name, value)
+            else:
+                ok = self.socket.set_server_state(backend, name, value)
+            self.stats['repairs' if ok else 'failed_repairs'] += 1
+
+        if needs_reload:
+            if self.__reloaded_generation == generation:
+                logger.warning("reconciler: servers are still missing after "
+                               "a reload, not reloading again until the "
+                               "config changes")
+            else:
+                logger.info("reconciler: servers are missing, reloading")
+                self.__reloaded_generation = generation
+                self.stats['reloads'] += 1
+                reload()
+        return counts
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""Chooses which of several Marathon hosts to send requests to.
+
+Each host's latency (as a moving average) and errors are tracked. Hosts
+are tried leader first (as reported by `/v2/leader`), then fastest
+first. A host which fails is ejected for a backoff which doubles with
+each consecutive failure, and is only tried again once that has passed,
+or when every other host has been ejected too.
+
+Requests go through a single session, so connections to the hosts are
+kept alive between requests. They time out after `timeout`, a (connect,
+read) tuple, so that a host which accepts connections but then stalls
+fails over like one which refuses them.
+"""
+
+from six.moves.urllib import parse
+
+import logging
+import socket
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger('marathon_lb')
+
+
+class MarathonHost(object):
+
+    def __init__(self, url):
+        self.url = url
+        self.netloc = parse.urlparse(url).netloc.rpartition('@')[2]
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.latency = None
+        self.ejected_until = 0
+        self.last_error = None
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'requests': self.requests,
+            'errors': self.errors,
+            'consecutive_errors': self.consecutive_errors,
+            'latency': self.latency,
+            'ejected': self.ejected_until > time.time(),
+            'last_error': self.last_error
+        }
+
+
+def resolve_netloc(netloc):
+    """Returns host:port with the host resolved to an IP, where possible."""
+    host, _, port = netloc.rpartition(':')
+    if not host:
+        host, port = port, ''
+    try:
+        host = socket.gethostbyname(host)
+    except socket.error:
+        pass
+    return host + ':' + port if port else host
+
+
+class MarathonHosts(object):
+
+    def __init__(self, urls, auth=None, leader_refresh=30, min_backoff=1,
+                 max_backoff=60, latency_weight=0.3, timeout=(5, 60)):
+        self.hosts = [MarathonHost(url) for url in urls]
+        self.auth = auth
+        self.leader_refresh = leader_refresh
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.latency_weight = latency_weight
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.leader = None
+        self.__leader_checked_at = None
+        self.__lock = threading.Lock()
+
+    def ordered(self):
+        """Returns the hosts in the order they should be tried."""
+        self.__refresh_leader()
+        now = time.time()
+        with self.__lock:
+            available = [h for h in self.hosts if h.ejected_until <= now]
+            ejected = sorted((h for h in self.hosts if h.ejected_until > now),
+                             key=lambda h: h.ejected_until)
+
+            def key(host):
+                latency = host.latency if host.latency is not None else 0
+                return (host is not self.leader, latency)
+            return sorted(available, key=key) + ejected
+
+    def best(self):
+        return self.ordered()[0]
+
+    def succeeded(self, host, latency):
+        with self.__lock:
+            host.requests += 1
+            if host.latency is None:
+                host.latency = latency
+            else:
+                host.latency += self.latency_weight * (latency - host.latency)
+            if host.consecutive_errors:
+                logger.info("Marathon host %s recovered", host.url)
+            host.consecutive_errors = 0
+            host.ejected_until = 0
+
+    def failed(self, host, error):
+        with self.__lock:
+            host.requests += 1
+            host.errors += 1
+            host.consecutive_errors += 1
+            host.last_error = str(error)
+            backoff = min(self.max_backoff, self.min_backoff *
+                          2 ** (host.consecutive_errors - 1))
+            host.ejected_until = time.time() + backoff
+            if host is self.leader:
+                # Find out who the leader is now
+                self.__leader_checked_at = None
+        logger.warning("Marathon host %s failed (%s), ejecting it for %ss",
+                       host.url, error, backoff)
+
+    def request(self, method, path, **kwargs):
+        """Makes a request to the first host which answers it without a
+        connection error or server error, returning the response (of the
+        last host tried, if none did)."""
+        kwargs.setdefault('timeout', self.timeout)
+        response = None
+        error = None
+        for host in self.ordered():
+            start = time.time()
+            try:
+                response = self.session.request(method, host.url + path,
+                                                **kwargs)
+            except requests.exceptions.RequestException as e:
+                self.failed(host, e)
+                error = e
+                continue
+            if response.status_code >= 500:
+                self.failed(host, "HTTP %d" % response.status_code)
+                continue
+            self.succeeded(host, time.time() - start)
+            return response
+        if response is None:
+            raise error
+        return response
+
+    def __refresh_leader(self):
+        now = time.time()
+        with self.__lock:
+            if len(self.hosts) < 2 or (
+                    self.__leader_checked_at is not None and
+                    now - self.__leader_checked_at < self.leader_refresh):
+                return
+            self.__leader_checked_at = now
+            candidates = sorted(
+                (h for h in self.hosts if h.ejected_until <= now),
+                key=lambda h: h.latency if h.latency is not None else 0)
+        for host in candidates:
+            try:
+                response = self.session.get(host.url + '/v2/leader',
+                                            auth=self.auth,
+                                            timeout=self.timeout)
+                leader = response.json()['leader']
+            except requests.exceptions.RequestException as e:
+                self.failed(host, e)
+                continue
+            except (ValueError, KeyError) as e:
+                logger.debug("couldn't get the leader from %s: %s",
+                             host.url, e)
+                continue
+            self.__set_leader(leader)
+            return
+
+    def __set_leader(self, leader):
+        resolved = resolve_netloc(leader)
+        for host in self.hosts:
+            if host.netloc == leader or \
+                    resolve_netloc(host.netloc) == resolved:
+                if host is not self.leader:
+                    logger.info("Marathon leader is %s", host.url)
+                self.leader = host
+                return
+        logger.debug("Marathon leader %s isn't one of our hosts", leader)
+        self.leader = None
+
+    def stats(self):
+        with self.__lock:
+            return [dict(host.stats(), leader=host is self.leader)
+                    for host in self.hosts]
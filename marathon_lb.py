@@ -20,17 +20,20 @@ which marathon-lb can be reached by Marathon.
 ### Command Line Usage
 """
 
-from logging.handlers import SysLogHandler
 from operator import attrgetter
 from shutil import move
 from tempfile import mkstemp
-from wsgiref.simple_server import make_server
 from six.moves.urllib import parse
-from itertools import cycle
 from common import *
 from config import *
+from haproxy_runtime import HAProxyMaster, HAProxySocket, \
+    OldWorkerReaper, ServerStateReconciler, process_rss
+from marathon_hosts import MarathonHosts
+from template_watcher import TemplateWatcher
 
 import argparse
+import gzip
+import hashlib
 import json
 import logging
 import os
@@ -43,7 +46,6 @@ import subprocess
 import sys
 import socket
 import time
-import dateutil.parser
 import math
 import threading
 import random
@@ -85,6 +87,8 @@ class MarathonService(object):
         self.balance = 'roundrobin'
         self.healthCheck = healthCheck
         self.labels = {}
+        # Set by ConfigTemplater.profile()
+        self.template_profile = None
         if healthCheck:
             if healthCheck['protocol'] == 'HTTP':
                 self.mode = 'http'
@@ -92,6 +96,13 @@ class MarathonService(object):
     def add_backend(self, host, port, draining):
         self.backends.add(MarathonBackend(host, port, draining))
 
+    def clone(self):
+        """Returns a copy of this service, without any backends."""
+        service = MarathonService.__new__(MarathonService)
+        service.__dict__.update(self.__dict__)
+        service.backends = set()
+        return service
+
     def __hash__(self):
         return hash(self.servicePort)
 
@@ -123,31 +134,27 @@ class Marathon(object):
 
     def __init__(self, hosts, health_check, auth):
         # TODO(cmaloney): Support getting master list from zookeeper
-        self.__hosts = hosts
+        self.__hosts = MarathonHosts([host.rstrip('/') for host in hosts],
+                                     auth)
         self.__health_check = health_check
         self.__auth = auth
-        self.__cycle_hosts = cycle(self.__hosts)
 
     def api_req_raw(self, method, path, auth, body=None, **kwargs):
-        for host in self.__hosts:
-            path_str = os.path.join(host, 'v2')
-
-            for path_elem in path:
-                path_str = path_str + "/" + path_elem
-            response = requests.request(
-                method,
-                path_str,
-                auth=auth,
-                headers={
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/json'
-                },
-                **kwargs
-            )
+        path_str = '/v2'
+        for path_elem in path:
+            path_str = path_str + "/" + path_elem
+        response = self.__hosts.request(
+            method,
+            path_str,
+            auth=auth,
+            headers={
+                'Accept': 'application/json',
+                'Content-Type': 'application/json'
+            },
+            **kwargs
+        )
 
-            logger.debug("%s %s", method, response.url)
-            if response.status_code == 200:
-                break
+        logger.debug("%s %s", method, response.url)
         if 'message' in response.json():
             response.reason = "%s (%s)" % (
                 response.reason,
@@ -178,6 +185,10 @@ class Marathon(object):
         logger.info('fetching tasks')
         return self.api_req('GET', ['tasks'])["tasks"]
 
+    def deployments(self):
+        logger.info('fetching deployments')
+        return self.api_req('GET', ['deployments'])
+
     def add_subscriber(self, callbackUrl):
         return self.api_req(
                 'POST',
@@ -190,18 +201,22 @@ class Marathon(object):
                 ['eventSubscriptions'],
                 params={'callbackUrl': callbackUrl})
 
-    def get_event_stream(self):
-        url = self.host+"/v2/events"
-        logger.info(
-            "SSE Active, trying fetch events from {0}".format(url))
+    def host_stats(self):
+        """Returns the latency, error and leader stats of each host."""
+        return self.__hosts.stats()
 
+    def get_event_stream(self):
         headers = {
             'Cache-Control': 'no-cache',
             'Accept': 'text/event-stream'
         }
 
-        resp = requests.get(url, stream=True,
-                            headers=headers, auth=self.__auth)
+        # Events can be minutes apart, so the stream has no read timeout
+        resp = self.__hosts.request('GET', '/v2/events', stream=True,
+                                    headers=headers, auth=self.__auth,
+                                    timeout=(self.__hosts.timeout[0], None))
+        logger.info(
+            "SSE Active, trying fetch events from {0}".format(resp.url))
 
         class Event(object):
             def __init__(self, data):
@@ -217,7 +232,7 @@ class Marathon(object):
 
     @property
     def host(self):
-        return next(self.__cycle_hosts)
+        return self.__hosts.best().url
 
 
 def has_group(groups, app_groups):
@@ -235,6 +250,25 @@ def has_group(groups, app_groups):
 
     return False
 
+
+def service_has_group(groups, service):
+    # Check if there is a haproxy group associated with service group
+    # if not fallback to original HAPROXY group.
+    # This is added for backward compatability with HAPROXY_GROUP
+    if service.haproxy_groups:
+        return has_group(groups, service.haproxy_groups)
+    return has_group(groups, service.groups)
+
+
+def get_backend_name(service):
+    return service.appId[1:].replace('/', '_') + '_' + \
+        str(service.servicePort)
+
+
+def get_server_name(backend_server):
+    return re.sub(r'[^a-zA-Z0-9\-]', '_',
+                  backend_server.host + '_' + str(backend_server.port))
+
 ip_cache = dict()
 
 
@@ -252,19 +286,33 @@ def resolve_ip(host):
             return None
 
 
-def config(apps, groups, bind_http_https, ssl_certs, templater):
+def config(apps, groups, bind_http_https, ssl_certs, templater,
+           server_slots=None, routing_maps=None, cert_list=None,
+           shared_frontends=None, old_workers=None):
     logger.info("generating config")
     config = templater.haproxy_head
+    if old_workers is not None:
+        config += old_workers.render(templater)
     groups = frozenset(groups)
     _ssl_certs = ssl_certs or "/etc/ssl/mesosphere.com.pem"
     _ssl_certs = _ssl_certs.split(",")
 
     if bind_http_https:
         http_frontends = templater.haproxy_http_frontend_head
+        if cert_list is not None:
+            cert_list.reset(_ssl_certs)
+            sslCerts = "crt-list " + cert_list.path
+        else:
+            sslCerts = " ".join(map(lambda cert: "crt " + cert, _ssl_certs))
         https_frontends = templater.haproxy_https_frontend_head.format(
-            sslCerts=" ".join(map(lambda cert: "crt " + cert, _ssl_certs))
+            sslCerts=sslCerts
         )
 
+    if routing_maps is not None:
+        routing_maps.reset()
+    if shared_frontends is not None:
+        shared_frontends.reset()
+
     frontends = str()
     backends = str()
     http_appid_frontends = templater.haproxy_http_frontend_appid_head
@@ -272,18 +320,11 @@ def config(apps, groups, bind_http_https, ssl_certs, templater):
 
     for app in sorted(apps, key=attrgetter('appId', 'servicePort')):
         # App only applies if we have it's group
-        # Check if there is a haproxy group associated with service group
-        # if not fallback to original HAPROXY group.
-        # This is added for backward compatability with HAPROXY_GROUP
-        if app.haproxy_groups:
-            if not has_group(groups, app.haproxy_groups):
-                continue
-        else:
-            if not has_group(groups, app.groups):
-                continue
+        if not service_has_group(groups, app):
+            continue
 
         logger.debug("configuring app %s", app.appId)
-        backend = app.appId[1:].replace('/', '_') + '_' + str(app.servicePort)
+        backend = get_backend_name(app)
 
         logger.debug("frontend at %s:%d with backend %s",
                      app.bindAddr, app.servicePort, backend)
@@ -293,15 +334,18 @@ def config(apps, groups, bind_http_https, ssl_certs, templater):
         if app.hostname:
             app.mode = 'http'
 
-        frontend_head = templater.haproxy_frontend_head(app)
-        frontends += frontend_head.format(
-            bindAddr=app.bindAddr,
-            backend=backend,
-            servicePort=app.servicePort,
-            mode=app.mode,
-            sslCert=' ssl crt ' + app.sslCert if app.sslCert else '',
-            bindOptions=' ' + app.bindOptions if app.bindOptions else ''
-        )
+        shared_frontend = shared_frontends is not None and \
+            shared_frontends.add(templater, app, backend)
+        if not shared_frontend:
+            frontend_head = templater.haproxy_frontend_head(app)
+            frontends += frontend_head.format(
+                bindAddr=app.bindAddr,
+                backend=backend,
+                servicePort=app.servicePort,
+                mode=app.mode,
+                sslCert=' ssl crt ' + app.sslCert if app.sslCert else '',
+                bindOptions=' ' + app.bindOptions if app.bindOptions else ''
+            )
 
         backend_head = templater.haproxy_backend_head(app)
         backends += backend_head.format(
@@ -314,10 +358,16 @@ def config(apps, groups, bind_http_https, ssl_certs, templater):
         # of our haproxy config
         # TODO(lloesche): Check if the hostname is already defined by another
         # service
+        if bind_http_https and app.hostname and app.sslCert and \
+                cert_list is not None:
+            cert_list.add(app.sslCert, app.hostname.split(','))
+
         if bind_http_https and app.hostname:
-            p_fe, s_fe = generateHttpVhostAcl(templater, app, backend)
-            http_frontends += p_fe
-            https_frontends += s_fe
+            if routing_maps is None or \
+                    not routing_maps.add(templater, app, backend):
+                p_fe, s_fe = generateHttpVhostAcl(templater, app, backend)
+                http_frontends += p_fe
+                https_frontends += s_fe
 
         # if app mode is http, we add the app to the second http frontend
         # selecting apps by http header X-Marathon-App-Id
@@ -377,71 +427,84 @@ def config(apps, groups, bind_http_https, ssl_certs, templater):
             logger.debug("turning on sticky sessions")
             backends += templater.haproxy_backend_sticky_options(app)
 
-        frontend_backend_glue = templater.haproxy_frontend_backend_glue(app)
-        frontends += frontend_backend_glue.format(backend=backend)
+        if not shared_frontend:
+            frontend_backend_glue = \
+                templater.haproxy_frontend_backend_glue(app)
+            frontends += frontend_backend_glue.format(backend=backend)
 
         key_func = attrgetter('host', 'port')
+        servers = []
         for backendServer in sorted(app.backends, key=key_func):
             logger.debug(
                 "backend server at %s:%d",
                 backendServer.host,
                 backendServer.port)
-            serverName = re.sub(
-                r'[^a-zA-Z0-9\-]', '_',
-                backendServer.host + '_' + str(backendServer.port))
-
-            healthCheckOptions = None
-            if app.healthCheck:
-                server_health_check_options = None
-                if app.mode == 'tcp' or app.healthCheck['protocol'] == 'TCP':
-                    server_health_check_options = templater \
-                        .haproxy_backend_server_tcp_healthcheck_options(app)
-                elif app.mode == 'http':
-                    server_health_check_options = templater \
-                        .haproxy_backend_server_http_healthcheck_options(app)
-                if server_health_check_options:
-                    healthCheckPort = app.healthCheck.get('port')
-                    healthCheckOptions = server_health_check_options.format(
-                        healthCheck=app.healthCheck,
-                        healthCheckPortIndex=app.healthCheck.get('portIndex'),
-                        healthCheckPort=healthCheckPort,
-                        healthCheckProtocol=app.healthCheck['protocol'],
-                        healthCheckPath=app.healthCheck.get('path', '/'),
-                        healthCheckTimeoutSeconds=app.healthCheck[
-                            'timeoutSeconds'],
-                        healthCheckIntervalSeconds=app.healthCheck[
-                            'intervalSeconds'],
-                        healthCheckIgnoreHttp1xx=app.healthCheck[
-                            'ignoreHttp1xx'],
-                        healthCheckGracePeriodSeconds=app.healthCheck[
-                            'gracePeriodSeconds'],
-                        healthCheckMaxConsecutiveFailures=app.healthCheck[
-                            'maxConsecutiveFailures'],
-                        healthCheckFalls=app.healthCheck[
-                            'maxConsecutiveFailures'] + 1,
-                        healthCheckPortOptions=' port ' +
-                        str(healthCheckPort) if healthCheckPort else ''
-                    )
             ipv4 = resolve_ip(backendServer.host)
-
             if ipv4 is not None:
-                backend_server_options = templater \
-                    .haproxy_backend_server_options(app)
-                backends += backend_server_options.format(
-                    host=backendServer.host,
-                    host_ipv4=ipv4,
-                    port=backendServer.port,
-                    serverName=serverName,
-                    cookieOptions=' check cookie ' +
-                    serverName if app.sticky else '',
-                    healthCheckOptions=healthCheckOptions
-                    if healthCheckOptions else '',
-                    otherOptions=' disabled' if backendServer.draining else ''
-                )
+                servers.append((get_server_name(backendServer),
+                                backendServer, ipv4))
             else:
                 logger.warning("Could not resolve ip for host %s, "
                                "ignoring this backend",
                                backendServer.host)
+        if server_slots:
+            servers = server_slots.assign(backend, servers)
+
+        # The health check options are the same for all the servers
+        healthCheckOptions = None
+        if app.healthCheck and servers:
+            server_health_check_options = None
+            if app.mode == 'tcp' or app.healthCheck['protocol'] == 'TCP':
+                server_health_check_options = templater \
+                    .haproxy_backend_server_tcp_healthcheck_options(app)
+            elif app.mode == 'http':
+                server_health_check_options = templater \
+                    .haproxy_backend_server_http_healthcheck_options(app)
+            if server_health_check_options:
+                healthCheckPort = app.healthCheck.get('port')
+                healthCheckOptions = server_health_check_options.format(
+                    healthCheck=app.healthCheck,
+                    healthCheckPortIndex=app.healthCheck.get('portIndex'),
+                    healthCheckPort=healthCheckPort,
+                    healthCheckProtocol=app.healthCheck['protocol'],
+                    healthCheckPath=app.healthCheck.get('path', '/'),
+                    healthCheckTimeoutSeconds=app.healthCheck[
+                        'timeoutSeconds'],
+                    healthCheckIntervalSeconds=app.healthCheck[
+                        'intervalSeconds'],
+                    healthCheckIgnoreHttp1xx=app.healthCheck[
+                        'ignoreHttp1xx'],
+                    healthCheckGracePeriodSeconds=app.healthCheck[
+                        'gracePeriodSeconds'],
+                    healthCheckMaxConsecutiveFailures=app.healthCheck[
+                        'maxConsecutiveFailures'],
+                    healthCheckFalls=app.healthCheck[
+                        'maxConsecutiveFailures'] + 1,
+                    healthCheckPortOptions=' port ' +
+                    str(healthCheckPort) if healthCheckPort else ''
+                )
+        backend_server_options = \
+            templater.haproxy_backend_server_options(app)
+        for serverName, backendServer, ipv4 in servers:
+            backends += backend_server_options.format(
+                host=backendServer.host,
+                host_ipv4=ipv4,
+                port=backendServer.port,
+                serverName=serverName,
+                cookieOptions=' check cookie ' +
+                serverName if app.sticky else '',
+                healthCheckOptions=healthCheckOptions
+                if healthCheckOptions else '',
+                otherOptions=' disabled' if backendServer.draining else ''
+            )
+
+    if bind_http_https and routing_maps is not None:
+        p_fe, s_fe = routing_maps.frontend_acls(templater)
+        http_frontends += p_fe
+        https_frontends += s_fe
+
+    if shared_frontends is not None:
+        frontends += shared_frontends.render(templater)
 
     if bind_http_https:
         config += http_frontends
@@ -451,9 +514,526 @@ def config(apps, groups, bind_http_https, ssl_certs, templater):
     config += frontends
     config += backends
 
+    templater.prune_profiles(apps)
     return config
 
 
+def get_desired_servers(apps, groups, templater, server_slots=None):
+    """Returns the servers config() puts in each backend, as
+    {backend: {serverName: (ipv4, port, draining)}}. Backends whose
+    server lines are overridden without the default server names are
+    left out, since there's no telling what they are called. With
+    server_slots, the slots assigned by the last config() are returned,
+    empty ones as draining."""
+    groups = frozenset(groups)
+    servers = dict()
+    for app in apps:
+        if not service_has_group(groups, app):
+            continue
+        if '{serverName}' not in \
+                templater.haproxy_backend_server_options(app):
+            continue
+        backend = get_backend_name(app)
+        backend_servers = servers.setdefault(backend, dict())
+        if server_slots:
+            for slot, backendServer, ipv4 in \
+                    server_slots.assigned.get(backend, []):
+                backend_servers[slot] = \
+                    (ipv4, backendServer.port, backendServer.draining)
+            continue
+        for backendServer in app.backends:
+            ipv4 = resolve_ip(backendServer.host)
+            if ipv4 is not None:
+                backend_servers[get_server_name(backendServer)] = \
+                    (ipv4, backendServer.port, backendServer.draining)
+    return servers
+
+
+class ServerSlots(object):
+    """Renders each backend with a fixed number of server slots, named
+    slot1, slot2, ..., rather than one server per task. Spare slots are
+    rendered as disabled placeholders, and servers keep the slot they had
+    in the running config. Tasks coming and going, or starting and
+    stopping draining, then only change the address and state of slots,
+    which apply_runtime_changes() can do through the stats socket without
+    a reload.
+
+    A backend has room for `size` servers, then 2 * `size` and so on, with
+    at least one spare slot.
+    """
+
+    placeholder = MarathonBackend('127.0.0.1', 1, True)
+    server_re = re.compile(
+        r'^(\s*server (slot\d+) )(\S+?):(\d+)(.*?)( disabled)?$')
+    backend_re = re.compile(r'^backend (\S+)')
+
+    def __init__(self, size):
+        self.size = size
+        # backend -> {(ipv4, port): slot}, from the running config
+        self.previous = dict()
+        # backend -> [(slot, MarathonBackend, ipv4)], from the last config()
+        self.assigned = dict()
+
+    @classmethod
+    def parse(cls, config):
+        """Returns the config with the address, port and disabled flag of
+        each slot masked out, and {backend: {slot: (ipv4, port, disabled)}}
+        for the slots."""
+        masked = []
+        slots = dict()
+        backend = None
+        for line in config.splitlines():
+            match = cls.backend_re.match(line)
+            if match:
+                backend = match.group(1)
+            match = cls.server_re.match(line)
+            if match and backend:
+                slots.setdefault(backend, dict())[match.group(2)] = \
+                    (match.group(3), int(match.group(4)),
+                     bool(match.group(6)))
+                line = match.group(1) + match.group(5)
+            masked.append(line)
+        return masked, slots
+
+    def load(self, running_config):
+        """Remembers the slots servers have in the running config."""
+        self.previous = dict()
+        _, slots = self.parse(running_config)
+        for backend, backend_slots in slots.items():
+            self.previous[backend] = dict(
+                ((ipv4, port), slot)
+                for slot, (ipv4, port, _) in backend_slots.items()
+                if (ipv4, port) != (self.placeholder.host,
+                                    self.placeholder.port))
+
+    def capacity(self, count):
+        return (count // self.size + 1) * self.size
+
+    def assign(self, backend, servers):
+        """Assigns (serverName, MarathonBackend, ipv4) tuples to slots,
+        returning them renamed after their slots, with placeholders for
+        the spare slots."""
+        previous = self.previous.get(backend, dict())
+        slots = [None] * self.capacity(len(servers))
+        unassigned = []
+        for server in servers:
+            slot = previous.get((server[2], server[1].port))
+            index = int(slot[4:]) - 1 if slot else len(slots)
+            if index < len(slots) and slots[index] is None:
+                slots[index] = server
+            else:
+                unassigned.append(server)
+        free = (i for i, server in enumerate(slots) if server is None)
+        for server in unassigned:
+            slots[next(free)] = server
+
+        assigned = []
+        for i, server in enumerate(slots):
+            if server is None:
+                assigned.append(('slot%d' % (i + 1), self.placeholder,
+                                 self.placeholder.host))
+            else:
+                assigned.append(('slot%d' % (i + 1), server[1], server[2]))
+        self.assigned[backend] = assigned
+        return assigned
+
+
+def get_slot_changes(running_config, config):
+    """Returns the runtime commands which turn the running config into the
+    new one, as (backend, slot, command, argument) tuples, or None if the
+    configs differ in more than the address and state of server slots."""
+    running_masked, running_slots = ServerSlots.parse(running_config)
+    masked, slots = ServerSlots.parse(config)
+    if masked != running_masked:
+        return None
+    changes = []
+    for backend, backend_slots in sorted(slots.items()):
+        for slot, (ipv4, port, disabled) in sorted(backend_slots.items()):
+            old_ipv4, old_port, old_disabled = running_slots[backend][slot]
+            if (ipv4, port) != (old_ipv4, old_port):
+                if not old_disabled:
+                    changes.append((backend, slot, 'state', 'maint'))
+                addr = ipv4 if port == old_port \
+                    else '%s port %d' % (ipv4, port)
+                changes.append((backend, slot, 'addr', addr))
+                if not disabled:
+                    changes.append((backend, slot, 'state', 'ready'))
+            elif disabled != old_disabled:
+                # `disabled` in the config is maintenance, so draining
+                # servers are put into maintenance at runtime too
+                changes.append((backend, slot, 'state',
+                                'maint' if disabled else 'ready'))
+    return changes
+
+
+def apply_runtime_changes(running_config, config, haproxy_socket):
+    """Tries to apply the difference between the running and the new
+    config through the stats socket. Returns whether HAProxy is now
+    running with the new config, so a reload isn't needed."""
+    changes = get_slot_changes(running_config, config)
+    if changes is None:
+        return False
+    logger.info("applying %d server slot changes at runtime", len(changes))
+    try:
+        for backend, slot, command, argument in changes:
+            if command == 'addr':
+                ok = haproxy_socket.set_server_addr(backend, slot, argument)
+            else:
+                ok = haproxy_socket.set_server_state(backend, slot, argument)
+            if not ok:
+                return False
+    except (IOError, OSError) as e:
+        logger.warning("couldn't apply changes at runtime: %s", e)
+        return False
+    return True
+
+
+class RoutingMaps(object):
+    """Map files which the HTTP and HTTPS frontends route virtual hosts
+    with, so that HAProxy looks a request's host (and path) up in a map
+    rather than evaluating an ACL per virtual host. Hosts are looked up
+    in a tree (`map_str`); hosts with paths are matched by prefix
+    (`map_beg`), which scans the path map in order, but in a single
+    lookup.
+
+    config() adds each service with a virtual host to the maps, unless
+    it redirects HTTP to HTTPS or overrides one of the templates its
+    ACLs are made from, in which case it's routed with ACLs as usual.
+    Map lookups come after the ACLs in each frontend.
+
+    When only the maps change, get_changes() and apply_changes() update
+    the running HAProxy's copies of them through the stats socket, so it
+    needn't be reloaded.
+    """
+
+    HOST_MAP = 'domain2backend.map'
+    PATH_MAP = 'domainpath2backend.map'
+
+    # The templates generateHttpVhostAcl renders
+    ACL_TEMPLATES = frozenset([
+        'HTTP_FRONTEND_ACL', 'HTTP_FRONTEND_ACL_ONLY',
+        'HTTP_FRONTEND_ROUTING_ONLY', 'HTTP_FRONTEND_ACL_WITH_PATH',
+        'HTTP_FRONTEND_ACL_ONLY_WITH_PATH',
+        'HTTPS_FRONTEND_ACL_ONLY_WITH_PATH',
+        'HTTP_FRONTEND_ROUTING_ONLY_WITH_PATH', 'HTTPS_FRONTEND_ACL',
+        'HTTPS_FRONTEND_ACL_WITH_PATH'])
+
+    def __init__(self, directory):
+        self.directory = directory
+        # [(hostname, backend)]
+        self.hosts = []
+        # [(hostname + path, backend)]
+        self.paths = []
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def reset(self):
+        self.hosts = []
+        self.paths = []
+
+    def add(self, templater, app, backend):
+        """Adds a service's virtual hosts to the maps, returning whether it
+        can be routed with them."""
+        if app.redirectHttpToHttps:
+            return False
+        if any(name in self.ACL_TEMPLATES
+               for name, value in templater.profile(app).overrides):
+            return False
+        for hostname in app.hostname.split(','):
+            hostname = hostname.strip().lower()
+            if app.path:
+                # The frontends lowercase the whole of `base`
+                self.paths.append(((hostname + app.path).lower(), backend))
+            else:
+                self.hosts.append((hostname, backend))
+        return True
+
+    def frontend_acls(self, templater):
+        """Returns the lines which route the HTTP and the HTTPS frontends
+        with the maps."""
+        http = https = ''
+        if self.paths:
+            path_acl = templater.haproxy_map_http_frontend_acl_with_path \
+                .format(pathMap=self.path(self.PATH_MAP))
+            http += path_acl
+            https += path_acl
+        if self.hosts:
+            http += templater.haproxy_map_http_frontend_acl.format(
+                hostMap=self.path(self.HOST_MAP))
+            https += templater.haproxy_map_https_frontend_acl.format(
+                hostMap=self.path(self.HOST_MAP))
+        return http, https
+
+    def render(self):
+        """Returns the contents of each map file. Host lookups are exact,
+        while paths are matched by prefix in the order they're listed, so
+        the longest paths go first."""
+        hosts = sorted(self.hosts)
+        paths = sorted(self.paths, key=lambda entry: (-len(entry[0]), entry))
+        return {
+            self.HOST_MAP: ''.join('%s %s\n' % entry for entry in hosts),
+            self.PATH_MAP: ''.join('%s %s\n' % entry for entry in paths)
+        }
+
+    def read(self, name):
+        """Returns the (key, value) entries of a map file on disk."""
+        try:
+            with open(self.path(name)) as f:
+                return [tuple(line.split(None, 1))
+                        for line in f.read().splitlines() if line.strip()]
+        except IOError:
+            return []
+
+    def get_changes(self):
+        """Returns the runtime map commands which turn the maps on disk into
+        the rendered ones, as (command, name, key, value) tuples, or None
+        if they can't be, because a key is listed twice or because a path
+        added at runtime would come after a shorter one it starts with."""
+        changes = []
+        for name, content in sorted(self.render().items()):
+            running = self.read(name)
+            wanted = [tuple(line.split(' ', 1))
+                      for line in content.splitlines()]
+            running_values = dict(running)
+            wanted_values = dict(wanted)
+            if len(running_values) != len(running) or \
+                    len(wanted_values) != len(wanted):
+                return None
+            for key, value in running:
+                if key not in wanted_values:
+                    changes.append(('del', name, key, None))
+                elif wanted_values[key] != value:
+                    changes.append(('set', name, key, wanted_values[key]))
+            # Added at the end of the running map, in the rendered order
+            for key, value in wanted:
+                if key in running_values:
+                    continue
+                if name == self.PATH_MAP and any(
+                        key.startswith(other) for other in running_values
+                        if other in wanted_values):
+                    return None
+                changes.append(('add', name, key, value))
+        return changes
+
+    def apply_changes(self, changes, haproxy_socket):
+        """Applies changes from get_changes() through the stats socket,
+        returning whether they all succeeded."""
+        for command, name, key, value in changes:
+            map_file = self.path(name)
+            logger.info("%s map %s %s %s", command, map_file, key,
+                        value or '')
+            if command == 'add':
+                ok = haproxy_socket.add_map(map_file, key, value)
+            elif command == 'set':
+                ok = haproxy_socket.set_map(map_file, key, value)
+            else:
+                ok = haproxy_socket.del_map(map_file, key)
+            if not ok:
+                return False
+        return True
+
+    def write(self):
+        """Writes the map files which changed, returning whether any did."""
+        changed = False
+        for name, content in self.render().items():
+            changed |= write_if_changed(self.path(name), content)
+        return changed
+
+
+class CertList(object):
+    """A crt-list which the HTTPS frontend loads its certificates from.
+
+    The --ssl-certs come first, without SNI filters, so the first of them
+    remains the default certificate. Each HAPROXY_{n}_SSL_CERT of a
+    service with a virtual host follows, filtered to the service's
+    hostnames, so HAProxy picks it by SNI.
+
+    Each certificate is preceded by a comment with the SHA-1 of its
+    contents, so the crt-list changes, and HAProxy is reloaded, when a
+    certificate does, but not when one is merely touched or the same
+    certificates are listed again. Hashes are kept by inode, size and
+    mtime, so unchanged files aren't read again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # [cert], in the order they're added
+        self.certs = []
+        # cert -> [hostname]
+        self.sni_filters = dict()
+        # cert -> ((inode, size, mtime), sha1)
+        self.__hashes = dict()
+
+    def reset(self, default_certs):
+        self.certs = list(default_certs)
+        self.sni_filters = dict((cert, []) for cert in default_certs)
+
+    def add(self, cert, hostnames):
+        if cert not in self.sni_filters:
+            self.certs.append(cert)
+            self.sni_filters[cert] = []
+        elif not self.sni_filters[cert]:
+            # Already a default certificate, for any hostname
+            return
+        for hostname in hostnames:
+            hostname = hostname.strip().lower()
+            if hostname not in self.sni_filters[cert]:
+                self.sni_filters[cert].append(hostname)
+
+    def hash(self, cert):
+        try:
+            st = os.stat(cert)
+            key = (st.st_ino, st.st_size, st.st_mtime)
+            cached = self.__hashes.get(cert)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            with open(cert, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        except (IOError, OSError) as e:
+            logger.warning("couldn't read certificate %s: %s", cert, e)
+            return 'missing'
+        self.__hashes[cert] = (key, digest)
+        return digest
+
+    def listed_hashes(self):
+        """Returns [(cert, sha1)] for the certificates in the crt-list on
+        disk, as they are now."""
+        try:
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+        except IOError:
+            return []
+        certs = [line.split()[0] for line in lines
+                 if line.strip() and not line.startswith('#')]
+        return [(cert, self.hash(cert)) for cert in certs]
+
+    def render(self):
+        lines = []
+        for cert in self.certs:
+            lines.append('# sha1 %s\n' % self.hash(cert))
+            lines.append(' '.join([cert] + self.sni_filters[cert]) + '\n')
+        return ''.join(lines)
+
+    def write(self):
+        """Writes the crt-list if it changed, returning whether it did."""
+        return write_if_changed(self.path, self.render())
+
+
+class SharedFrontends(object):
+    """Frontends which TCP services bound to the same address share,
+    rather than each having its own, with connections routed to the
+    services' backends by the port they were made to.
+
+    HAProxy still listens on each service port, but with thousands of
+    services there are far fewer proxies to parse, check and set up, and
+    so to reload. Services with a virtual host, an SSL certificate or
+    bind options, or which override `HAPROXY_{n}_FRONTEND_HEAD` or
+    `HAPROXY_{n}_FRONTEND_BACKEND_GLUE`, keep their own frontends. So do
+    all services when `HAPROXY_FRONTEND_HEAD` or
+    `HAPROXY_FRONTEND_BACKEND_GLUE` is overridden globally, as the shared
+    frontends are made from their own templates.
+    """
+
+    # The templates the frontend of a service is made from
+    FRONTEND_TEMPLATES = frozenset(['FRONTEND_HEAD', 'FRONTEND_BACKEND_GLUE'])
+
+    # HAProxy limits config lines to 2048 characters
+    BINDS_PER_LINE = 32
+
+    def __init__(self):
+        # (bindAddr, mode) -> [(servicePort, backend)]
+        self.frontends = dict()
+        # The templater generation last warned about global overrides in
+        self.__warned = None
+
+    def reset(self):
+        self.frontends = dict()
+
+    def global_overrides(self, templater):
+        """Returns the frontend templates overridden for all services."""
+        overridden = sorted(
+            name for name in self.FRONTEND_TEMPLATES
+            if templater.t[name].value != templater.t[name].default_value)
+        if overridden and self.__warned != (templater, templater.generation):
+            logger.warning(
+                "not sharing frontends, as %s %s overridden",
+                ' and '.join('HAPROXY_' + name for name in overridden),
+                'is' if len(overridden) == 1 else 'are')
+            self.__warned = (templater, templater.generation)
+        return overridden
+
+    def add(self, templater, app, backend):
+        """Adds a service to the frontend for its address, returning whether
+        it can share one."""
+        if app.mode != 'tcp' or app.sslCert or app.bindOptions:
+            return False
+        if self.global_overrides(templater):
+            return False
+        if any(name in self.FRONTEND_TEMPLATES
+               for name, value in templater.profile(app).overrides):
+            return False
+        self.frontends.setdefault((app.bindAddr, app.mode), []).append(
+            (app.servicePort, backend))
+        return True
+
+    @staticmethod
+    def frontend_name(bind_addr, mode):
+        if bind_addr == '*':
+            return 'marathon_shared_' + mode
+        return 'marathon_shared_%s_%s' % (
+            mode, re.sub(r'[^a-zA-Z0-9]', '_', bind_addr))
+
+    @staticmethod
+    def port_ranges(ports):
+        """Returns sorted, distinct ports as 'port' and 'first-last'
+        ranges of consecutive ports."""
+        ranges = []
+        for port in sorted(set(ports)):
+            if ranges and ranges[-1][1] == port - 1:
+                ranges[-1][1] = port
+            else:
+                ranges.append([port, port])
+        return [str(first) if first == last else '%d-%d' % (first, last)
+                for first, last in ranges]
+
+    def render(self, templater):
+        frontends = str()
+        for bind_addr, mode in sorted(self.frontends):
+            services = sorted(self.frontends[(bind_addr, mode)])
+            frontends += templater.haproxy_shared_frontend_head.format(
+                frontend=self.frontend_name(bind_addr, mode),
+                bindAddr=bind_addr,
+                mode=mode)
+            binds = [bind_addr + ':' + ports for ports in
+                     self.port_ranges(port for port, _ in services)]
+            for i in range(0, len(binds), self.BINDS_PER_LINE):
+                frontends += templater.haproxy_shared_frontend_bind.format(
+                    binds=','.join(binds[i:i + self.BINDS_PER_LINE]))
+            glue = templater.haproxy_shared_frontend_backend_glue
+            for port, backend in services:
+                frontends += glue.format(backend=backend, servicePort=port)
+        return frontends
+
+
+def write_if_changed(filename, content):
+    """Atomically replaces a file if its content differs, returning
+    whether it did."""
+    try:
+        with open(filename) as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+    logger.info("writing %s", filename)
+    fd, tmp = mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.chmod(tmp, 0o644)
+    move(tmp, filename)
+    return True
+
+
 def get_haproxy_pids():
     try:
         return subprocess.check_output(
@@ -464,7 +1044,72 @@ def get_haproxy_pids():
         return ''
 
 
+def get_server_state_file(config):
+    """Returns the file which `load-server-state-from-file global` has
+    HAProxy load the server state from, or None if the config doesn't
+    load it from a global file."""
+    settings = dict()
+    for line in config.splitlines():
+        words = line.split()
+        if len(words) == 2 and words[0] in ('server-state-base',
+                                            'server-state-file',
+                                            'load-server-state-from-file'):
+            settings[words[0]] = words[1]
+    if settings.get('load-server-state-from-file') != 'global' or \
+            'server-state-file' not in settings:
+        return None
+    return os.path.join(settings.get('server-state-base', ''),
+                        settings['server-state-file'])
+
+
+def reload_haproxy_master(master, haproxy_socket=None, state_file=None):
+    """Reloads HAProxy through its master CLI, returning whether the new
+    workers started. Logs how many old workers are left serving
+    connections from before, and the memory they hold.
+
+    If `state_file` is set, the server state is saved to it through
+    `haproxy_socket` first, as service/haproxy/run does for the other
+    reloads, so the new workers keep the servers' health and admin
+    states."""
+    if haproxy_socket is not None and state_file is not None:
+        try:
+            haproxy_socket.save_servers_state(state_file)
+        except (IOError, OSError) as e:
+            logger.warning("couldn't save the server state to %s: %s",
+                           state_file, e)
+    logger.info("reloading through the master socket %s", master.path)
+    start_time = time.time()
+    try:
+        processes = master.reload()
+    except (IOError, OSError) as e:
+        logger.error("unable to reload through the master socket: %s", e)
+        return False
+    if processes is None:
+        return False
+    workers = [p['pid'] for p in processes
+               if p['type'] == 'worker' and not p['old']]
+    old_workers = [p['pid'] for p in processes
+                   if p['type'] == 'worker' and p['old']]
+    old_rss = sum(process_rss(pid) or 0 for pid in old_workers)
+    logger.info("reload finished, took %.3f seconds: workers %s, "
+                "%d old workers using %.1fMB", time.time() - start_time,
+                " ".join(map(str, workers)), len(old_workers),
+                old_rss / 1048576.0)
+    return True
+
+
 def reloadConfig():
+    if args.haproxy_master_socket:
+        try:
+            with open(args.haproxy_config) as f:
+                state_file = get_server_state_file(f.read())
+        except IOError:
+            state_file = None
+        reload_haproxy_master(HAProxyMaster(args.haproxy_master_socket),
+                              HAProxySocket(args.haproxy_socket),
+                              state_file)
+        return
+
     reloadCommand = []
     if args.command:
         reloadCommand = shlex.split(args.command)
@@ -691,6 +1336,15 @@ def generateHttpVhostAcl(templater, app, backend):
     return (staging_http_frontends, staging_https_frontends)
 
 
+def write_config_hash(config, config_file):
+    """Writes the config's hash, and its length, to <config_file>.hash,
+    where getconfig.lua reads its ETag from when HAProxy starts, rather than
+    hashing the config itself."""
+    data = config.encode('utf-8')
+    write_if_changed(config_file + '.hash', '%s %d\n' % (
+        hashlib.sha1(data).hexdigest(), len(data)))
+
+
 def writeConfigAndValidate(config, config_file):
     # Test run, print to stdout and exit
     if args.dry:
@@ -715,6 +1369,7 @@ def writeConfigAndValidate(config, config_file):
         logger.debug("skipping validation. moving temp file %s to %s",
                      haproxyTempConfigFile,
                      config_file)
+        write_config_hash(config, config_file)
         move(haproxyTempConfigFile, config_file)
         return True
 
@@ -727,6 +1382,7 @@ def writeConfigAndValidate(config, config_file):
         logger.debug("moving temp file %s to %s",
                      haproxyTempConfigFile,
                      config_file)
+        write_config_hash(config, config_file)
         move(haproxyTempConfigFile, config_file)
         return True
     else:
@@ -734,7 +1390,8 @@ def writeConfigAndValidate(config, config_file):
         return False
 
 
-def compareWriteAndReloadConfig(config, config_file):
+def compareWriteAndReloadConfig(config, config_file, force_reload=False,
+                                haproxy_socket=None):
     # See if the last config on disk matches this, and if so don't reload
     # haproxy
     runningConfig = str()
@@ -746,12 +1403,26 @@ def compareWriteAndReloadConfig(config, config_file):
         logger.warning("couldn't open config file for reading")
 
     if runningConfig != config:
+        if haproxy_socket and not force_reload and \
+                get_slot_changes(runningConfig, config) is not None:
+            logger.info("running config only differs in server slots - "
+                        "updating at runtime")
+            if not writeConfigAndValidate(config, config_file):
+                logger.warning("skipping update: config not valid")
+            elif not apply_runtime_changes(runningConfig, config,
+                                           haproxy_socket):
+                logger.warning("runtime update failed - reloading")
+                reloadConfig()
+            return
         logger.info(
             "running config is different from generated config - reloading")
         if writeConfigAndValidate(config, config_file):
             reloadConfig()
         else:
             logger.warning("skipping reload: config not valid")
+    elif force_reload:
+        logger.info("running config is unchanged, but reloading anyway")
+        reloadConfig()
 
 
 def get_health_check(app, portIndex):
@@ -763,51 +1434,470 @@ def get_health_check(app, portIndex):
     return None
 
 
-def get_apps(marathon):
+def get_app_version(app):
+    """Returns the version of an app's definition, or None if unknown.
+
+    Marathon bumps `version` on every change, including scaling, whereas
+    `versionInfo.lastConfigChangeAt` only changes along with the labels,
+    ports and health checks we derive the services from.
+    """
+    version_info = app.get('versionInfo', {})
+    return version_info.get('lastConfigChangeAt', app.get('version'))
+
+
+class MarathonAppDefinition(object):
+    """The parts of an app's model which only depend on its definition
+    (labels, ports and health checks), rather than on its tasks."""
+
+    def __init__(self, app, version):
+        self.version = version
+        labels = app['labels']
+
+        self.appId = app['id']
+        self.deployment_group = None
+        self.__started_at_label = labels.get('HAPROXY_DEPLOYMENT_STARTED_AT')
+        self.__started_at = None
+        if 'HAPROXY_DEPLOYMENT_GROUP' in labels:
+            self.deployment_group = labels['HAPROXY_DEPLOYMENT_GROUP']
+            # the app id is mutated to match the deployment group
+            if self.deployment_group[0] != '/':
+                self.deployment_group = '/' + self.deployment_group
+            self.appId = self.deployment_group
+
+        self.groups = frozenset()
+        if 'HAPROXY_GROUP' in labels:
+            self.groups = labels['HAPROXY_GROUP'].split(',')
+
+        # (servicePort, service, groups) for each of the app's ports, where
+        # groups is HAPROXY_{n}_GROUP, or HAPROXY_GROUP if that isn't set
+        self.__services = []
+        self.all_groups = frozenset()
+        service_labels = get_service_port_labels(labels)
+        for i, servicePort in enumerate(app['ports']):
+            service = MarathonService(
+                        self.appId, servicePort, get_health_check(app, i))
+            for key_unformatted, func, value in service_labels.get(i, []):
+                func(service, key_unformatted, value)
+            service_groups = frozenset(service.haproxy_groups or self.groups)
+            self.all_groups |= service_groups
+            self.__services.append((servicePort, service, service_groups))
+
+    @property
+    def deployment_started_at(self):
+        # TODO(brenden): do something more intelligent when the label is
+        # missing.
+        if self.__started_at_label is None:
+            return ''
+        if self.__started_at is None:
+            # Only needed for deployment groups, and slow to import
+            import dateutil.parser
+            self.__started_at = dateutil.parser.parse(self.__started_at_label)
+        return self.__started_at
+
+    def has_group(self, groups):
+        """Whether any of the app's services belong to one of `groups`."""
+        return has_group(groups, self.all_groups)
+
+    def services(self, groups=None):
+        """Returns a fresh list of (servicePort, service) tuples, with
+        services that don't have any backends yet, in the order of the
+        app's ports. If `groups` is set, only the services belonging to
+        one of them are returned."""
+        return [(servicePort, prototype.clone())
+                for servicePort, prototype, service_groups in self.__services
+                if groups is None or has_group(groups, service_groups)]
+
+
+class AppDefinitionCache(object):
+    """Memoizes MarathonAppDefinitions across calls to get_apps, keyed by
+    app id and definition version, so that only the tasks of unchanged
+    apps need to be processed again."""
+
+    def __init__(self):
+        # appId -> MarathonAppDefinition
+        self.__definitions = dict()
+        self.__seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, app):
+        appId = app['id']
+        version = get_app_version(app)
+        self.__seen.add(appId)
+
+        definition = self.__definitions.get(appId)
+        if definition is not None and version is not None and \
+                definition.version == version:
+            self.hits += 1
+            return definition
+
+        self.misses += 1
+        definition = MarathonAppDefinition(app, version)
+        if version is not None:
+            self.__definitions[appId] = definition
+        else:
+            self.__definitions.pop(appId, None)
+        return definition
+
+    def evict_unseen(self):
+        """Drops the definitions of apps which weren't looked up since the
+        last call, i.e. apps which have been deleted."""
+        evicted = set(self.__definitions) - self.__seen
+        for appId in evicted:
+            del self.__definitions[appId]
+        logger.debug("app definition cache: %d hits, %d misses, %d evicted",
+                     self.hits, self.misses, len(evicted))
+        self.__seen = set()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.__definitions)
+
+
+def get_change_probe(marathon):
+    """Returns a fingerprint of the tasks (with their health) and the
+    deployments in progress. /v2/tasks is much smaller than the apps with
+    their tasks embedded, and changing an app's definition starts new
+    tasks, so this changes whenever the generated config could, except
+    for apps without any tasks."""
+    digest = hashlib.sha1()
+    for task in sorted(marathon.tasks(), key=lambda task: task['id']):
+        digest.update(json.dumps([
+            task['id'],
+            task.get('appId'),
+            task.get('host'),
+            task.get('ports'),
+            task.get('version'),
+            [r.get('alive') for r in task.get('healthCheckResults', [])]
+        ]).encode('utf-8'))
+    deployments = sorted(d['id'] for d in marathon.deployments())
+    digest.update(json.dumps(deployments).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class MarathonAppsCache(object):
+    """Persists the last apps snapshot fetched from Marathon, along with the
+    change probe (see get_change_probe) at the time, a hash of everything
+    else the config depends on, and a hash of the config written.
+
+    poll_marathon uses it to skip downloading the apps, and building and
+    rendering the model, when nothing has changed since the last poll. A
+    full refresh is still done once the snapshot is older than `max_age`
+    seconds, to pick up changes the probe can't see."""
+
+    def __init__(self, path, max_age=300):
+        self.path = path
+        self.max_age = max_age
+        self.probe = None
+        self.inputs = None
+        self.config_hash = None
+        self.fetched_at = 0
+        self.apps = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.info("not using the apps cache %s: %s", self.path, e)
+            return False
+        self.probe = cached.get('probe')
+        self.inputs = cached.get('inputs')
+        self.config_hash = cached.get('config_hash')
+        self.fetched_at = cached.get('fetched_at', 0)
+        self.apps = cached.get('apps')
+        return True
+
+    def save(self):
+        fd, tmp = mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'probe': self.probe,
+                'inputs': self.inputs,
+                'config_hash': self.config_hash,
+                'fetched_at': self.fetched_at,
+                'apps': self.apps
+            }, f)
+        move(tmp, self.path)
+
+    def expired(self):
+        return time.time() - self.fetched_at > self.max_age
+
+
+class ModelSnapshot(object):
+    """Persists the last model built from Marathon: the services and their
+    backends, the IPs their hosts resolved to, and a hash of the config
+    and other files rendered from them (see hash_outputs).
+
+    restore_model_snapshot() loads it on startup, so a restart can go on
+    with the config it had (or render it right away) instead of waiting
+    for the apps to be fetched and the model built again."""
+
+    def __init__(self, path):
+        self.path = path
+        self.config_hash = None
+        self.saved_at = 0
+        self.apps = None
+        self.ips = dict()
+
+    def load(self):
+        try:
+            with gzip.open(self.path, 'rb') as f:
+                snapshot = json.loads(f.read().decode('utf-8'))
+            self.apps = [self.service_from_dict(service)
+                         for service in snapshot['services']]
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            logger.info("not using the model snapshot %s: %s", self.path, e)
+            return False
+        self.config_hash = snapshot.get('config_hash')
+        self.saved_at = snapshot.get('saved_at', 0)
+        self.ips = snapshot.get('ips', dict())
+        return True
+
+    def save(self, apps, config_hash):
+        """Saves `apps` unless the config rendered from them is the one
+        last saved. Returns whether it did."""
+        if config_hash == self.config_hash:
+            return False
+        hosts = set(backend.host for app in apps for backend in app.backends)
+        self.config_hash = config_hash
+        self.saved_at = time.time()
+        self.apps = apps
+        self.ips = dict((host, ip) for host, ip in ip_cache.items()
+                        if host in hosts)
+        data = json.dumps({
+            'config_hash': self.config_hash,
+            'saved_at': self.saved_at,
+            'ips': self.ips,
+            'services': [self.service_to_dict(app) for app in apps]
+        }, separators=(',', ':'), sort_keys=True)
+        fd, tmp = mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        os.close(fd)
+        with gzip.open(tmp, 'wb') as f:
+            f.write(data.encode('utf-8'))
+        move(tmp, self.path)
+        return True
+
+    @staticmethod
+    def service_to_dict(service):
+        fields = dict((name, value)
+                      for name, value in service.__dict__.items()
+                      if name not in ('backends', 'template_profile'))
+        fields['groups'] = sorted(service.groups)
+        fields['haproxy_groups'] = sorted(service.haproxy_groups)
+        fields['backends'] = sorted([backend.host, backend.port,
+                                     backend.draining]
+                                    for backend in service.backends)
+        return fields
+
+    @staticmethod
+    def service_from_dict(fields):
+        service = MarathonService.__new__(MarathonService)
+        service.__dict__.update(fields)
+        service.groups = frozenset(fields['groups'])
+        service.haproxy_groups = frozenset(fields['haproxy_groups'])
+        service.template_profile = None
+        service.backends = set()
+        for host, port, draining in fields['backends']:
+            service.add_backend(host, port, draining)
+        return service
+
+
+class SnapshotMarathon(object):
+    """Serves apps from a snapshot in place of Marathon, for get_apps."""
+
+    def __init__(self, marathon, apps):
+        self.__marathon = marathon
+        self.__apps = apps
+
+    def list(self):
+        return self.__apps
+
+    def health_check(self):
+        return self.__marathon.health_check()
+
+
+def hash_file(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def hash_outputs(config_file, routing_maps=None, cert_list=None):
+    """Returns a hash of the config file, and of the map files and
+    crt-list written along with it, if there are any."""
+    files = [config_file]
+    if routing_maps is not None:
+        files += [routing_maps.path(name)
+                  for name in (RoutingMaps.HOST_MAP, RoutingMaps.PATH_MAP)]
+    if cert_list is not None:
+        files.append(cert_list.path)
+    return hashlib.sha1(json.dumps(
+        [hash_file(name) for name in files]).encode('utf-8')).hexdigest()
+
+
+def restore_model_snapshot(snapshot, config_file, groups, bind_http_https,
+                           ssl_certs, server_slots=None, haproxy_socket=None,
+                           routing_maps=None, cert_list=None,
+                           shared_frontends=None, old_workers=None):
+    """Loads the model snapshot on startup, returning whether it did. If
+    the config (or the files written along with it) isn't the one last
+    rendered from the snapshot, it's rendered again right away, rather
+    than once the apps have been fetched from Marathon."""
+    if not snapshot.load():
+        return False
+    logger.info("restored %d services from the model snapshot saved "
+                "%.0fs ago", len(snapshot.apps),
+                time.time() - snapshot.saved_at)
+    ip_cache.update(snapshot.ips)
+    if hash_outputs(config_file, routing_maps, cert_list) == \
+            snapshot.config_hash:
+        return True
+    logger.info("the config doesn't match the model snapshot, rendering "
+                "it from the snapshot")
+    try:
+        regenerate_config(snapshot.apps, config_file, groups,
+                          bind_http_https, ssl_certs, ConfigTemplater(),
+                          server_slots=server_slots,
+                          haproxy_socket=haproxy_socket,
+                          routing_maps=routing_maps,
+                          cert_list=cert_list,
+                          shared_frontends=shared_frontends,
+                          old_workers=old_workers)
+    except Exception:
+        logger.exception("Rendering the model snapshot failed")
+    return True
+
+
+def get_config_inputs(groups, bind_http_https, ssl_certs, templater,
+                      health_check, server_slots=None, routing_maps=None,
+                      cert_list=None, shared_frontends=None,
+                      old_workers=None):
+    """Returns a hash of everything, other than the apps, which the
+    generated config depends on, including the files written alongside
+    it: the map files, and the certificates in the crt-list."""
+    templates = sorted((name, template.value)
+                       for name, template in templater.t.items())
+    features = [
+        server_slots.size if server_slots else None,
+        [routing_maps.directory] +
+        [hash_file(routing_maps.path(name))
+         for name in (RoutingMaps.HOST_MAP, RoutingMaps.PATH_MAP)]
+        if routing_maps else None,
+        [cert_list.path, cert_list.listed_hashes()] if cert_list else None,
+        shared_frontends is not None,
+        [old_workers.max_old_workers, old_workers.max_age]
+        if old_workers else None
+    ]
+    return hashlib.sha1(json.dumps([
+        sorted(groups), bind_http_https, ssl_certs, health_check, templates,
+        features
+    ]).encode('utf-8')).hexdigest()
+
+
+def poll_marathon(marathon, apps_cache, config_file, groups,
+                  bind_http_https, ssl_certs, templater, app_cache=None,
+                  timings=None, **kwargs):
+    """Regenerates the config, unless the apps cache shows that neither
+    Marathon nor the config's other inputs have changed since the config
+    was last written. If only the other inputs have, the config is
+    rendered from the cached snapshot without fetching the apps. Returns
+    what was done: 'skipped', 'rendered' or 'fetched'.
+
+    If `timings` is given, the seconds spent probing, fetching and
+    regenerating are added to it."""
+    if timings is None:
+        timings = dict()
+    inputs = get_config_inputs(groups, bind_http_https, ssl_certs,
+                               templater, marathon.health_check(),
+                               kwargs.get('server_slots'),
+                               kwargs.get('routing_maps'),
+                               kwargs.get('cert_list'),
+                               kwargs.get('shared_frontends'),
+                               kwargs.get('old_workers'))
+    if apps_cache.apps is None:
+        apps_cache.load()
+    start = time.time()
+    probe = get_change_probe(marathon)
+    timings['probe'] = time.time() - start
+    unchanged = apps_cache.apps is not None and \
+        probe == apps_cache.probe and not apps_cache.expired()
+
+    if unchanged and inputs == apps_cache.inputs and \
+            hash_file(config_file) == apps_cache.config_hash:
+        logger.info("Marathon is unchanged since the last poll, skipping")
+        return 'skipped'
+
+    if unchanged:
+        logger.info("Marathon is unchanged since the last poll, "
+                    "rendering from the cached apps")
+        # get_apps modifies the apps it's given
+        raw_apps = json.loads(json.dumps(apps_cache.apps))
+        result = 'rendered'
+    else:
+        start = time.time()
+        raw_apps = marathon.list()
+        timings['fetch'] = time.time() - start
+        apps_cache.apps = json.loads(json.dumps(raw_apps))
+        apps_cache.probe = probe
+        apps_cache.fetched_at = time.time()
+        result = 'fetched'
+
+    start = time.time()
+    apps = get_apps(SnapshotMarathon(marathon, raw_apps), app_cache, groups)
+    regenerate_config(apps, config_file, groups, bind_http_https,
+                      ssl_certs, templater, **kwargs)
+    timings['regenerate'] = time.time() - start
+    apps_cache.inputs = inputs
+    apps_cache.config_hash = hash_file(config_file)
+    apps_cache.save()
+    return result
+
+
+def get_apps(marathon, app_cache=None, groups=None):
+    """Builds the MarathonServices of all apps running in Marathon.
+
+    If `groups` is set, only services belonging to one of those HAProxy
+    groups are modelled; other apps are skipped before their tasks are
+    processed.
+    """
     apps = marathon.list()
     logger.debug("got apps %s", [app["id"] for app in apps])
 
+    if app_cache is None:
+        app_cache = AppDefinitionCache()
+    if groups is not None:
+        groups = frozenset(groups)
+
     marathon_apps = []
     # This process requires 2 passes: the first is to gather apps belonging
     # to a deployment group.
     processed_apps = []
     deployment_groups = {}
     for app in apps:
-        deployment_group = None
-        if 'HAPROXY_DEPLOYMENT_GROUP' in app['labels']:
-            deployment_group = app['labels']['HAPROXY_DEPLOYMENT_GROUP']
-            # mutate the app id to match deployment group
-            if deployment_group[0] != '/':
-                deployment_group = '/' + deployment_group
-            app['id'] = deployment_group
-        else:
-            processed_apps.append(app)
+        definition = app_cache.get(app)
+        deployment_group = definition.deployment_group
+        if deployment_group is None:
+            processed_apps.append((app, definition))
             continue
+        app['id'] = deployment_group
         if deployment_group in deployment_groups:
             # merge the groups, with the oldest taking precedence
-            prev = deployment_groups[deployment_group]
-            cur = app
-
-            # TODO(brenden): do something more intelligent when the label is
-            # missing.
-            if 'HAPROXY_DEPLOYMENT_STARTED_AT' in prev['labels']:
-                prev_date = dateutil.parser.parse(
-                    prev['labels']['HAPROXY_DEPLOYMENT_STARTED_AT'])
-            else:
-                prev_date = ''
-            if 'HAPROXY_DEPLOYMENT_STARTED_AT' in cur['labels']:
-                cur_date = dateutil.parser.parse(
-                    cur['labels']['HAPROXY_DEPLOYMENT_STARTED_AT'])
-            else:
-                cur_date = ''
+            prev, prev_definition = deployment_groups[deployment_group]
+            cur, cur_definition = app, definition
+
+            prev_date = prev_definition.deployment_started_at
+            cur_date = cur_definition.deployment_started_at
 
             old = new = None
             if prev_date < cur_date:
-                old = prev
+                old, old_definition = prev, prev_definition
                 new = cur
             else:
                 new = prev
-                old = cur
+                old, old_definition = cur, cur_definition
 
             target_instances = \
                 int(new['labels']['HAPROXY_DEPLOYMENT_TARGET_INSTANCES'])
@@ -846,38 +1936,27 @@ def get_apps(marathon):
             old_tasks.extend(new['tasks'])
             merged['tasks'] = old_tasks
 
-            deployment_groups[deployment_group] = merged
+            deployment_groups[deployment_group] = (merged, old_definition)
         else:
-            deployment_groups[deployment_group] = app
+            deployment_groups[deployment_group] = (app, definition)
 
     processed_apps.extend(deployment_groups.values())
+    app_cache.evict_unseen()
 
-    for app in processed_apps:
+    for app, definition in processed_apps:
         appId = app['id']
         if appId[1:] == os.environ.get("FRAMEWORK_NAME"):
             continue
 
-        marathon_app = MarathonApp(marathon, appId, app)
+        if groups is not None and not definition.has_group(groups):
+            continue
 
-        if 'HAPROXY_GROUP' in marathon_app.app['labels']:
-            marathon_app.groups = \
-                marathon_app.app['labels']['HAPROXY_GROUP'].split(',')
+        marathon_app = MarathonApp(marathon, appId, app)
+        marathon_app.groups = definition.groups
         marathon_apps.append(marathon_app)
 
         service_ports = app['ports']
-        for i in range(len(service_ports)):
-            servicePort = service_ports[i]
-            service = MarathonService(
-                        appId, servicePort, get_health_check(app, i))
-
-            for key_unformatted in label_keys:
-                key = key_unformatted.format(i)
-                if key in marathon_app.app['labels']:
-                    func = label_keys[key_unformatted]
-                    func(service,
-                         key_unformatted,
-                         marathon_app.app['labels'][key])
-
+        for servicePort, service in definition.services(groups):
             marathon_app.services[servicePort] = service
 
         for task in app['tasks']:
@@ -926,31 +2005,116 @@ def get_apps(marathon):
     return apps_list
 
 
+def update_routing_maps(routing_maps, generated_config, config_file,
+                        haproxy_socket=None):
+    """Writes the routing maps, returning whether HAProxy needs reloading
+    to pick them up. HAProxy reads map files when its processes start,
+    but if the config itself is unchanged (or only its server slots
+    changed), the changes are applied to the running processes through
+    the stats socket instead where they can be."""
+    changes = routing_maps.get_changes()
+    if not routing_maps.write():
+        return False
+    if haproxy_socket is None or changes is None:
+        return True
+    try:
+        with open(config_file) as f:
+            if get_slot_changes(f.read(), generated_config) is None:
+                # Reloading for the config picks up the maps too
+                return True
+    except IOError:
+        return True
+    try:
+        if routing_maps.apply_changes(changes, haproxy_socket):
+            logger.info("updated %d map entries at runtime", len(changes))
+            return False
+    except (IOError, OSError) as e:
+        logger.warning("couldn't update the maps at runtime: %s", e)
+    logger.warning("runtime map update failed - reloading")
+    return True
+
+
 def regenerate_config(apps, config_file, groups, bind_http_https,
-                      ssl_certs, templater):
-    compareWriteAndReloadConfig(config(apps, groups, bind_http_https,
-                                ssl_certs, templater), config_file)
+                      ssl_certs, templater, force_reload=False,
+                      server_slots=None, haproxy_socket=None,
+                      routing_maps=None, cert_list=None,
+                      shared_frontends=None, old_workers=None):
+    if server_slots:
+        try:
+            with open(config_file) as f:
+                server_slots.load(f.read())
+        except IOError:
+            pass
+    generated_config = config(apps, groups, bind_http_https, ssl_certs,
+                              templater, server_slots, routing_maps,
+                              cert_list, shared_frontends, old_workers)
+    if routing_maps is not None and not args.dry and \
+            update_routing_maps(routing_maps, generated_config, config_file,
+                                haproxy_socket):
+        force_reload = True
+    # HAProxy 2.0 can't change certificates at runtime (`set ssl cert`
+    # came in 2.1), so a change to them needs a reload
+    if cert_list is not None and bind_http_https and not args.dry and \
+            cert_list.write():
+        force_reload = True
+    compareWriteAndReloadConfig(generated_config,
+                                config_file, force_reload,
+                                haproxy_socket if server_slots else None)
 
 
 class MarathonEventProcessor(object):
 
     def __init__(self, marathon, config_file, groups,
-                 bind_http_https, ssl_certs):
+                 bind_http_https, ssl_certs, reconciler=None,
+                 server_slots=None, haproxy_socket=None,
+                 watch_templates=False, routing_maps=None, cert_list=None,
+                 shared_frontends=None, old_workers=None,
+                 model_snapshot=None):
         self.__marathon = marathon
         # appId -> MarathonApp
         self.__apps = dict()
         self.__config_file = config_file
         self.__groups = groups
         self.__templater = ConfigTemplater()
+        self.__app_cache = AppDefinitionCache()
         self.__bind_http_https = bind_http_https
         self.__ssl_certs = ssl_certs
+        self.__server_slots = server_slots
+        self.__haproxy_socket = haproxy_socket
+        self.__routing_maps = routing_maps
+        self.__cert_list = cert_list
+        self.__shared_frontends = shared_frontends
+        self.__old_workers = old_workers
+        self.__model_snapshot = model_snapshot
 
         self.__condition = threading.Condition()
         self.__thread = threading.Thread(target=self.do_reset)
         self.__pending_reset = False
+        self.__pending_render = False
+        self.__force_reload = False
         self.__stop = False
         self.__thread.start()
 
+        self.__template_watcher = None
+        if watch_templates:
+            # do_reset() holds the condition while it renders
+            self.__template_watcher = TemplateWatcher(
+                self.__templater, lock=self.__condition)
+            self.__template_watcher.start(self.templates_changed)
+
+        # generation -> servers, for the reconciler
+        self.__desired = (0, None)
+        self.__reconciler = reconciler
+        if reconciler:
+            reconciler.start(self.desired_servers, self.force_reload)
+
+        # Go on with the model restored on startup, or saved by a
+        # previous processor, until the apps have been fetched
+        if model_snapshot is not None and model_snapshot.apps is not None:
+            self.__apps = model_snapshot.apps
+            if reconciler:
+                self.update_desired_servers()
+
         # Fetch the base data
         self.reset_from_tasks()
 
@@ -962,22 +2126,47 @@ class MarathonEventProcessor(object):
                 if self.__stop:
                     logger.info('stopping event processor thread')
                     return
-                if not self.__pending_reset:
+                if not self.__pending_reset and not self.__pending_render:
                     if not self.__condition.wait(300):
                         logger.info('condition wait expired')
+                # Only the templates changing doesn't need the apps fetched
+                # again
+                refetch = self.__pending_reset or \
+                    not self.__pending_render or not self.__apps
                 self.__pending_reset = False
+                self.__pending_render = False
+                force_reload = self.__force_reload
+                self.__force_reload = False
                 self.__condition.release()
 
                 try:
                     start_time = time.time()
 
-                    self.__apps = get_apps(self.__marathon)
+                    if refetch:
+                        self.__apps = get_apps(self.__marathon,
+                                               self.__app_cache,
+                                               self.__groups)
                     regenerate_config(self.__apps,
                                       self.__config_file,
                                       self.__groups,
                                       self.__bind_http_https,
                                       self.__ssl_certs,
-                                      self.__templater)
+                                      self.__templater,
+                                      force_reload,
+                                      self.__server_slots,
+                                      self.__haproxy_socket,
+                                      self.__routing_maps,
+                                      self.__cert_list,
+                                      self.__shared_frontends,
+                                      self.__old_workers)
+                    if self.__model_snapshot is not None:
+                        self.__model_snapshot.save(
+                            self.__apps,
+                            hash_outputs(self.__config_file,
+                                         self.__routing_maps,
+                                         self.__cert_list))
+                    if self.__reconciler:
+                        self.update_desired_servers()
 
                     logger.debug("updating tasks finished, took %s seconds",
                                  time.time() - start_time)
@@ -987,7 +2176,34 @@ class MarathonEventProcessor(object):
                 except:
                     logger.exception("Unexpected error!")
 
+    def update_desired_servers(self):
+        servers = get_desired_servers(self.__apps, self.__groups,
+                                      self.__templater, self.__server_slots)
+        generation, current = self.__desired
+        if servers != current:
+            self.__desired = (generation + 1, servers)
+
+    def desired_servers(self):
+        return self.__desired
+
+    def force_reload(self):
+        self.__condition.acquire()
+        self.__force_reload = True
+        self.__pending_reset = True
+        self.__condition.notify()
+        self.__condition.release()
+
+    def templates_changed(self, names):
+        self.__condition.acquire()
+        self.__pending_render = True
+        self.__condition.notify()
+        self.__condition.release()
+
     def stop(self):
+        if self.__reconciler:
+            self.__reconciler.stop()
+        if self.__template_watcher:
+            self.__template_watcher.stop()
         self.__condition.acquire()
         self.__stop = True
         self.__condition.notify()
@@ -1057,24 +2273,119 @@ def get_arg_parser():
                              "for frontend marathon_https_in"
                              "Ex: /etc/ssl/site1.co.pem,/etc/ssl/site2.co.pem",
                         default="/etc/ssl/mesosphere.com.pem")
+    parser.add_argument("--ssl-crt-list",
+                        help="Load the certificates of marathon_https_in "
+                        "from a crt-list written to this file: the "
+                        "--ssl-certs, followed by each HAPROXY_{n}_SSL_CERT "
+                        "of an app with a virtual host, selected by SNI. "
+                        "HAProxy is only reloaded for a certificate when "
+                        "its contents change.")
     parser.add_argument("--skip-validation",
                         help="Skip haproxy config file validation",
                         action="store_true")
     parser.add_argument("--dry", "-d",
                         help="Only print configuration to console",
                         action="store_true")
+    parser.add_argument("--haproxy-socket",
+                        help="Location of the HAProxy stats socket",
+                        default="/var/run/haproxy/socket")
+    parser.add_argument("--haproxy-master-socket",
+                        help="If set, HAProxy runs in master-worker mode, "
+                        "and is reloaded through its master CLI socket at "
+                        "this location instead of with --command")
+    parser.add_argument("--max-old-workers",
+                        help="If set, stop the oldest of the HAProxy "
+                        "processes left behind by reloads, and close their "
+                        "connections, when there are more than this many",
+                        type=int, default=0)
+    parser.add_argument("--old-worker-max-age",
+                        help="If set, close the connections of the HAProxy "
+                        "processes left behind by reloads once they have "
+                        "been draining for this many seconds, with "
+                        "hard-stop-after",
+                        type=int, default=0)
+    parser.add_argument("--reconcile-interval",
+                        help="If set, compare HAProxy's live servers with "
+                        "the generated config every this many seconds, and "
+                        "repair any drift through the stats socket. Only "
+                        "applies to the SSE and callback modes.",
+                        type=float, default=0)
+    parser.add_argument("--haproxy-map",
+                        help="Route virtual hosts with map files, written "
+                        "next to the HAProxy config, instead of with an ACL "
+                        "per virtual host",
+                        action="store_true")
+    parser.add_argument("--shared-frontends",
+                        help="Bind the TCP services on each address in a "
+                        "single frontend, which routes connections by the "
+                        "port they were made to, instead of a frontend per "
+                        "service. Makes reloads quicker with many services.",
+                        action="store_true")
+    parser.add_argument("--watch-templates",
+                        help="Watch the templates directory, and regenerate "
+                        "the config from the apps already fetched when a "
+                        "template override changes. Only applies to the "
+                        "SSE and callback modes, polling picks up changes "
+                        "anyway.",
+                        action="store_true")
+    parser.add_argument("--poll-interval",
+                        help="Instead of generating the config once and "
+                        "exiting, keep running and regenerate it every "
+                        "this many seconds",
+                        type=float, default=0)
+    parser.add_argument("--poll-jitter",
+                        help="Randomly vary the poll interval by up to this "
+                        "fraction of it",
+                        type=float, default=0.1)
+    parser.add_argument("--apps-cache",
+                        help="When polling, keep the last apps snapshot "
+                        "in this file, and skip fetching the apps and "
+                        "regenerating the config when a cheap probe of "
+                        "Marathon's tasks and deployments shows that "
+                        "nothing has changed.")
+    parser.add_argument("--apps-cache-max-age",
+                        help="Fetch the apps anyway once the apps cache is "
+                        "older than this many seconds",
+                        type=float, default=300)
+    parser.add_argument("--model-snapshot",
+                        help="With --sse or --listening, keep the last "
+                        "services, backends and resolved IPs in this "
+                        "file. On startup, they're used until the apps "
+                        "have been fetched from Marathon, and the config "
+                        "is rendered from them if it doesn't match.")
+    parser.add_argument("--server-slots",
+                        help="If set, render each backend with room for a "
+                        "multiple of this many servers, and apply changes "
+                        "to servers and their draining through the stats "
+                        "socket instead of reloading where possible.",
+                        type=int, default=0)
     parser = set_logging_args(parser)
     parser = set_marathon_auth_args(parser)
     return parser
 
 
 def run_server(marathon, listen_addr, callback_url, config_file, groups,
-               bind_http_https, ssl_certs):
+               bind_http_https, ssl_certs, reconciler=None,
+               server_slots=None, haproxy_socket=None, watch_templates=False,
+               routing_maps=None, cert_list=None, shared_frontends=None,
+               old_workers=None, model_snapshot=None):
+    # Only the callback mode needs an HTTP server, which is slow to import
+    from wsgiref.simple_server import make_server
+
     processor = MarathonEventProcessor(marathon,
                                        config_file,
                                        groups,
                                        bind_http_https,
-                                       ssl_certs)
+                                       ssl_certs,
+                                       reconciler,
+                                       server_slots,
+                                       haproxy_socket,
+                                       watch_templates,
+                                       routing_maps,
+                                       cert_list,
+                                       shared_frontends,
+                                       old_workers,
+                                       model_snapshot)
     try:
         marathon.add_subscriber(callback_url)
 
@@ -1097,43 +2408,120 @@ def run_server(marathon, listen_addr, callback_url, config_file, groups,
         processor.stop()
 
 
+def run_poll_loop(marathon, interval, jitter, config_file, groups,
+                  bind_http_https, ssl_certs, apps_cache=None,
+                  server_slots=None, haproxy_socket=None, routing_maps=None,
+                  cert_list=None, shared_frontends=None, old_workers=None,
+                  cycles=None):
+    """Regenerates the config every `interval` seconds (give or take a
+    random `jitter` fraction of it, so that several instances don't poll
+    Marathon in lockstep) from a single process, keeping the templates,
+    app definitions, resolved IPs and connections to Marathon warm between
+    cycles. Template overrides which changed are reloaded at the start of
+    each cycle. Stops after `cycles` cycles, if set."""
+    templater = ConfigTemplater()
+    template_watcher = TemplateWatcher(templater)
+    app_cache = AppDefinitionCache()
+    cycle = 0
+    while cycles is None or cycle < cycles:
+        cycle += 1
+        started = time.time()
+        timings = dict()
+        try:
+            template_watcher.check()
+            if apps_cache is not None:
+                result = poll_marathon(marathon, apps_cache, config_file,
+                                       groups, bind_http_https, ssl_certs,
+                                       templater, app_cache, timings,
+                                       server_slots=server_slots,
+                                       haproxy_socket=haproxy_socket,
+                                       routing_maps=routing_maps,
+                                       cert_list=cert_list,
+                                       shared_frontends=shared_frontends,
+                                       old_workers=old_workers)
+            else:
+                apps = get_apps(marathon, app_cache, groups)
+                timings['fetch'] = time.time() - started
+                regenerate_config(apps, config_file, groups,
+                                  bind_http_https, ssl_certs, templater,
+                                  server_slots=server_slots,
+                                  haproxy_socket=haproxy_socket,
+                                  routing_maps=routing_maps,
+                                  cert_list=cert_list,
+                                  shared_frontends=shared_frontends,
+                                  old_workers=old_workers)
+                timings['regenerate'] = \
+                    time.time() - started - timings['fetch']
+                result = 'fetched'
+        except Exception:
+            logger.exception("Poll cycle %d failed", cycle)
+            result = 'failed'
+        elapsed = time.time() - started
+        logger.info("poll cycle %d %s in %.3fs (%s)", cycle, result, elapsed,
+                    ", ".join("%s %.3fs" % (name, timings[name])
+                              for name in sorted(timings)))
+        if cycles is not None and cycle >= cycles:
+            break
+        delay = interval * (1 + random.uniform(-jitter, jitter))
+        time.sleep(max(0, delay - elapsed))
+
+
 def clear_callbacks(marathon, callback_url):
     logger.info("Cleanup, removing subscription to {0}".format(callback_url))
     marathon.remove_subscriber(callback_url)
 
 
 def process_sse_events(marathon, config_file, groups,
-                       bind_http_https, ssl_certs):
+                       bind_http_https, ssl_certs, reconciler=None,
+                       server_slots=None, haproxy_socket=None,
+                       watch_templates=False, routing_maps=None,
+                       cert_list=None, shared_frontends=None,
+                       old_workers=None, model_snapshot=None):
     processor = MarathonEventProcessor(marathon,
                                        config_file,
                                        groups,
                                        bind_http_https,
-                                       ssl_certs)
+                                       ssl_certs,
+                                       reconciler,
+                                       server_slots,
+                                       haproxy_socket,
+                                       watch_templates,
+                                       routing_maps,
+                                       cert_list,
+                                       shared_frontends,
+                                       old_workers,
+                                       model_snapshot)
     try:
-        events = marathon.get_event_stream()
-        for event in events:
-            try:
-                # logger.info("received event: {0}".format(event))
-                # marathon might also send empty messages as keepalive...
-                if (event.data.strip() != ''):
-                    # marathon sometimes sends more than one json per event
-                    # e.g. {}\r\n{}\r\n\r\n
-                    for real_event_data in re.split(r'\r\n', event.data):
-                        data = json.loads(real_event_data)
-                        logger.info(
-                            "received event of type {0}"
-                            .format(data['eventType']))
-                        processor.handle_event(data)
-                else:
-                    logger.info("skipping empty message")
-            except:
-                print(event.data)
-                print("Unexpected error:", sys.exc_info()[0])
-                raise
+        stream_events(marathon, processor)
     finally:
         processor.stop()
 
 
+def stream_events(marathon, processor):
+    """Hands the events from Marathon's event stream to `processor`, until
+    the stream ends or fails."""
+    events = marathon.get_event_stream()
+    for event in events:
+        try:
+            # logger.info("received event: {0}".format(event))
+            # marathon might also send empty messages as keepalive...
+            if (event.data.strip() != ''):
+                # marathon sometimes sends more than one json per event
+                # e.g. {}\r\n{}\r\n\r\n
+                for real_event_data in re.split(r'\r\n', event.data):
+                    data = json.loads(real_event_data)
+                    logger.info(
+                        "received event of type {0}"
+                        .format(data['eventType']))
+                    processor.handle_event(data)
+            else:
+                logger.info("skipping empty message")
+        except:
+            print(event.data)
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+
+
 if __name__ == '__main__':
     # Process arguments
     arg_parser = get_arg_parser()
@@ -1171,6 +2559,41 @@ if __name__ == '__main__':
                         args.health_check,
                         get_marathon_auth_params(args))
 
+    haproxy_socket = HAProxySocket(args.haproxy_socket)
+    reconciler = None
+    if args.reconcile_interval:
+        reconciler = ServerStateReconciler(haproxy_socket,
+                                           args.reconcile_interval)
+    server_slots = None
+    if args.server_slots:
+        server_slots = ServerSlots(args.server_slots)
+    routing_maps = None
+    if args.haproxy_map:
+        routing_maps = RoutingMaps(
+            os.path.dirname(os.path.abspath(args.haproxy_config)))
+    cert_list = None
+    if args.ssl_crt_list:
+        cert_list = CertList(args.ssl_crt_list)
+    shared_frontends = None
+    if args.shared_frontends:
+        shared_frontends = SharedFrontends()
+    old_workers = None
+    if args.max_old_workers or args.old_worker_max_age:
+        old_workers = OldWorkerReaper(
+            HAProxyMaster(args.haproxy_master_socket)
+            if args.haproxy_master_socket else None,
+            args.max_old_workers, args.old_worker_max_age)
+        if args.listening or args.sse or args.poll_interval:
+            old_workers.start()
+    model_snapshot = None
+    if args.model_snapshot and (args.listening or args.sse):
+        model_snapshot = ModelSnapshot(args.model_snapshot)
+        restore_model_snapshot(model_snapshot, args.haproxy_config,
+                               args.group, not args.dont_bind_http_https,
+                               args.ssl_certs, server_slots, haproxy_socket,
+                               routing_maps, cert_list, shared_frontends,
+                               old_workers)
+
     # If in listening mode, spawn a webserver waiting for events. Otherwise
     # just write the config.
     if args.listening:
@@ -1178,31 +2601,83 @@ if __name__ == '__main__':
         try:
             run_server(marathon, args.listening, callback_url,
                        args.haproxy_config, args.group,
-                       not args.dont_bind_http_https, args.ssl_certs)
+                       not args.dont_bind_http_https, args.ssl_certs,
+                       reconciler, server_slots, haproxy_socket,
+                       args.watch_templates, routing_maps, cert_list,
+                       shared_frontends, old_workers, model_snapshot)
         finally:
             clear_callbacks(marathon, callback_url)
     elif args.sse:
+        # The processor (and its caches) outlives reconnections to the
+        # event stream
+        processor = MarathonEventProcessor(marathon,
+                                           args.haproxy_config,
+                                           args.group,
+                                           not args.dont_bind_http_https,
+                                           args.ssl_certs,
+                                           reconciler,
+                                           server_slots,
+                                           haproxy_socket,
+                                           args.watch_templates,
+                                           routing_maps,
+                                           cert_list,
+                                           shared_frontends,
+                                           old_workers,
+                                           model_snapshot)
         backoff = 3
-        while True:
-            stream_started = time.time()
-            try:
-                process_sse_events(marathon,
-                                   args.haproxy_config,
-                                   args.group,
-                                   not args.dont_bind_http_https,
-                                   args.ssl_certs)
-            except:
-                logger.exception("Caught exception")
-                backoff = backoff * 1.5
-                if backoff > 300:
-                    backoff = 300
-                logger.error("Reconnecting in {}s...", backoff)
-            # Reset the backoff if it's been more than 10 minutes
-            if time.time() - stream_started > 600:
-                backoff = 3
-            time.sleep(random.random() * backoff)
+        try:
+            while True:
+                stream_started = time.time()
+                try:
+                    stream_events(marathon, processor)
+                except:
+                    logger.exception("Caught exception")
+                    logger.info("Marathon hosts: %s", marathon.host_stats())
+                    backoff = backoff * 1.5
+                    if backoff > 300:
+                        backoff = 300
+                    logger.error("Reconnecting in {}s...", backoff)
+                # Reset the backoff if it's been more than 10 minutes
+                if time.time() - stream_started > 600:
+                    backoff = 3
+                time.sleep(random.random() * backoff)
+                # Catch up with the events missed while disconnected
+                processor.reset_from_tasks()
+        finally:
+            processor.stop()
+    elif args.poll_interval:
+        apps_cache = None
+        if args.apps_cache:
+            apps_cache = MarathonAppsCache(args.apps_cache,
+                                           args.apps_cache_max_age)
+        run_poll_loop(marathon, args.poll_interval, args.poll_jitter,
+                      args.haproxy_config, args.group,
+                      not args.dont_bind_http_https, args.ssl_certs,
+                      apps_cache, server_slots, haproxy_socket,
+                      routing_maps, cert_list, shared_frontends,
+                      old_workers)
+    elif args.apps_cache:
+        poll_marathon(marathon,
+                      MarathonAppsCache(args.apps_cache,
+                                        args.apps_cache_max_age),
+                      args.haproxy_config, args.group,
+                      not args.dont_bind_http_https,
+                      args.ssl_certs, ConfigTemplater(),
+                      server_slots=server_slots,
+                      haproxy_socket=haproxy_socket,
+                      routing_maps=routing_maps,
+                      cert_list=cert_list,
+                      shared_frontends=shared_frontends,
+                      old_workers=old_workers)
     else:
         # Generate base config
-        regenerate_config(get_apps(marathon), args.haproxy_config, args.group,
+        regenerate_config(get_apps(marathon, groups=args.group),
+                          args.haproxy_config, args.group,
                           not args.dont_bind_http_https,
-                          args.ssl_certs, ConfigTemplater())
+                          args.ssl_certs, ConfigTemplater(),
+                          server_slots=server_slots,
+                          haproxy_socket=haproxy_socket,
+                          routing_maps=routing_maps,
+                          cert_list=cert_list,
+                          shared_frontends=shared_frontends,
+                          old_workers=old_workers)
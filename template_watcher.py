@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""Watches the templates directory for changes to the template overrides
+(`HAPROXY_*` files), and reloads the ones which changed into a
+ConfigTemplater.
+
+On Linux, the directory is watched with inotify, so changes are picked up
+as soon as they're made; elsewhere, or if the directory doesn't exist
+yet, it's polled instead.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import threading
+
+logger = logging.getLogger('marathon_lb')
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+
+def inotify_watch(directory):
+    """Returns an inotify file descriptor watching `directory`, or None if
+    inotify isn't available or the directory can't be watched."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        inotify_init = libc.inotify_init
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    fd = inotify_init()
+    if fd < 0:
+        return None
+    if inotify_add_watch(fd, directory.encode('utf-8'), WATCH_MASK) < 0:
+        logger.debug("can't watch %s: %s", directory,
+                     os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+
+def drain(fd):
+    """Reads all the pending events from an inotify file descriptor."""
+    while select.select([fd], [], [], 0)[0]:
+        try:
+            if not os.read(fd, 65536):
+                return
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+class TemplateWatcher(object):
+    """Reloads the template overrides of `templater` which changed.
+
+    check() compares the size and modification time of the overrides with
+    the last time it was called, and reloads those which differ. start()
+    calls it from a thread whenever the directory changes, or every
+    `interval` seconds when it can't be watched, and passes the names of
+    the templates which changed to `on_change`. Events which arrive within
+    `settle` seconds of each other are handled together, so that an editor
+    saving a file, or several files being copied in, results in a single
+    change.
+
+    The templates are reloaded holding `lock`, which whatever renders the
+    config from `templater` on another thread should also hold, so that a
+    render never mixes old and new templates.
+    """
+
+    def __init__(self, templater, interval=5, settle=0.5, lock=None):
+        self.templater = templater
+        self.interval = interval
+        self.settle = settle
+        self.__lock = lock if lock is not None else threading.Lock()
+        self.__files = self.__stat()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __stat(self):
+        files = dict()
+        directory = self.templater.directory
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return files
+        for name in names:
+            if not name.startswith('HAPROXY_'):
+                continue
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            files[name] = (st.st_mtime, st.st_size, st.st_ino)
+        return files
+
+    def check(self):
+        """Reloads the overrides which changed since the last check,
+        returning the names of the templates whose values changed."""
+        files = self.__stat()
+        names = frozenset(name for name in set(files) | set(self.__files)
+                          if files.get(name) != self.__files.get(name))
+        self.__files = files
+        if not names:
+            return []
+        with self.__lock:
+            changed = self.templater.reload_templates(names)
+        if changed:
+            logger.info("templates changed: %s", ", ".join(changed))
+        return changed
+
+    def start(self, on_change):
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run,
+                                         args=(on_change, self.__stop))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def __run(self, on_change, stop):
+        logger.info("watching %s for template changes",
+                    self.templater.directory)
+        fd = None
+        try:
+            while not stop.is_set():
+                if fd is None:
+                    fd = inotify_watch(self.templater.directory)
+                    if fd is None and stop.wait(self.interval):
+                        return
+                    # Otherwise check straight away, for changes made
+                    # before the directory was watched
+                elif select.select([fd], [], [], self.interval)[0]:
+                    if stop.wait(self.settle):
+                        return
+                    drain(fd)
+                try:
+                    changed = self.check()
+                except Exception:
+                    logger.exception("Unexpected error checking templates")
+                    continue
+                if changed:
+                    on_change(changed)
+                if fd is not None and \
+                        not os.path.isdir(self.templater.directory):
+                    # The directory was removed, so watch for it again
+                    os.close(fd)
+                    fd = None
+        finally:
+            if fd is not None:
+                os.close(fd)
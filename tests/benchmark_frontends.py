@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""Benchmarks a config with a frontend per TCP service against one with
+--shared-frontends, for growing numbers of services.
+
+For each number of services and each mode this measures how long
+config() takes, how big the config is and how many frontends it has.
+If an HAProxy binary is available it also measures how long HAProxy
+takes to check the config (`haproxy -c`), to start with it, and to
+reload it (starting a new process with `-sf`, which returns once the new
+process is listening), which is what a reload costs marathon-lb.
+
+The services are bound to consecutive ports from --base-port, on
+127.0.0.1, with three servers each. Starting HAProxy needs a file
+descriptor per port, so run it with a high enough `ulimit -n`:
+
+    python tests/benchmark_frontends.py --services 100,1000,5000 \\
+        --haproxy /usr/local/sbin/haproxy
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(tests_dir))
+
+import marathon_lb  # noqa: E402
+
+# Like the default HAPROXY_HEAD, but without the stats socket and syslog,
+# so HAProxy can run unprivileged
+HEAD = '''\
+global
+  daemon
+  maxconn 50000
+defaults
+  timeout connect 5s
+  timeout client 30s
+  timeout server 30s
+'''
+
+
+def make_services(count, base_port):
+    services = []
+    for i in range(count):
+        service = marathon_lb.MarathonService(
+            '/bench/app%d' % i, base_port + i, None)
+        service.groups = frozenset(['external'])
+        service.bindAddr = '127.0.0.1'
+        for j in range(3):
+            service.add_backend('127.0.0.1', 31000 + (i * 3 + j) % 30000,
+                                False)
+        services.append(service)
+    return services
+
+
+def render(services, shared):
+    templater = marathon_lb.ConfigTemplater()
+    templater.t['HEAD'].value = HEAD
+    shared_frontends = marathon_lb.SharedFrontends() if shared else None
+    start = time.time()
+    config = marathon_lb.config(services, ['external'], False, None,
+                                templater, shared_frontends=shared_frontends)
+    return config, time.time() - start
+
+
+def run_haproxy(haproxy, config_file, pid_file, *args):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([haproxy, '-f', config_file, '-p', pid_file] +
+                              list(args), stdout=devnull)
+    return time.time() - start
+
+
+def read_pids(pid_file):
+    with open(pid_file) as f:
+        return [int(pid) for pid in f.read().split()]
+
+
+def measure_haproxy(haproxy, config, tmpdir):
+    config_file = os.path.join(tmpdir, 'haproxy.cfg')
+    pid_file = os.path.join(tmpdir, 'haproxy.pid')
+    with open(config_file, 'w') as f:
+        f.write(config)
+    timings = dict()
+    timings['check'] = run_haproxy(haproxy, config_file, pid_file, '-c')
+    timings['start'] = run_haproxy(haproxy, config_file, pid_file)
+    old_pids = read_pids(pid_file)
+    try:
+        timings['reload'] = run_haproxy(
+            haproxy, config_file, pid_file,
+            '-sf', *[str(pid) for pid in old_pids])
+    finally:
+        for pid in set(old_pids + read_pids(pid_file)):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    # Let the ports be released before the next run
+    time.sleep(1)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark shared frontends against a frontend per "
+        "service")
+    parser.add_argument("--services", default="100,1000,5000",
+                        help="Comma-separated numbers of services")
+    parser.add_argument("--base-port", type=int, default=20000)
+    parser.add_argument("--haproxy",
+                        help="HAProxy binary to measure checks, starts and "
+                        "reloads with")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print("%8s %-10s %9s %9s %8s %8s %8s %8s" % (
+            "services", "mode", "frontends", "bytes", "config",
+            "check", "start", "reload"))
+        for count in [int(n) for n in args.services.split(',')]:
+            services = make_services(count, args.base_port)
+            for shared in [False, True]:
+                config, elapsed = render(services, shared)
+                timings = dict()
+                if args.haproxy:
+                    timings = measure_haproxy(args.haproxy, config, tmpdir)
+                print("%8d %-10s %9d %9d %7.3fs %8s %8s %8s" % ((
+                    count, "shared" if shared else "per-port",
+                    config.count('\nfrontend '), len(config), elapsed) +
+                    tuple("%.3fs" % timings[name] if name in timings
+                          else "-" for name in ["check", "start", "reload"])))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
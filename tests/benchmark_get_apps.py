@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""Benchmarks get_apps() over a synthetic cluster (see
+cluster_generator.py), both from scratch ("cold") and with an
+AppDefinitionCache carried over from the previous run ("warm"), and then
+config() over the resulting services.
+
+Run from the repository root:
+
+    python tests/benchmark_get_apps.py --apps 5000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import marathon_lb  # noqa: E402
+from cluster_generator import generate_cluster  # noqa: E402
+
+
+class Marathon(object):
+    """Hands out a fresh copy of the apps per call, since get_apps()
+    mutates them. The copies are made up front so that decoding them isn't
+    part of the measurement."""
+    def __init__(self, apps, copies):
+        apps_json = json.dumps(apps)
+        self.copies = [json.loads(apps_json) for _ in range(copies)]
+
+    def list(self):
+        return self.copies.pop()
+
+    def health_check(self):
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark get_apps()")
+    parser.add_argument("--apps", type=int, default=5000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--group", action="append", default=None,
+                        help="Only model apps in these HAProxy groups")
+    args = parser.parse_args()
+
+    apps = generate_cluster(args.apps, args.seed)
+    for name, app_cache in [("cold", None),
+                            ("warm", marathon_lb.AppDefinitionCache())]:
+        marathon = Marathon(apps, args.runs + 1)
+        if app_cache is not None:
+            marathon_lb.get_apps(marathon, app_cache, args.group)
+        timings = []
+        for _ in range(args.runs):
+            start = time.time()
+            services = marathon_lb.get_apps(marathon, app_cache,
+                                            args.group)
+            timings.append(time.time() - start)
+
+        print("get_apps (%s): %d apps, %d services, best %.3fs, "
+              "mean %.3fs over %d runs" % (name, args.apps, len(services),
+                                           min(timings),
+                                           sum(timings) / len(timings),
+                                           args.runs))
+
+    templater = marathon_lb.ConfigTemplater()
+    groups = args.group or ['*']
+    timings = []
+    for _ in range(args.runs):
+        start = time.time()
+        haproxy_config = marathon_lb.config(services, groups, True, None,
+                                            templater)
+        timings.append(time.time() - start)
+    print("config: %d services, %d bytes, best %.3fs, mean %.3fs over "
+          "%d runs" % (len(services), len(haproxy_config), min(timings),
+                       sum(timings) / len(timings), args.runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+"""Measures what HAProxy reloads cost clients, for comparing reload
+strategies.
+
+HAProxy is run locally with a generated config of TCP services, all
+balanced to an upstream (see load_generator.py). While the load
+generator requests the services, HAProxy is reloaded (or updated) up to
+--reload-rate times a second with each strategy in turn:
+
+  * `none`: no reloads, as the baseline
+  * `plain`: `haproxy -D -sf <old pids>`
+  * `iptables`: what service/haproxy/run does - drop SYNs to the ports
+    with iptables, wait 0.1s, save the server state, reload, remove the
+    rules, and wait 1s before the next reload (needs root)
+  * `socket-transfer`: `haproxy -D -x <stats socket> -sf <old pids>`,
+    with `expose-fd listeners` on the stats socket, so the new process
+    takes over the listening sockets (needs HAProxy 1.8 or later)
+  * `runtime`: no reload, but a server state change per backend
+    through the stats socket, as with --server-slots
+  * `command`: the --reload-command shell command, run with the
+    harness's HAProxy in $HAPROXY_CONFIG, $HAPROXY_PIDFILE and
+    $HAPROXY_SOCKET
+
+Each strategy reports the failed requests (by kind), the latency and
+connect time of the ones which succeeded, the latency added over the
+`none` baseline, how many connections took over a second to connect
+(a retransmitted SYN), and how many reloads completed per second.
+Results can be saved and compared with a previous run:
+
+    python tests/benchmark_reload.py --haproxy /usr/local/sbin/haproxy \\
+        --strategies none,plain,iptables --output before.json
+    python tests/benchmark_reload.py --haproxy /usr/local/sbin/haproxy \\
+        --strategies none,plain,iptables --output after.json \\
+        --baseline before.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(tests_dir))
+
+import marathon_lb  # noqa: E402
+from benchmark_replay import compare  # noqa: E402
+from haproxy_runtime import HAProxySocket  # noqa: E402
+from load_generator import LoadGenerator, percentile, summarize  # noqa: E402
+
+STRATEGIES = ['none', 'plain', 'iptables', 'socket-transfer', 'runtime',
+              'command']
+
+HEAD = '''\
+global
+  daemon
+  maxconn 20000
+  stats socket {socket} mode 600 level admin{exposeFd}
+defaults
+  timeout connect 5s
+  timeout client 30s
+  timeout server 30s
+'''
+
+
+def make_services(count, base_port, upstream_port):
+    services = []
+    for i in range(count):
+        service = marathon_lb.MarathonService(
+            '/bench/app%d' % i, base_port + i, None)
+        service.groups = frozenset(['external'])
+        service.bindAddr = '127.0.0.1'
+        service.add_backend('127.0.0.1', upstream_port, False)
+        services.append(service)
+    return services
+
+
+def render(services, socket_path, expose_fd):
+    templater = marathon_lb.ConfigTemplater()
+    templater.t['HEAD'].value = HEAD.format(
+        socket=socket_path,
+        exposeFd=' expose-fd listeners' if expose_fd else '')
+    return marathon_lb.config(services, ['external'], False, None,
+                              templater)
+
+
+class HAProxy(object):
+    """An HAProxy run from a config file, and every process it was run
+    as, so they can all be stopped."""
+
+    def __init__(self, binary, config_file, pid_file, socket_path):
+        self.binary = binary
+        self.config_file = config_file
+        self.pid_file = pid_file
+        self.socket = HAProxySocket(socket_path)
+        self.all_pids = set()
+
+    def pids(self):
+        try:
+            with open(self.pid_file) as f:
+                pids = [int(pid) for pid in f.read().split()]
+        except IOError:
+            return []
+        self.all_pids.update(pids)
+        return pids
+
+    def run(self, *args):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([self.binary, '-f', self.config_file,
+                                   '-p', self.pid_file, '-D'] + list(args),
+                                  stdout=devnull)
+        self.pids()
+
+    def start(self):
+        self.run()
+        deadline = time.time() + 10
+        while not os.path.exists(self.socket.path):
+            if time.time() > deadline:
+                raise Exception("HAProxy didn't create its stats socket")
+            time.sleep(0.1)
+
+    def reload(self, *args):
+        old_pids = [str(pid) for pid in self.pids()]
+        self.run(*(list(args) + ['-sf'] + old_pids))
+
+    def stop(self):
+        for pid in self.all_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for name in [self.pid_file, self.socket.path]:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def iptables(action, ports):
+    for port in ports:
+        subprocess.check_call(['iptables', '-w', action, 'INPUT', '-p', 'tcp',
+                               '--dport', str(port), '--syn', '-j', 'DROP'])
+
+
+def make_reload(strategy, haproxy, services, reload_command):
+    """Returns a function which does one reload with `strategy`."""
+    ports = [service.servicePort for service in services]
+
+    def reload_iptables():
+        iptables('-I', ports)
+        try:
+            time.sleep(0.1)
+            haproxy.socket.command('show servers state')
+            haproxy.reload()
+        finally:
+            iptables('-D', ports)
+        time.sleep(1)
+
+    def update_runtime():
+        for service in services:
+            backend = marathon_lb.get_backend_name(service)
+            for server in service.backends:
+                if not haproxy.socket.set_server_state(
+                        backend, marathon_lb.get_server_name(server),
+                        'ready'):
+                    raise Exception("runtime update failed")
+
+    def run_command():
+        env = dict(os.environ,
+                   HAPROXY_CONFIG=haproxy.config_file,
+                   HAPROXY_PIDFILE=haproxy.pid_file,
+                   HAPROXY_SOCKET=haproxy.socket.path)
+        subprocess.check_call(reload_command, shell=True, env=env)
+        haproxy.pids()
+
+    return {
+        'none': None,
+        'plain': haproxy.reload,
+        'iptables': reload_iptables,
+        'socket-transfer': lambda: haproxy.reload('-x', haproxy.socket.path),
+        'runtime': update_runtime,
+        'command': run_command,
+    }[strategy]
+
+
+class Reloader(object):
+    """Calls `reload` `rate` times a second, or as often as it can if it
+    takes longer than that, recording (start, duration, ok) for each."""
+
+    def __init__(self, reload, rate):
+        self.reload = reload
+        self.rate = rate
+        self.reloads = []
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __run(self):
+        started = time.time()
+        count = 0
+        while not self.__stop.wait(
+                max(0, started + count / self.rate - time.time())):
+            count += 1
+            start = time.time()
+            try:
+                self.reload()
+                ok = True
+            except Exception as e:
+                print("reload failed: %s" % e)
+                ok = False
+            self.reloads.append((start, time.time() - start, ok))
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+        return self.reloads
+
+
+def run_strategy(strategy, args, services, tmpdir):
+    socket_path = os.path.join(tmpdir, 'haproxy.sock')
+    config_file = os.path.join(tmpdir, 'haproxy.cfg')
+    with open(config_file, 'w') as f:
+        f.write(render(services, socket_path,
+                       strategy == 'socket-transfer'))
+    haproxy = HAProxy(args.haproxy, config_file,
+                      os.path.join(tmpdir, 'haproxy.pid'), socket_path)
+    haproxy.start()
+    try:
+        generator = LoadGenerator(
+            [('127.0.0.1', service.servicePort) for service in services],
+            args.concurrency, args.timeout).start()
+        reload = make_reload(strategy, haproxy, services,
+                             args.reload_command)
+        reloader = None
+        if reload is not None:
+            reloader = Reloader(reload, args.reload_rate).start()
+        time.sleep(args.duration)
+        reloads = reloader.stop() if reloader else []
+        results = generator.stop()
+    finally:
+        haproxy.stop()
+    # Let the old processes finish and the ports be released
+    time.sleep(1)
+
+    result = summarize(results, args.duration)
+    durations = [duration for _, duration, ok in reloads if ok]
+    result['reloads'] = {
+        'attempted': len(reloads),
+        'completed': len(durations),
+        'per_second': len(durations) / args.duration,
+        'processes': len(haproxy.all_pids)
+    }
+    if durations:
+        result['reloads']['duration'] = {
+            'p50': percentile(durations, 50),
+            'p99': percentile(durations, 99),
+            'max': max(durations)
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the impact of HAProxy reloads on clients",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--haproxy", default="haproxy",
+                        help="HAProxy binary")
+    parser.add_argument("--strategies", default="none,plain",
+                        help="Comma separated strategies, out of %s"
+                        % ", ".join(STRATEGIES))
+    parser.add_argument("--reload-command",
+                        help="Shell command for the `command` strategy")
+    parser.add_argument("--services", type=int, default=10)
+    parser.add_argument("--base-port", type=int, default=20000)
+    parser.add_argument("--upstream-port", type=int, default=31000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10,
+                        help="Seconds to run each strategy for")
+    parser.add_argument("--reload-rate", type=float, default=2,
+                        help="Reloads per second to attempt")
+    parser.add_argument("--timeout", type=float, default=5,
+                        help="Request timeout, in seconds")
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--baseline",
+                        help="Compare the results against this file")
+    args = parser.parse_args()
+
+    strategies = args.strategies.split(',')
+    for strategy in strategies:
+        if strategy not in STRATEGIES:
+            parser.error("unknown strategy %s" % strategy)
+    if 'command' in strategies and not args.reload_command:
+        parser.error("the command strategy needs --reload-command")
+    if 'iptables' in strategies and os.geteuid() != 0:
+        parser.error("the iptables strategy needs root")
+
+    results = {
+        'created_at': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'haproxy': subprocess.check_output(
+            [args.haproxy, '-v']).decode('utf-8').splitlines()[0],
+        'scenarios': {}
+    }
+
+    services = make_services(args.services, args.base_port,
+                             args.upstream_port)
+    upstream = subprocess.Popen(
+        [sys.executable, os.path.join(tests_dir, 'load_generator.py'),
+         'serve', '--port', str(args.upstream_port)])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        time.sleep(0.5)
+        for strategy in strategies:
+            result = run_strategy(strategy, args, services, tmpdir)
+            results['scenarios'][strategy] = result
+            print("%s: %s" % (strategy, json.dumps(result, sort_keys=True)))
+    finally:
+        upstream.terminate()
+        upstream.wait()
+        shutil.rmtree(tmpdir)
+
+    baseline = results['scenarios'].get('none', {}).get('latency')
+    if baseline:
+        for strategy, result in sorted(results['scenarios'].items()):
+            if 'latency' in result:
+                result['added_latency'] = dict(
+                    (name, result['latency'][name] - baseline[name])
+                    for name in ['p50', 'p99', 'max'])
+                print("%-16s failed %6d  added latency p50 %+.4fs p99 "
+                      "%+.4fs  reloads/s %.2f" % (
+                          strategy, result['failed'],
+                          result['added_latency']['p50'],
+                          result['added_latency']['p99'],
+                          result['reloads']['per_second']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
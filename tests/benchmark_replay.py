@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+"""Replays Marathon app snapshots and SSE events against marathon-lb.
+
+marathon-lb is run in SSE mode in a subprocess, against a stub Marathon
+(see marathon_stub.py). For each scenario this measures:
+
+  * the time from startup until the first config was generated
+  * the latency from an event being sent until the resulting
+    config had been generated and written
+  * how many regenerations per second are done during a storm of events
+  * the CPU time and peak RSS of the marathon-lb process
+
+HAProxy isn't part of the measurement, so reloads are skipped.
+
+By default synthetic clusters of 100, 1k, 10k and 50k tasks are used,
+with an event per iteration that scales a random app up or down. A
+recorded `/v2/apps?embed=apps.tasks` snapshot and SSE stream (as saved
+by e.g. `curl -H 'Accept: text/event-stream' .../v2/events`) can be
+replayed instead. Results are written as JSON, and can be compared with
+a previous run:
+
+    python tests/benchmark_replay.py --output before.json
+    python tests/benchmark_replay.py --output after.json \\
+        --baseline before.json
+"""
+
+from six.moves import queue
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(tests_dir)
+sys.path.insert(0, root_dir)
+
+import marathon_lb  # noqa: E402
+from cluster_generator import generate_cluster  # noqa: E402
+from marathon_stub import MarathonStub  # noqa: E402
+
+# The events which make marathon-lb regenerate its config
+RESET_EVENT_TYPES = frozenset(['status_update_event',
+                               'health_status_changed_event',
+                               'api_post_event'])
+
+
+def emit(message, **kwargs):
+    kwargs['message'] = message
+    sys.stdout.write(json.dumps(kwargs) + "\n")
+    sys.stdout.flush()
+
+
+def run_worker(argv):
+    """Runs marathon-lb in SSE mode, reporting each regeneration (and the
+    resource usage when terminated) as JSON lines on stdout."""
+    args = marathon_lb.get_arg_parser().parse_args(argv)
+    marathon_lb.args = args
+
+    compare_write_and_reload = marathon_lb.compareWriteAndReloadConfig
+
+    def report_regeneration(config, config_file, *args):
+        compare_write_and_reload(config, config_file, *args)
+        emit('regenerated', time=time.time())
+
+    def report_usage(signum, frame):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        emit('usage', cpu_seconds=usage.ru_utime + usage.ru_stime,
+             peak_rss_kb=usage.ru_maxrss)
+        os._exit(0)
+
+    marathon_lb.compareWriteAndReloadConfig = report_regeneration
+    marathon_lb.reloadConfig = lambda: None
+    signal.signal(signal.SIGTERM, report_usage)
+
+    marathon = marathon_lb.Marathon(args.marathon, args.health_check, None)
+    marathon_lb.process_sse_events(marathon,
+                                   args.haproxy_config,
+                                   args.group,
+                                   not args.dont_bind_http_https,
+                                   args.ssl_certs)
+
+
+class Worker(object):
+
+    def __init__(self, marathon_url, config_file):
+        cmd = [sys.executable, os.path.abspath(__file__), 'worker',
+               '--marathon', marathon_url,
+               '--sse',
+               '--group', '*',
+               '--haproxy-config', config_file,
+               '--skip-validation',
+               '--syslog-socket', '/dev/null']
+        self.started_at = time.time()
+        self.process = subprocess.Popen(cmd, cwd=root_dir,
+                                        stdout=subprocess.PIPE,
+                                        stderr=open(os.devnull, 'w'))
+        self.messages = queue.Queue()
+        self.__reader = threading.Thread(target=self.__read)
+        self.__reader.daemon = True
+        self.__reader.start()
+
+    def __read(self):
+        for line in iter(self.process.stdout.readline, b''):
+            self.messages.put(json.loads(line.decode('utf-8')))
+        self.messages.put(None)
+
+    def wait_for(self, message, timeout):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                msg = self.messages.get(
+                    timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                return None
+            if msg is None:
+                raise Exception("marathon-lb exited unexpectedly")
+            if msg['message'] == message:
+                return msg
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        usage = self.wait_for('usage', 10)
+        self.process.wait()
+        return usage
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100.0 * len(values))))]
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {
+        'min': min(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values),
+        'mean': sum(values) / len(values)
+    }
+
+
+def count_tasks(apps):
+    return sum(len(app.get('tasks', [])) for app in apps)
+
+
+def synthetic_events(apps, iterations, seed):
+    """Yields (apps, event) tuples, each scaling a random app up or down by
+    one task."""
+    rnd = random.Random(seed)
+    for i in range(iterations):
+        app = rnd.choice(apps)
+        tasks = app['tasks']
+        if len(tasks) > 1 and rnd.random() < 0.5:
+            task = tasks.pop()
+            status = 'TASK_KILLED'
+        else:
+            task = dict(tasks[0])
+            task['id'] = '%s.scaled%d' % (app['id'][1:], i)
+            task['ports'] = [20000 + (i % 10000) for _ in task['ports']]
+            tasks.append(task)
+            status = 'TASK_RUNNING'
+        yield apps, {
+            'eventType': 'status_update_event',
+            'taskStatus': status,
+            'appId': app['id'],
+            'taskId': task['id'],
+            'host': task['host'],
+            'ports': task['ports'],
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
+        }
+
+
+def recorded_events(filename):
+    """Yields (None, event) tuples from a recorded SSE stream."""
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('data:'):
+                yield None, line[5:].strip()
+
+
+def run_scenario(name, apps, events, storm_seconds, storm_rate, timeout):
+    stub = MarathonStub(apps).start()
+    tmpdir = tempfile.mkdtemp()
+    worker = Worker(stub.url, os.path.join(tmpdir, 'haproxy.cfg'))
+    try:
+        initial = worker.wait_for('regenerated', timeout)
+        if initial is None:
+            raise Exception("timed out waiting for the initial config")
+        stub.wait_for_subscribers(timeout=timeout)
+        result = {
+            'apps': len(apps),
+            'tasks': count_tasks(apps),
+            'initial_sync_seconds': initial['time'] - worker.started_at
+        }
+
+        latencies = []
+        for new_apps, event in events:
+            if new_apps is not None:
+                stub.set_apps(new_apps)
+            event_type = event['eventType'] if isinstance(event, dict) \
+                else json.loads(event).get('eventType')
+            sent_at = time.time()
+            stub.send_event(event)
+            if event_type in RESET_EVENT_TYPES:
+                msg = worker.wait_for('regenerated', timeout)
+                if msg is None:
+                    raise Exception("timed out waiting for a regeneration")
+                latencies.append(msg['time'] - sent_at)
+        result['event_to_config_seconds'] = summarize(latencies)
+
+        # Storm: send events at a steady rate, and count regenerations
+        # until marathon-lb has gone quiet again.
+        quiet = max(1.0, 5 * (result['event_to_config_seconds']
+                              .get('max', 0)))
+        storm_started = time.time()
+        sent = 0
+        while time.time() - storm_started < storm_seconds:
+            stub.send_event({'eventType': 'status_update_event',
+                             'taskStatus': 'TASK_RUNNING'})
+            sent += 1
+            time.sleep(1.0 / storm_rate)
+        regenerations = 0
+        last = storm_started
+        while True:
+            msg = worker.wait_for('regenerated', quiet)
+            if msg is None:
+                break
+            regenerations += 1
+            last = msg['time']
+        result['storm_events'] = sent
+        result['storm_regenerations'] = regenerations
+        result['regenerations_per_second'] = \
+            regenerations / (last - storm_started) if regenerations else 0
+    finally:
+        usage = worker.stop()
+        stub.stop()
+        shutil.rmtree(tmpdir)
+
+    if usage:
+        result['cpu_seconds'] = usage['cpu_seconds']
+        result['peak_rss_kb'] = usage['peak_rss_kb']
+    print("%s: %s" % (name, json.dumps(result, sort_keys=True)))
+    return result
+
+
+def compare(results, baseline):
+    """Prints the relative change of each metric against a baseline."""
+    def flatten(d, prefix=''):
+        flat = {}
+        for key, value in d.items():
+            if isinstance(value, dict):
+                flat.update(flatten(value, prefix + key + '.'))
+            elif isinstance(value, (int, float)):
+                flat[prefix + key] = value
+        return flat
+
+    for name, scenario in sorted(results['scenarios'].items()):
+        if name not in baseline['scenarios']:
+            continue
+        before = flatten(baseline['scenarios'][name])
+        after = flatten(scenario)
+        for metric in sorted(after):
+            if metric in before and before[metric]:
+                change = (after[metric] - before[metric]) / before[metric]
+                print("%s %-40s %12.4f -> %12.4f (%+.1f%%)"
+                      % (name, metric, before[metric], after[metric],
+                         change * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay Marathon snapshots and events against "
+                    "marathon-lb",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--tasks", default="100,1000,10000,50000",
+                        help="Comma separated synthetic cluster sizes, "
+                        "in tasks")
+    parser.add_argument("--snapshot",
+                        help="Recorded /v2/apps?embed=apps.tasks response "
+                        "to replay instead of a synthetic cluster")
+    parser.add_argument("--events",
+                        help="Recorded SSE stream to replay against the "
+                        "snapshot")
+    parser.add_argument("--iterations", type=int, default=20,
+                        help="Number of synthetic events per scenario")
+    parser.add_argument("--storm-seconds", type=float, default=2,
+                        help="How long to send a storm of events for, to "
+                        "measure the regeneration rate")
+    parser.add_argument("--storm-rate", type=float, default=200,
+                        help="Events per second sent during the storm")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="Seconds to wait for marathon-lb to react")
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--baseline",
+                        help="Compare the results against this file")
+    args = parser.parse_args()
+
+    results = {
+        'created_at': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'scenarios': {}
+    }
+
+    if args.snapshot:
+        with open(args.snapshot) as f:
+            apps = json.load(f)
+        if isinstance(apps, dict):
+            apps = apps['apps']
+        if args.events:
+            events = recorded_events(args.events)
+        else:
+            events = synthetic_events(apps, args.iterations, args.seed)
+        name = os.path.basename(args.snapshot)
+        results['scenarios'][name] = run_scenario(
+            name, apps, events, args.storm_seconds, args.storm_rate,
+            args.timeout)
+    else:
+        for tasks in [int(t) for t in args.tasks.split(',')]:
+            # generate_cluster averages roughly 3 tasks per app
+            apps = generate_cluster(max(1, tasks // 3), args.seed)
+            name = "%d-tasks" % tasks
+            results['scenarios'][name] = run_scenario(
+                name, apps,
+                synthetic_events(apps, args.iterations, args.seed),
+                args.storm_seconds, args.storm_rate, args.timeout)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        run_worker(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""Benchmarks how long marathon_lb.py takes to start, by running it in a
+fresh interpreter several times over: importing it, importing it and
+loading the templates, and printing the --longhelp (which parses the
+arguments and renders every template's description).
+
+With --imports, the slowest imports (by cumulative time, from
+`python -X importtime`) of a single run are listed too.
+
+Run from the repository root:
+
+    python tests/benchmark_startup.py --runs 20 --imports 15
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+    ("import", ["-c", "import marathon_lb"]),
+    ("templater", ["-c", "import marathon_lb; "
+                   "marathon_lb.ConfigTemplater()"]),
+    ("longhelp", [os.path.join(ROOT, "marathon_lb.py"), "--longhelp"]),
+]
+
+
+def run(args):
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call([sys.executable] + args, cwd=ROOT,
+                              stdout=devnull)
+        return time.time() - start
+
+
+def slowest_imports(count):
+    output = subprocess.check_output(
+        [sys.executable, "-X", "importtime", "-c", "import marathon_lb"],
+        cwd=ROOT, stderr=subprocess.STDOUT).decode('utf-8')
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            imports.append((int(fields[1]), fields[2].strip()))
+        except ValueError:
+            # The header
+            continue
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark marathon_lb.py's startup")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--imports", type=int, default=0,
+                        help="List this many of the slowest imports")
+    args = parser.parse_args()
+
+    for name, case in CASES:
+        # The first run warms the page cache and writes the .pyc files
+        run(case)
+        timings = sorted(run(case) for _ in range(args.runs))
+        print("%-10s min %.3fs, median %.3fs, max %.3fs" % (
+            name, timings[0], timings[len(timings) // 2], timings[-1]))
+
+    if args.imports:
+        print("slowest imports (cumulative):")
+        for usecs, module in slowest_imports(args.imports):
+            print("  %8.1fms  %s" % (usecs / 1000.0, module))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+"""Generates large, realistic Marathon clusters for benchmarking and
+profiling marathon-lb without a real cluster.
+
+The output is the list of apps as returned by
+`/v2/apps?embed=apps.tasks`, and is fully determined by the seed. It
+includes apps nested in groups, multiple service ports per app, vhosts
+(some with several comma separated hostnames and paths), per service
+port groups and template overrides, HTTP/TCP/command health checks with
+task health check results (including unhealthy and starting tasks), and
+blue/green deployments in flight.
+
+    python tests/cluster_generator.py --apps 5000 --seed 1 > apps.json
+"""
+
+import argparse
+import datetime
+import json
+import random
+import sys
+
+BASE_TIME = datetime.datetime(2016, 2, 1, 12, 0, 0)
+
+
+class ClusterGenerator(object):
+
+    def __init__(self, seed=0, tasks_per_app=3, agents=None,
+                 deployment_fraction=0.02, external_fraction=0.5):
+        self.rnd = random.Random(seed)
+        self.tasks_per_app = tasks_per_app
+        self.agents = agents
+        self.deployment_fraction = deployment_fraction
+        self.external_fraction = external_fraction
+        self.next_service_port = 10000
+        self.next_task = 0
+
+    def timestamp(self, offset_seconds=0):
+        t = BASE_TIME + datetime.timedelta(seconds=offset_seconds)
+        return t.isoformat() + 'Z'
+
+    def service_port(self):
+        port = self.next_service_port
+        self.next_service_port += 1
+        return port
+
+    def agent(self, agents):
+        n = self.rnd.randrange(agents)
+        return "10.%d.%d.%d" % (n // 65536 % 256, n // 256 % 256, n % 256 + 1)
+
+    def health_checks(self, ports):
+        kind = self.rnd.random()
+        if kind < 0.5:
+            return [{
+                "path": self.rnd.choice(["/", "/health", "/_status"]),
+                "protocol": "HTTP",
+                "portIndex": 0,
+                "gracePeriodSeconds": 15,
+                "intervalSeconds": self.rnd.choice([2, 3, 5, 10]),
+                "timeoutSeconds": 10,
+                "maxConsecutiveFailures": self.rnd.choice([3, 10]),
+                "ignoreHttp1xx": False
+            }]
+        elif kind < 0.7:
+            return [{
+                "protocol": "TCP",
+                "portIndex": self.rnd.randrange(len(ports)),
+                "gracePeriodSeconds": 30,
+                "intervalSeconds": 5,
+                "timeoutSeconds": 5,
+                "maxConsecutiveFailures": 3,
+                "ignoreHttp1xx": False
+            }]
+        elif kind < 0.75:
+            return [{
+                "protocol": "COMMAND",
+                "command": {"value": "curl -f http://$HOST:$PORT0/"},
+                "gracePeriodSeconds": 30,
+                "intervalSeconds": 10,
+                "timeoutSeconds": 5,
+                "maxConsecutiveFailures": 3,
+                "ignoreHttp1xx": False
+            }]
+        return []
+
+    def labels(self, name, ports):
+        rnd = self.rnd
+        group = "external" if rnd.random() < self.external_fraction \
+            else "internal"
+        labels = {"HAPROXY_GROUP": group}
+        for i in range(len(ports)):
+            if rnd.random() < 0.4:
+                hosts = ["%s-%d.example.com" % (name, i)]
+                if rnd.random() < 0.2:
+                    hosts += ["%s-%d.%s.example.org" % (name, i, alias)
+                              for alias in range(rnd.randint(1, 3))]
+                labels["HAPROXY_%d_VHOST" % i] = ",".join(hosts)
+                if rnd.random() < 0.2:
+                    labels["HAPROXY_%d_PATH" % i] = \
+                        rnd.choice(["/api", "/v1", "/static", "/app"])
+                if rnd.random() < 0.3:
+                    labels["HAPROXY_%d_REDIRECT_TO_HTTPS" % i] = "true"
+                    if rnd.random() < 0.5:
+                        labels["HAPROXY_%d_USE_HSTS" % i] = "true"
+                if rnd.random() < 0.05:
+                    labels["HAPROXY_%d_SSL_CERT" % i] = \
+                        "/etc/ssl/%s.pem" % name
+            elif rnd.random() < 0.3:
+                labels["HAPROXY_%d_MODE" % i] = "http"
+            if rnd.random() < 0.1:
+                labels["HAPROXY_%d_STICKY" % i] = "true"
+            if rnd.random() < 0.1:
+                labels["HAPROXY_%d_BALANCE" % i] = \
+                    rnd.choice(["leastconn", "source"])
+            if i > 0 and rnd.random() < 0.2:
+                labels["HAPROXY_%d_GROUP" % i] = \
+                    "internal" if group == "external" else "external"
+            if rnd.random() < 0.02:
+                labels["HAPROXY_%d_BACKEND_HEAD" % i] = \
+                    "\nbackend {backend}\n  balance {balance}\n" \
+                    "  mode {mode}\n  timeout server 60s\n"
+            if rnd.random() < 0.02:
+                labels["HAPROXY_%d_BIND_ADDR" % i] = "127.0.0.1"
+        return labels
+
+    def tasks(self, app_id, ports, instances, health_checks, version,
+              agents):
+        tasks = []
+        for _ in range(instances):
+            self.next_task += 1
+            task = {
+                "id": "%s.%08x" % (app_id[1:].replace('/', '_'),
+                                   self.next_task),
+                "appId": app_id,
+                "host": self.agent(agents),
+                "ports": [self.rnd.randint(20000, 32000) for _ in ports],
+                "startedAt": self.timestamp(self.rnd.randint(0, 86400)),
+                "stagedAt": self.timestamp(),
+                "version": version
+            }
+            # Tasks of an older app version may expose fewer ports
+            if len(ports) > 1 and self.rnd.random() < 0.02:
+                task["ports"] = task["ports"][:-1]
+            if health_checks:
+                r = self.rnd.random()
+                if r < 0.9:
+                    alive = True
+                elif r < 0.95:
+                    alive = False
+                else:
+                    alive = None  # still starting, no results yet
+                if alive is not None:
+                    task["healthCheckResults"] = [{
+                        "alive": alive,
+                        "consecutiveFailures": 0 if alive else 3,
+                        "firstSuccess": self.timestamp(),
+                        "lastFailure": None,
+                        "lastSuccess": self.timestamp(60),
+                        "taskId": task["id"]
+                    } for _ in health_checks]
+            tasks.append(task)
+        return tasks
+
+    def app(self, app_id, ports, labels, instances, agents):
+        version = self.timestamp(self.rnd.randint(0, 3600))
+        health_checks = self.health_checks(ports)
+        return {
+            "id": app_id,
+            "cmd": "./run --port $PORT0",
+            "cpus": 0.1,
+            "mem": 128,
+            "instances": instances,
+            "ports": ports,
+            "labels": labels,
+            "healthChecks": health_checks,
+            "version": version,
+            "versionInfo": {
+                "lastConfigChangeAt": version,
+                "lastScalingAt": version
+            },
+            "tasksRunning": instances,
+            "tasksHealthy": instances if health_checks else 0,
+            "tasks": self.tasks(app_id, ports, instances, health_checks,
+                                version, agents)
+        }
+
+    def instances(self):
+        return max(1, int(self.rnd.expovariate(1.0 / self.tasks_per_app)))
+
+    def deployment(self, name, agents):
+        """Returns the blue and green apps of a deployment in flight."""
+        port, alt_port = self.service_port(), self.service_port()
+        target = self.rnd.randint(2, 10)
+        started_at = self.rnd.randint(0, 3600)
+        apps = []
+        for colour, service_port, instances, offset in [
+                ("blue", port, target, 0),
+                ("green", alt_port, self.rnd.randint(1, target),
+                 started_at)]:
+            labels = {
+                "HAPROXY_GROUP": "external",
+                "HAPROXY_0_PORT": str(port),
+                "HAPROXY_DEPLOYMENT_GROUP": name,
+                "HAPROXY_DEPLOYMENT_ALT_PORT": str(alt_port),
+                "HAPROXY_DEPLOYMENT_COLOUR": colour,
+                "HAPROXY_DEPLOYMENT_STARTED_AT":
+                    self.timestamp(offset)[:-1],
+                "HAPROXY_DEPLOYMENT_TARGET_INSTANCES": str(target)
+            }
+            apps.append(self.app("/%s-%s" % (name, colour), [service_port],
+                                 labels, instances, agents))
+        return apps
+
+    def generate(self, count):
+        agents = self.agents or max(1, count // 10)
+        apps = []
+        while len(apps) < count:
+            team = self.rnd.randrange(max(1, count // 50))
+            name = "svc%d" % len(apps)
+            if self.rnd.random() < self.deployment_fraction and \
+                    count - len(apps) >= 2:
+                apps.extend(self.deployment("team%d-%s" % (team, name),
+                                            agents))
+                continue
+            ports = [self.service_port()
+                     for _ in range(self.rnd.choice([1, 1, 1, 2, 3]))]
+            apps.append(self.app("/team%d/%s" % (team, name), ports,
+                                 self.labels(name, ports),
+                                 self.instances(), agents))
+        return apps
+
+
+def generate_cluster(apps, seed=0, **kwargs):
+    """Returns `apps` synthetic Marathon apps (with embedded tasks)."""
+    return ClusterGenerator(seed, **kwargs).generate(apps)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic Marathon /v2/apps response",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--apps", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tasks-per-app", type=float, default=3,
+                        help="Mean number of tasks per app")
+    parser.add_argument("--agents", type=int,
+                        help="Number of agents to spread tasks over "
+                        "(defaults to one per 10 apps)")
+    parser.add_argument("--deployment-fraction", type=float, default=0.02,
+                        help="Fraction of apps in a blue/green deployment")
+    args = parser.parse_args()
+
+    apps = generate_cluster(args.apps, args.seed,
+                            tasks_per_app=args.tasks_per_app,
+                            agents=args.agents,
+                            deployment_fraction=args.deployment_fraction)
+    json.dump({"apps": apps}, sys.stdout, indent=1, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
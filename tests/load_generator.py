@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+"""A small load generator for measuring what clients see through
+HAProxy, and an upstream for it to be load balanced to.
+
+Each client thread makes one HTTP/1.0 request per connection, as `ab`
+does without keep-alive, so every request goes through HAProxy's
+listeners and a reload's effect on accepting connections shows up. For
+each request the start time, the time taken to connect, the total time
+and the error (if any) are recorded:
+
+  * `connect`: the connection was refused or timed out
+  * `reset`: the connection was reset or closed without a response
+  * `timeout`: the response didn't arrive in time
+  * `status`: the response wasn't a 200
+
+A dropped SYN isn't an error unless the connection times out, but the
+client's retransmission (after a second, on Linux) shows up as added
+connect time.
+
+    python tests/load_generator.py serve --port 31000
+    python tests/load_generator.py run --target 127.0.0.1:10000 \\
+        --concurrency 20 --duration 10
+"""
+
+from six.moves import socketserver
+
+import argparse
+import errno
+import json
+import socket
+import threading
+import time
+
+RESPONSE = (b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n'
+            b'Content-Length: 3\r\nConnection: close\r\n\r\nok\n')
+
+
+class UpstreamHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        data = b''
+        while b'\r\n\r\n' not in data:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                return
+            data += chunk
+        self.request.sendall(RESPONSE)
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn,
+                         socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class Upstream(object):
+    """Answers every request with a 200, as soon as it's been read."""
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.server = ThreadingTCPServer((host, port), UpstreamHandler)
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def request(host, port, timeout):
+    """Makes a single request, returning (connect time, total time,
+    error)."""
+    start = time.time()
+    connected = None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect((host, port))
+        except socket.error:
+            # Including timeouts
+            return None, time.time() - start, 'connect'
+        connected = time.time() - start
+        sock.sendall(('GET / HTTP/1.0\r\nHost: %s:%d\r\n\r\n'
+                      % (host, port)).encode('ascii'))
+        response = b''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+    except socket.timeout:
+        return connected, time.time() - start, 'timeout'
+    except socket.error as e:
+        if e.errno not in (errno.ECONNRESET, errno.EPIPE):
+            raise
+        return connected, time.time() - start, 'reset'
+    finally:
+        sock.close()
+    elapsed = time.time() - start
+    if not response:
+        return connected, elapsed, 'reset'
+    if response.split(b'\r\n', 1)[0].split(b' ')[1:2] != [b'200']:
+        return connected, elapsed, 'status'
+    return connected, elapsed, None
+
+
+class LoadGenerator(object):
+    """Requests the `targets` ((host, port) pairs, in turn) from
+    `concurrency` threads until stopped. `results` holds a (start,
+    connect time, total time, error) tuple for each request."""
+
+    def __init__(self, targets, concurrency=10, timeout=5):
+        self.targets = targets
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.results = []
+        self.__stop = threading.Event()
+        self.__threads = []
+
+    def __run(self, offset):
+        i = offset
+        while not self.__stop.is_set():
+            host, port = self.targets[i % len(self.targets)]
+            i += 1
+            start = time.time()
+            connect, elapsed, error = request(host, port, self.timeout)
+            self.results.append((start, connect, elapsed, error))
+
+    def start(self):
+        self.__stop.clear()
+        self.__threads = [threading.Thread(target=self.__run, args=(i,))
+                          for i in range(self.concurrency)]
+        for thread in self.__threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self.__stop.set()
+        for thread in self.__threads:
+            thread.join()
+        return self.results
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100.0 * len(values))))]
+
+
+def summarize(results, duration):
+    """Summarizes LoadGenerator results gathered over `duration` seconds.
+    Latencies are of the requests which succeeded."""
+    latencies = [elapsed for _, _, elapsed, error in results if not error]
+    connects = [connect for _, connect, _, error in results if not error]
+    errors = dict()
+    for _, _, _, error in results:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+    summary = {
+        'requests': len(results),
+        'failed': sum(errors.values()),
+        'errors': errors,
+        'requests_per_second': len(results) / duration if duration else 0,
+        # Requests which took over a second to connect have had a SYN
+        # retransmitted
+        'slow_connects': len([c for c in connects if c >= 1])
+    }
+    for name, values in [('latency', latencies), ('connect', connects)]:
+        if values:
+            summary[name] = {
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': max(values),
+                'mean': sum(values) / len(values)
+            }
+    return summary
+
+
+def parse_target(target):
+    host, port = target.rsplit(':', 1)
+    return host, int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate HTTP load, or serve as its upstream",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    serve = subparsers.add_parser('serve', help="Run an upstream")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=31000)
+    run = subparsers.add_parser('run', help="Generate load")
+    run.add_argument("--target", action="append", required=True,
+                     help="host:port to request, may be repeated")
+    run.add_argument("--concurrency", type=int, default=10)
+    run.add_argument("--duration", type=float, default=10)
+    run.add_argument("--timeout", type=float, default=5)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        upstream = Upstream(args.port, args.host)
+        try:
+            upstream.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'run':
+        generator = LoadGenerator([parse_target(t) for t in args.target],
+                                  args.concurrency, args.timeout).start()
+        time.sleep(args.duration)
+        results = generator.stop()
+        print(json.dumps(summarize(results, args.duration), indent=2,
+                         sort_keys=True))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,565 @@
+#!/usr/bin/env python3
+
+"""A stub Marathon for running marathon-lb and bluegreen_deploy against
+without a cluster.
+
+It keeps the apps (with their tasks) in memory and serves the parts of
+the Marathon API that they use:
+
+  * GET/POST /v2/apps, GET/PUT/DELETE /v2/apps/<id>
+  * GET /v2/tasks, POST /v2/tasks/delete[?scale=true]
+  * GET /v2/events (SSE)
+  * GET/POST/DELETE /v2/eventSubscriptions (HTTP callbacks)
+  * GET /v2/leader
+  * GET /v2/deployments (always empty, as changes are applied at once)
+
+Changes made through the API emit the matching events. To load test,
+responses can be delayed (`latency`, `latency_jitter`), apps padded to
+inflate the payload size (`app_padding`), and a steady rate of task
+status events generated (`start_events()`). It can also be run on its
+own:
+
+    python tests/marathon_stub.py --port 8080 --apps 2000 --event-rate 50
+"""
+
+from six.moves import BaseHTTPServer, socketserver, queue
+from six.moves.urllib import parse
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+import requests
+
+from cluster_generator import generate_cluster
+
+logger = logging.getLogger('marathon_stub')
+
+
+def timestamp():
+    return datetime.datetime.utcnow().isoformat() + 'Z'
+
+
+class NotFound(Exception):
+    pass
+
+
+class Conflict(Exception):
+    pass
+
+
+class MarathonStub(object):
+
+    def __init__(self, apps=None, host='127.0.0.1', port=0, latency=0,
+                 latency_jitter=0, app_padding=0, seed=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.app_padding = app_padding
+        self.rnd = random.Random(seed)
+        # host:port of the leader, defaults to this stub
+        self.leader = None
+        # path -> number of requests
+        self.requests = collections.Counter()
+        self.__lock = threading.RLock()
+        self.__subscribers = []
+        self.__callbacks = collections.OrderedDict()
+        self.__next_task = 0
+        self.__events_thread = None
+        self.__events_stop = threading.Event()
+        self.set_apps(apps or [])
+
+        stub = self
+
+        class Handler(MarathonStubHandler):
+            marathon = stub
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.__thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server.server_address[:2]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.stop_events()
+        for subscriber in self.subscribers():
+            subscriber.put(None)
+        for url in list(self.callbacks()):
+            self.remove_callback(url)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def delay(self):
+        """Sleeps for the configured response latency."""
+        latency = self.latency
+        if self.latency_jitter:
+            latency += self.rnd.uniform(0, self.latency_jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    # Apps and tasks
+
+    def set_apps(self, apps):
+        """Replaces all apps. The snapshot served on /v2/apps is
+        serialized once, rather than on every request."""
+        with self.__lock:
+            self.__apps = collections.OrderedDict(
+                (app['id'], app) for app in apps)
+            self.__apps_body = self.__serialize()
+
+    def __changed(self):
+        self.__apps_body = None
+
+    def __serialize(self):
+        apps = list(self.__apps.values())
+        if self.app_padding:
+            padding = 'x' * self.app_padding
+            apps = [dict(app, env=dict(app.get('env', {}),
+                                       STUB_PADDING=padding))
+                    for app in apps]
+        return json.dumps({"apps": apps}).encode('utf-8')
+
+    def apps(self):
+        with self.__lock:
+            return list(self.__apps.values())
+
+    def apps_body(self):
+        with self.__lock:
+            if self.__apps_body is None:
+                self.__apps_body = self.__serialize()
+            return self.__apps_body
+
+    def get_app(self, app_id):
+        with self.__lock:
+            try:
+                return self.__apps[app_id]
+            except KeyError:
+                raise NotFound("App '%s' does not exist" % app_id)
+
+    def tasks(self):
+        with self.__lock:
+            return [dict(task, appId=app['id'],
+                         servicePorts=app.get('ports', []))
+                    for app in self.__apps.values()
+                    for task in app.get('tasks', [])]
+
+    def __new_task(self, app):
+        self.__next_task += 1
+        hosts = [t['host'] for t in app['tasks']] or ['127.0.0.1']
+        task = {
+            "id": "%s.stub%d" % (app['id'][1:].replace('/', '_'),
+                                 self.__next_task),
+            "appId": app['id'],
+            "host": self.rnd.choice(hosts),
+            "ports": [self.rnd.randint(20000, 32000)
+                      for _ in app.get('ports', [])],
+            "startedAt": timestamp(),
+            "stagedAt": timestamp(),
+            "version": app.get('version')
+        }
+        if app.get('healthChecks'):
+            task['healthCheckResults'] = [
+                {"alive": True, "taskId": task['id']}
+                for _ in app['healthChecks']]
+        return task
+
+    def __task_event(self, task, status):
+        self.send_event({
+            "eventType": "status_update_event",
+            "taskStatus": status,
+            "appId": task['appId'],
+            "taskId": task['id'],
+            "host": task['host'],
+            "ports": task['ports'],
+            "timestamp": timestamp()
+        })
+
+    def __scale(self, app, instances):
+        app.setdefault('tasks', [])
+        app['instances'] = instances
+        while len(app['tasks']) < instances:
+            task = self.__new_task(app)
+            app['tasks'].append(task)
+            self.__task_event(task, 'TASK_RUNNING')
+        while len(app['tasks']) > instances:
+            self.__task_event(app['tasks'].pop(), 'TASK_KILLED')
+        app['tasksRunning'] = len(app['tasks'])
+
+    def __deployment(self, app):
+        self.send_event({"eventType": "api_post_event",
+                         "appDefinition": dict((k, v) for k, v in
+                                               app.items() if k != 'tasks'),
+                         "timestamp": timestamp()})
+        return {"deploymentId": "stub-%d" % self.rnd.getrandbits(32),
+                "version": app['version']}
+
+    def create_app(self, app):
+        with self.__lock:
+            if app['id'] in self.__apps:
+                raise Conflict("An app with id [%s] already exists"
+                               % app['id'])
+            app = dict(app, tasks=[], version=timestamp())
+            self.__apps[app['id']] = app
+            self.__scale(app, app.get('instances', 1))
+            self.__changed()
+            self.__deployment(app)
+            return app
+
+    def update_app(self, app_id, changes):
+        with self.__lock:
+            app = self.get_app(app_id)
+            for key, value in changes.items():
+                if key not in ('id', 'instances', 'tasks'):
+                    app[key] = value
+            app['version'] = timestamp()
+            if 'instances' in changes:
+                self.__scale(app, changes['instances'])
+            self.__changed()
+            return self.__deployment(app)
+
+    def delete_app(self, app_id):
+        with self.__lock:
+            app = self.get_app(app_id)
+            self.__scale(app, 0)
+            del self.__apps[app_id]
+            self.__changed()
+            self.send_event({"eventType": "app_terminated_event",
+                             "appId": app_id,
+                             "timestamp": timestamp()})
+            return {"deploymentId": "stub-%d" % self.rnd.getrandbits(32),
+                    "version": timestamp()}
+
+    def kill_tasks(self, task_ids, scale=False):
+        """Kills tasks, as POST /v2/tasks/delete does. Unless `scale` is
+        set, Marathon replaces the killed tasks."""
+        task_ids = set(task_ids)
+        killed = []
+        with self.__lock:
+            for app in self.__apps.values():
+                tasks = [t for t in app.get('tasks', [])
+                         if t['id'] in task_ids]
+                if not tasks:
+                    continue
+                app['tasks'] = [t for t in app['tasks']
+                                if t['id'] not in task_ids]
+                for task in tasks:
+                    self.__task_event(task, 'TASK_KILLED')
+                killed.extend(tasks)
+                if scale:
+                    app['instances'] = len(app['tasks'])
+                    app['version'] = timestamp()
+                self.__scale(app, app['instances'])
+            self.__changed()
+        return killed
+
+    # Events
+
+    def subscribe(self):
+        subscriber = queue.Queue()
+        with self.__lock:
+            self.__subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.__lock:
+            self.__subscribers.remove(subscriber)
+
+    def subscribers(self):
+        with self.__lock:
+            return list(self.__subscribers)
+
+    def disconnect_event_streams(self):
+        """Ends all SSE streams, so that clients have to reconnect."""
+        for subscriber in self.subscribers():
+            subscriber.put(None)
+
+    def callbacks(self):
+        with self.__lock:
+            return list(self.__callbacks)
+
+    def add_callback(self, url):
+        with self.__lock:
+            if url in self.__callbacks:
+                return
+            events = queue.Queue()
+            thread = threading.Thread(target=self.__deliver,
+                                      args=(url, events))
+            thread.daemon = True
+            self.__callbacks[url] = events
+            thread.start()
+
+    def remove_callback(self, url):
+        with self.__lock:
+            events = self.__callbacks.pop(url, None)
+        if events is not None:
+            events.put(None)
+
+    def __deliver(self, url, events):
+        session = requests.Session()
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            try:
+                session.post(url, data=event,
+                             headers={'Content-Type': 'application/json'},
+                             timeout=10)
+            except requests.exceptions.RequestException as e:
+                logger.debug("Failed to deliver event to %s: %s", url, e)
+
+    def send_event(self, event):
+        """Sends an event (a dict, or an already serialized string) to all
+        connected SSE clients and registered callbacks."""
+        if not isinstance(event, str):
+            event = json.dumps(event)
+        with self.__lock:
+            queues = self.__subscribers + list(self.__callbacks.values())
+        for subscriber in queues:
+            subscriber.put(event)
+
+    def wait_for_subscribers(self, count=1, timeout=10):
+        deadline = time.time() + timeout
+        while len(self.subscribers()) < count:
+            if time.time() > deadline:
+                raise Exception("timed out waiting for SSE subscribers")
+            time.sleep(0.01)
+
+    def random_task_event(self):
+        """Returns a status update for a random task, as sent by
+        start_events() by default."""
+        with self.__lock:
+            apps = [app for app in self.__apps.values() if app['tasks']]
+            if not apps:
+                return {"eventType": "status_update_event",
+                        "taskStatus": "TASK_RUNNING",
+                        "timestamp": timestamp()}
+            task = self.rnd.choice(self.rnd.choice(apps)['tasks'])
+        return {"eventType": "status_update_event",
+                "taskStatus": "TASK_RUNNING",
+                "appId": task.get('appId'),
+                "taskId": task['id'],
+                "host": task['host'],
+                "ports": task['ports'],
+                "timestamp": timestamp()}
+
+    def start_events(self, rate, factory=None):
+        """Sends `rate` events per second from a background thread, until
+        stop_events() is called. Events are made by `factory`, which
+        defaults to random_task_event."""
+        self.stop_events()
+        factory = factory or self.random_task_event
+        self.__events_stop.clear()
+
+        def run():
+            interval = 1.0 / rate
+            next_at = time.time()
+            while not self.__events_stop.is_set():
+                self.send_event(factory())
+                next_at += interval
+                self.__events_stop.wait(max(0, next_at - time.time()))
+
+        self.__events_thread = threading.Thread(target=run)
+        self.__events_thread.daemon = True
+        self.__events_thread.start()
+
+    def stop_events(self):
+        if self.__events_thread is not None:
+            self.__events_stop.set()
+            self.__events_thread.join()
+            self.__events_thread = None
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class MarathonStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Set on the per-stub subclass created by MarathonStub
+    marathon = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send_json(self, body, status=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        self.wfile.write(("%x\r\n" % len(data)).encode('ascii') + data +
+                         b"\r\n")
+        self.wfile.flush()
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def route(self):
+        url = parse.urlparse(self.path)
+        path = re.sub('/+', '/', url.path).rstrip('/')
+        return path, dict(parse.parse_qsl(url.query))
+
+    def handle_method(self, method):
+        path, params = self.route()
+        self.marathon.requests[path] += 1
+        if method == 'GET' and path == '/v2/events':
+            self.marathon.delay()
+            self.stream_events()
+            return
+        # Always consume the request body, so keep-alive keeps working
+        body = self.read_json()
+        self.marathon.delay()
+        try:
+            self.send_json(*self.dispatch(method, path, params, body))
+        except NotFound as e:
+            self.send_json({"message": str(e)}, 404)
+        except Conflict as e:
+            self.send_json({"message": str(e)}, 409)
+
+    def dispatch(self, method, path, params, body):
+        marathon = self.marathon
+        if path == '/v2/apps':
+            if method == 'GET':
+                return marathon.apps_body(),
+            if method == 'POST':
+                return marathon.create_app(body), 201
+        elif path.startswith('/v2/apps/'):
+            app_id = path[len('/v2/apps'):]
+            if method == 'GET':
+                return {"app": marathon.get_app(app_id)},
+            if method == 'PUT':
+                return marathon.update_app(app_id, body),
+            if method == 'DELETE':
+                return marathon.delete_app(app_id),
+        elif path == '/v2/leader' and method == 'GET':
+            return {"leader": marathon.leader or "%s:%d" %
+                    self.server.server_address[:2]},
+        elif path == '/v2/deployments' and method == 'GET':
+            return [],
+        elif path == '/v2/tasks' and method == 'GET':
+            return {"tasks": marathon.tasks()},
+        elif path == '/v2/tasks/delete' and method == 'POST':
+            scale = params.get('scale') == 'true'
+            killed = marathon.kill_tasks(body.get('ids', []), scale)
+            if scale:
+                return {"deploymentId": "stub-scale",
+                        "version": timestamp()},
+            return {"tasks": killed},
+        elif path == '/v2/eventSubscriptions':
+            url = params.get('callbackUrl')
+            if method == 'GET':
+                return {"callbackUrls": marathon.callbacks()},
+            if method == 'POST' and url:
+                marathon.add_callback(url)
+                return {"callbackUrl": url,
+                        "clientIp": self.client_address[0],
+                        "eventType": "subscribe_event"},
+            if method == 'DELETE' and url:
+                marathon.remove_callback(url)
+                return {"callbackUrl": url,
+                        "clientIp": self.client_address[0],
+                        "eventType": "unsubscribe_event"},
+        raise NotFound("Not found")
+
+    def do_GET(self):
+        self.handle_method('GET')
+
+    def do_POST(self):
+        self.handle_method('POST')
+
+    def do_PUT(self):
+        self.handle_method('PUT')
+
+    def do_DELETE(self):
+        self.handle_method('DELETE')
+
+    def stream_events(self):
+        subscriber = self.marathon.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            while True:
+                event = subscriber.get()
+                if event is None:
+                    self.write_chunk(b'')
+                    return
+                self.write_chunk(("event: message\r\ndata: %s\r\n\r\n"
+                                  % event).encode('utf-8'))
+        except IOError:
+            logger.debug("SSE client went away")
+        finally:
+            self.marathon.unsubscribe(subscriber)
+            self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a stub Marathon",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--apps", type=int, default=100,
+                        help="Number of synthetic apps to serve")
+    parser.add_argument("--snapshot",
+                        help="Serve this /v2/apps?embed=apps.tasks response "
+                        "instead of synthetic apps")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds to delay each response by")
+    parser.add_argument("--latency-jitter", type=float, default=0,
+                        help="Up to this many seconds of random extra "
+                        "latency")
+    parser.add_argument("--app-padding", type=int, default=0,
+                        help="Bytes of padding to add to each app, to "
+                        "inflate the /v2/apps payload")
+    parser.add_argument("--event-rate", type=float, default=0,
+                        help="Task status events to send per second")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.snapshot:
+        with open(args.snapshot) as f:
+            apps = json.load(f)
+        if isinstance(apps, dict):
+            apps = apps['apps']
+    else:
+        apps = generate_cluster(args.apps, args.seed)
+
+    stub = MarathonStub(apps, args.host, args.port, args.latency,
+                        args.latency_jitter, args.app_padding, args.seed)
+    stub.start()
+    logger.info("Serving %d apps on %s", len(apps), stub.url)
+    if args.event_rate:
+        stub.start_events(args.event_rate)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 import unittest
 import bluegreen_deploy
 import mock
+import requests
 import json
 
+from marathon_stub import MarathonStub
+
 
 class Arguments:
     json = 'tests/1-nginx.json'
@@ -90,3 +93,70 @@ class TestBluegreenDeploy(unittest.TestCase):
 ''')
         expected['labels']['HAPROXY_DEPLOYMENT_STARTED_AT'] = ""
         self.assertEqual(output, expected)
+
+    def test_get_haproxy_pids_json(self):
+        response = mock.Mock()
+        response.json.return_value = json.loads('''{
+  "generation": 3,
+  "pid": 123,
+  "pids": [123, 97, 45],
+  "processes": [
+    {"pid": 123, "generation": 3, "current": true, "conns": 7},
+    {"pid": 97, "generation": 2, "current": false, "conns": 2},
+    {"pid": 45, "generation": 1, "current": false, "conns": null}
+  ]
+}''')
+        with mock.patch('requests.get', return_value=response):
+            pids, old_conns = bluegreen_deploy.get_haproxy_pids("http://lb")
+        self.assertEqual(pids, [123, 97, 45])
+        self.assertEqual(old_conns, 2)
+
+    def test_get_haproxy_pids_text(self):
+        response = mock.Mock()
+        response.json.side_effect = ValueError
+        response.text = "123 97\n"
+        with mock.patch('requests.get', return_value=response):
+            pids, old_conns = bluegreen_deploy.get_haproxy_pids("http://lb")
+        self.assertEqual(pids, ["123", "97"])
+        self.assertIsNone(old_conns)
+
+    def test_get_haproxy_pids_single_pid_text(self):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b"123"
+        with mock.patch('requests.get', return_value=response):
+            pids, old_conns = bluegreen_deploy.get_haproxy_pids("http://lb")
+        self.assertEqual(pids, ["123"])
+        self.assertIsNone(old_conns)
+
+    def test_get_app_info_and_scale_against_stub(self):
+        with open('tests/bluegreen_app_blue.json') as f:
+            apps = json.load(f)['apps']
+        stub = MarathonStub(apps).start()
+        try:
+            args = Arguments()
+            args.marathon = stub.url
+            args.resume = False
+            colour, port, existing_app, resuming = \
+                bluegreen_deploy.get_app_info(args, 'nginx', 10001)
+            self.assertEqual(colour, 'blue')
+            self.assertEqual(existing_app['id'], apps[0]['id'])
+
+            app_id = existing_app['id']
+            url = stub.url + "/v2/apps" + app_id
+            requests.put(url, data=json.dumps({'instances': 3}),
+                         headers={'Content-Type': 'application/json'}
+                         ).raise_for_status()
+            self.assertEqual(len(stub.get_app(app_id)['tasks']), 3)
+
+            task_id = stub.get_app(app_id)['tasks'][0]['id']
+            requests.post(stub.url + "/v2/tasks/delete?scale=true",
+                          data=json.dumps({'ids': [task_id]}),
+                          headers={'Content-Type': 'application/json'}
+                          ).raise_for_status()
+            self.assertEqual(stub.get_app(app_id)['instances'], 2)
+
+            requests.delete(url).raise_for_status()
+            self.assertEqual(requests.get(url).status_code, 404)
+        finally:
+            stub.stop()
@@ -0,0 +1,252 @@
+import mock
+import signal
+import unittest
+
+from config import ConfigTemplater
+from haproxy_runtime import HAProxyMaster, HAProxySocket, \
+    OldWorkerReaper, ServerStateReconciler, list_haproxy_processes
+
+SERVERS_STATE = '''1
+# be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state \
+srv_uweight srv_iweight srv_time_since_last_change srv_check_status \
+srv_check_result srv_check_health srv_check_state srv_agent_state \
+bk_f_forced_id srv_f_forced_id srv_fqdn srv_port srvrecord
+3 nginx_10000 1 10_0_0_1_31000 10.0.0.1 2 0 1 1 5 6 3 4 6 0 0 0 - 31000 -
+3 nginx_10000 2 10_0_0_2_31000 10.0.0.9 2 0 1 1 5 6 3 4 6 0 0 0 - 31000 -
+3 nginx_10000 3 10_0_0_3_31000 10.0.0.3 0 1 1 1 5 6 3 4 6 0 0 0 - 31000 -
+3 nginx_10000 4 10_0_0_4_31000 10.0.0.4 2 0 1 1 5 6 3 4 6 0 0 0 - 31000 -
+3 nginx_10000 5 10_0_0_5_31000 10.0.0.5 2 0 1 1 5 6 3 4 6 0 0 0 - 31000 -
+3 nginx_10000 6 slot1 10.0.0.7 2 0 1 1 5 6 3 4 6 0 0 0 - 31001 -
+
+'''
+
+SHOW_STAT = '''# pxname,svname,qcur,status,
+nginx_10000,FRONTEND,,OPEN,
+nginx_10000,10_0_0_1_31000,0,UP,
+nginx_10000,10_0_0_2_31000,0,UP,
+nginx_10000,10_0_0_3_31000,0,MAINT,
+nginx_10000,10_0_0_4_31000,0,UP,
+nginx_10000,10_0_0_5_31000,0,no check,
+nginx_10000,slot1,0,UP,
+nginx_10000,BACKEND,0,UP,
+
+'''
+
+
+SHOW_PROC = '''#<PID>          <type>          <relative PID>  <reloads>       <uptime>
+1162            master          0               {reloads:<15} 0d00h02m07s
+# workers
+{workers}
+# old workers
+1233            worker          [was: 1       ] 2               0d00h00m28s
+# programs
+
+'''
+
+
+class FakeHAProxyMaster(HAProxyMaster):
+    """Reloads into `outcomes`, a list of the workers (as `show proc`
+    lines) after each reload."""
+
+    def __init__(self, outcomes):
+        HAProxyMaster.__init__(self, '/dev/null')
+        self.outcomes = outcomes
+        self.reloads = 0
+        self.workers = '1271            worker          1               0' \
+            '               0d00h00m00s'
+
+    def command(self, cmd):
+        if cmd == 'reload':
+            self.reloads += 1
+            self.workers = self.outcomes.pop(0)
+            return ''
+        return SHOW_PROC.format(reloads=self.reloads, workers=self.workers)
+
+
+class FakeHAProxySocket(HAProxySocket):
+
+    def __init__(self):
+        HAProxySocket.__init__(self, '/dev/null')
+        self.commands = []
+
+    def command(self, cmd):
+        if cmd == 'show servers state':
+            return SERVERS_STATE
+        if cmd == 'show stat':
+            return SHOW_STAT
+        self.commands.append(cmd)
+        if ' addr ' in cmd:
+            # What HAProxy replies when the address changes
+            return "IP changed from '10.0.0.9' to '10.0.0.2', no need to " \
+                "change the port by 'stats socket command'\n"
+        return '\n'
+
+
+class TestHAProxyRuntime(unittest.TestCase):
+
+    def test_show_servers_state(self):
+        servers = FakeHAProxySocket().show_servers_state()
+        self.assertEqual(list(servers), ['nginx_10000'])
+        self.assertEqual(len(servers['nginx_10000']), 6)
+        self.assertEqual(
+            servers['nginx_10000']['10_0_0_2_31000']['srv_addr'],
+            '10.0.0.9')
+
+    def test_show_stat(self):
+        rows = FakeHAProxySocket().show_stat()
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(rows[3]['svname'], '10_0_0_3_31000')
+        self.assertEqual(rows[3]['status'], 'MAINT')
+
+    def test_show_proc(self):
+        processes = FakeHAProxyMaster([]).show_proc()
+        self.assertEqual([(p['pid'], p['type'], p['relative_pid'],
+                           p['reloads'], p['old']) for p in processes],
+                         [(1162, 'master', 0, 0, False),
+                          (1271, 'worker', 1, 0, False),
+                          (1233, 'worker', 1, 2, True)])
+
+    def test_master_reload(self):
+        new_worker = '1300            worker          1               0' \
+            '               0d00h00m00s'
+        master = FakeHAProxyMaster([new_worker, ''])
+        processes = master.reload()
+        self.assertEqual([p['pid'] for p in processes
+                          if p['type'] == 'worker' and not p['old']],
+                         [1300])
+        # The new config didn't load, so there are no new workers
+        self.assertIsNone(master.reload())
+
+    def test_master_reload_without_master(self):
+        master = FakeHAProxyMaster([])
+        master.show_proc = mock.Mock(return_value=[
+            {'pid': 1271, 'type': 'worker', 'relative_pid': 1,
+             'reloads': 0, 'uptime': '0d00h00m00s', 'old': False}])
+        self.assertIsNone(master.reload())
+        self.assertEqual(master.reloads, 0)
+
+    def test_old_worker_reaper(self):
+        master = FakeHAProxyMaster([])
+        master.show_proc = mock.Mock()
+        reaper = OldWorkerReaper(master, max_old_workers=2, max_age=60,
+                                 interval=5)
+        self.assertEqual(reaper.render(ConfigTemplater()),
+                         '\nglobal\n  hard-stop-after 60s\n')
+
+        def workers(*old):
+            return [{'pid': 10, 'type': 'worker', 'old': False}] + \
+                [{'pid': pid, 'type': 'worker', 'old': True} for pid in old]
+
+        with mock.patch('haproxy_runtime.os.kill') as kill, \
+                mock.patch('haproxy_runtime.process_rss',
+                           return_value=1048576):
+            master.show_proc.return_value = workers(7, 8)
+            self.assertEqual(reaper.check(now=1000), [])
+            self.assertEqual(reaper.stats['old_rss'], 2097152)
+
+            # Over the limit, the oldest goes first
+            master.show_proc.return_value = workers(7, 8, 9)
+            self.assertEqual(reaper.check(now=1010), [7])
+            kill.assert_called_once_with(7, signal.SIGTERM)
+
+            # HAProxy's hard-stop-after should have closed 8 by now
+            master.show_proc.return_value = workers(8, 9)
+            self.assertEqual(reaper.check(now=1064), [])
+            self.assertEqual(reaper.check(now=1066), [8])
+            self.assertEqual(reaper.stats['old_workers'], 1)
+            self.assertEqual(reaper.stats['reaped'], 2)
+
+    def test_list_haproxy_processes_without_master(self):
+        def start_time(pid):
+            return {10: 100, 11: 200, 12: 300}.get(pid)
+
+        with mock.patch('haproxy_runtime.subprocess.check_output',
+                        return_value=b'12 11 10\n'), \
+                mock.patch('haproxy_runtime.process_start_time',
+                           side_effect=start_time), \
+                mock.patch('haproxy_runtime.is_config_check',
+                           side_effect=lambda pid: pid == 12), \
+                mock.patch('haproxy_runtime.read_pid_file',
+                           return_value=set()) as read_pid_file:
+            # `haproxy -c` (12) started last, but isn't serving
+            self.assertEqual(list_haproxy_processes(),
+                             [(10, True), (11, False)])
+            # The pid file names the current workers
+            read_pid_file.return_value = set([10])
+            self.assertEqual(list_haproxy_processes(),
+                             [(10, False), (11, True)])
+
+    def test_reconcile_repair_counts(self):
+        haproxy = FakeHAProxySocket()
+        reconciler = ServerStateReconciler(haproxy, 1)
+        servers = {
+            'nginx_10000': dict(
+                ('10_0_0_%d_31000' % i, ('10.0.0.%d' % i, 31000, False))
+                for i in [1, 2, 4, 5])
+        }
+        servers['nginx_10000']['slot1'] = ('10.0.0.7', 31001, False)
+        for _ in range(2):
+            reconciler.reconcile(1, servers, lambda: None)
+        # HAProxy replies to the address being changed
+        self.assertEqual(haproxy.commands, [
+            'set server nginx_10000/10_0_0_2_31000 addr 10.0.0.2'])
+        self.assertEqual(reconciler.stats['repairs'], 1)
+        self.assertEqual(reconciler.stats['failed_repairs'], 0)
+
+        # And with an error when it can't be
+        haproxy.command = mock.Mock(side_effect=lambda cmd: {
+            'show servers state': SERVERS_STATE,
+            'show stat': SHOW_STAT
+        }.get(cmd, 'No such server.\n'))
+        reconciler.reconcile(1, servers, lambda: None)
+        self.assertEqual(reconciler.stats['repairs'], 1)
+        self.assertEqual(reconciler.stats['failed_repairs'], 1)
+
+    def test_reconcile(self):
+        haproxy = FakeHAProxySocket()
+        reconciler = ServerStateReconciler(haproxy, 1)
+        reloads = []
+        servers = {
+            'nginx_10000': {
+                # Fine
+                '10_0_0_1_31000': ('10.0.0.1', 31000, False),
+                # Wrong address
+                '10_0_0_2_31000': ('10.0.0.2', 31000, False),
+                # Stuck in maintenance
+                '10_0_0_3_31000': ('10.0.0.3', 31000, False),
+                # Should be draining
+                '10_0_0_4_31000': ('10.0.0.4', 31000, True),
+                # Wrong port
+                'slot1': ('10.0.0.7', 31000, False),
+                # Missing
+                '10_0_0_6_31000': ('10.0.0.6', 31000, False)
+                # 10_0_0_5_31000 is extra
+            }
+        }
+
+        drift = reconciler.reconcile(1, servers,
+                                     lambda: reloads.append(True))
+        self.assertEqual(drift, {'missing': 1, 'extra': 1, 'address': 2,
+                                 'state': 2})
+        # Nothing is repaired until the drift has been seen twice
+        self.assertEqual(haproxy.commands, [])
+        self.assertEqual(reloads, [])
+
+        reconciler.reconcile(1, servers, lambda: reloads.append(True))
+        self.assertEqual(sorted(haproxy.commands), [
+            'set server nginx_10000/10_0_0_2_31000 addr 10.0.0.2',
+            'set server nginx_10000/10_0_0_3_31000 state ready',
+            'set server nginx_10000/10_0_0_4_31000 state maint',
+            'set server nginx_10000/10_0_0_5_31000 state maint',
+            'set server nginx_10000/slot1 addr 10.0.0.7 port 31000'])
+        self.assertEqual(reloads, [True])
+        self.assertEqual(reconciler.stats['repairs'], 5)
+
+        # A reload which didn't help isn't repeated for the same config
+        reconciler.reconcile(1, servers, lambda: reloads.append(True))
+        self.assertEqual(reloads, [True])
+
+        # A new desired state starts over
+        del haproxy.commands[:]
+        reconciler.reconcile(2, servers, lambda: reloads.append(True))
+        self.assertEqual(haproxy.commands, [])
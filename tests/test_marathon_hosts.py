@@ -0,0 +1,88 @@
+import socket
+import time
+import unittest
+
+import marathon_lb
+from marathon_hosts import MarathonHosts
+from marathon_stub import MarathonStub
+
+
+def unused_url():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "http://127.0.0.1:%d" % port
+
+
+class TestMarathonHosts(unittest.TestCase):
+
+    def test_failover(self):
+        stub = MarathonStub().start()
+        try:
+            dead = unused_url()
+            marathon = marathon_lb.Marathon([dead, stub.url], False, None)
+            self.assertEqual(marathon.list(), [])
+            self.assertEqual(marathon.list(), [])
+
+            stats = dict((s['url'], s) for s in marathon.host_stats())
+            # The dead host is ejected after its first failure
+            self.assertEqual(stats[dead]['errors'], 1)
+            self.assertTrue(stats[dead]['ejected'])
+            self.assertEqual(stats[stub.url]['errors'], 0)
+            self.assertEqual(stub.requests['/v2/apps'], 2)
+            self.assertEqual(marathon.host, stub.url)
+        finally:
+            stub.stop()
+
+    def test_prefers_leader(self):
+        follower = MarathonStub().start()
+        leader = MarathonStub().start()
+        try:
+            follower.leader = leader.leader = leader.url[len('http://'):]
+            marathon = marathon_lb.Marathon([follower.url, leader.url],
+                                            False, None)
+            marathon.list()
+            self.assertEqual(follower.requests['/v2/apps'], 0)
+            self.assertEqual(leader.requests['/v2/apps'], 1)
+            self.assertEqual([s['leader'] for s in marathon.host_stats()],
+                             [False, True])
+        finally:
+            follower.stop()
+            leader.stop()
+
+    def test_stalled_host(self):
+        stub = MarathonStub().start()
+        # Accepts connections (into its backlog), but never answers
+        stalled = socket.socket()
+        stalled.bind(('127.0.0.1', 0))
+        stalled.listen(5)
+        try:
+            stalled_url = "http://127.0.0.1:%d" % stalled.getsockname()[1]
+            hosts = MarathonHosts([stalled_url, stub.url], timeout=(1, 0.5))
+            start = time.time()
+            response = hosts.request('GET', '/v2/apps')
+            self.assertEqual(response.status_code, 200)
+            self.assertLess(time.time() - start, 5)
+            stats = dict((s['url'], s) for s in hosts.stats())
+            self.assertTrue(stats[stalled_url]['ejected'])
+        finally:
+            stub.stop()
+            stalled.close()
+
+    def test_backoff(self):
+        hosts = MarathonHosts(["http://a", "http://b"], min_backoff=1,
+                              max_backoff=4, leader_refresh=3600)
+        a, b = hosts.hosts
+        start = time.time()
+        for expected in [1, 2, 4, 4]:
+            hosts.failed(a, "HTTP 503")
+            self.assertAlmostEqual(a.ejected_until - start, expected,
+                                   delta=0.5)
+        self.assertEqual(hosts.ordered(), [b, a])
+
+        hosts.succeeded(a, 0.1)
+        self.assertEqual(a.consecutive_errors, 0)
+        self.assertEqual(a.errors, 4)
+        hosts.succeeded(b, 0.5)
+        self.assertEqual(hosts.ordered(), [a, b])
@@ -1,6 +1,17 @@
 import unittest
+import hashlib
 import json
 import marathon_lb
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from cluster_generator import generate_cluster
+from marathon_stub import MarathonStub
+from test_haproxy_runtime import FakeHAProxyMaster, FakeHAProxySocket
 
 
 class TestMarathonUpdateHaproxy(unittest.TestCase):
@@ -35,7 +46,7 @@ DHE-RSA-AES256-SHA:ECDHE-ECDSA-DES-CBC3-SHA:ECDHE-RSA-DES-CBC3-SHA:\
 EDH-RSA-DES-CBC3-SHA:AES128-GCM-SHA256:AES256-GCM-SHA384:AES128-SHA256:\
 AES256-SHA256:AES128-SHA:AES256-SHA:DES-CBC3-SHA:!DSS
   ssl-default-server-options no-sslv3 no-tls-tickets
-  stats socket /var/run/haproxy/socket
+  stats socket /var/run/haproxy/socket expose-fd listeners
   server-state-file global
   server-state-base /var/state/haproxy/
   lua-load /marathon-lb/getpids.lua
@@ -67,6 +78,8 @@ listen stats
   http-request use-service lua.getpids if getpid
   acl getconfig path /_haproxy_getconfig
   http-request use-service lua.getconfig if getconfig
+  acl getconfighash path /_haproxy_getconfighash
+  http-request use-service lua.getconfighash if getconfighash
 '''
 
     def test_config_no_apps(self):
@@ -1179,3 +1192,923 @@ backend nginx_10001
   server 1_1_1_1_1025 1.1.1.1:1025
 '''
         self.assertMultiLineEqual(config, expected)
+
+    def test_get_apps_service_port_labels(self):
+        class Marathon:
+            def list(self):
+                return [{
+                    "id": "/nginx",
+                    "ports": [10000, 10001],
+                    "healthChecks": [],
+                    "labels": {
+                        "HAPROXY_GROUP": "external",
+                        "HAPROXY_0_VHOST": "nginx.mesosphere.com",
+                        "HAPROXY_0_STICKY": "true",
+                        "HAPROXY_0_BACKEND_HEAD": "backend {backend}\n",
+                        "HAPROXY_1_PORT": "8080",
+                        "HAPROXY_1_MODE": "http",
+                        "HAPROXY_1_UNKNOWN": "ignored",
+                        "HAPROXY_DEPLOYMENT_ALT_PORT": "10002"
+                    },
+                    "tasks": [{
+                        "id": "nginx.1",
+                        "host": "1.1.1.1",
+                        "ports": [31000, 31001]
+                    }]
+                }]
+
+            def health_check(self):
+                return False
+
+        apps = sorted(marathon_lb.get_apps(Marathon()),
+                      key=lambda service: service.servicePort)
+        self.assertEqual([app.servicePort for app in apps], [8080, 10000])
+
+        self.assertEqual(apps[0].mode, 'http')
+        self.assertIsNone(apps[0].hostname)
+        self.assertEqual(apps[0].labels, {})
+
+        self.assertEqual(apps[1].hostname, "nginx.mesosphere.com")
+        self.assertTrue(apps[1].sticky)
+        self.assertEqual(apps[1].labels,
+                         {"HAPROXY_{0}_BACKEND_HEAD": "backend {backend}\n"})
+
+    def test_get_apps_definition_cache(self):
+        def make_app(appId, version, vhost):
+            return {
+                "id": appId,
+                "ports": [10000],
+                "healthChecks": [],
+                "labels": {
+                    "HAPROXY_GROUP": "external",
+                    "HAPROXY_0_VHOST": vhost
+                },
+                "versionInfo": {"lastConfigChangeAt": version},
+                "tasks": [{
+                    "id": appId[1:] + ".1",
+                    "host": "1.1.1.1",
+                    "ports": [31000]
+                }]
+            }
+
+        class Marathon:
+            def __init__(self):
+                self.apps = []
+
+            def list(self):
+                return self.apps
+
+            def health_check(self):
+                return False
+
+        marathon = Marathon()
+        cache = marathon_lb.AppDefinitionCache()
+
+        marathon.apps = [make_app("/nginx", "v1", "a.example.com"),
+                         make_app("/apache", "v1", "b.example.com")]
+        marathon_lb.get_apps(marathon, cache)
+        self.assertEqual(len(cache), 2)
+
+        # Unchanged definitions are reused, but tasks are always fresh
+        marathon.apps = [make_app("/nginx", "v1", "ignored.example.com"),
+                         make_app("/apache", "v1", "b.example.com")]
+        marathon.apps[0]['tasks'][0]['host'] = "2.2.2.2"
+        apps = marathon_lb.get_apps(marathon, cache)
+        nginx = [app for app in apps if app.appId == "/nginx"][0]
+        self.assertEqual(nginx.hostname, "a.example.com")
+        self.assertEqual([b.host for b in nginx.backends], ["2.2.2.2"])
+
+        # A new version is parsed again, and deleted apps are evicted
+        marathon.apps = [make_app("/nginx", "v2", "c.example.com")]
+        apps = marathon_lb.get_apps(marathon, cache)
+        self.assertEqual(apps[0].hostname, "c.example.com")
+        self.assertEqual(len(cache), 1)
+
+    def test_get_apps_group_filter(self):
+        def make_app(appId, labels):
+            return {
+                "id": appId,
+                "ports": [10000, 10001],
+                "healthChecks": [],
+                "labels": labels,
+                "tasks": [{
+                    "id": appId[1:] + ".1",
+                    "host": "1.1.1.1",
+                    "ports": [31000, 31001]
+                }]
+            }
+
+        class Marathon:
+            def list(self):
+                return [
+                    make_app("/internal", {"HAPROXY_GROUP": "internal"}),
+                    make_app("/external", {"HAPROXY_GROUP": "external"}),
+                    make_app("/hybrid", {"HAPROXY_GROUP": "internal",
+                                         "HAPROXY_1_GROUP": "external"})
+                ]
+
+            def health_check(self):
+                return False
+
+        apps = marathon_lb.get_apps(Marathon(), groups=['external'])
+        self.assertEqual(
+            sorted((app.appId, app.servicePort) for app in apps),
+            [("/external", 10000), ("/external", 10001),
+             ("/hybrid", 10001)])
+
+        apps = marathon_lb.get_apps(Marathon(), groups=['*'])
+        self.assertEqual(len(apps), 6)
+
+    def test_config_synthetic_cluster(self):
+        self.assertEqual(generate_cluster(50, seed=3),
+                         generate_cluster(50, seed=3))
+        self.assertNotEqual(generate_cluster(50, seed=3),
+                            generate_cluster(50, seed=4))
+
+        class Marathon:
+            def list(self):
+                return generate_cluster(200, seed=1,
+                                        deployment_fraction=0.1)
+
+            def health_check(self):
+                return True
+
+        apps = marathon_lb.get_apps(Marathon())
+        config = marathon_lb.config(apps, ['*'], True, None,
+                                    marathon_lb.ConfigTemplater())
+        self.assertEqual(config, marathon_lb.config(
+            marathon_lb.get_apps(Marathon()), ['*'], True, None,
+            marathon_lb.ConfigTemplater()))
+        self.assertIn("acl host_", config)
+        self.assertIn("path_beg", config)
+
+    def test_event_stream_small_events(self):
+        # A single small event must be delivered without waiting for more
+        # data to arrive on the stream
+        stub = MarathonStub().start()
+        try:
+            marathon = marathon_lb.Marathon([stub.url], False, None)
+            events = []
+
+            def read_event():
+                events.append(next(marathon.get_event_stream()))
+
+            reader = threading.Thread(target=read_event)
+            reader.daemon = True
+            reader.start()
+            stub.wait_for_subscribers()
+            stub.send_event({"eventType": "api_post_event"})
+            reader.join(5)
+            self.assertEqual(len(events), 1)
+            self.assertEqual(json.loads(events[0].data),
+                             {"eventType": "api_post_event"})
+        finally:
+            stub.stop()
+
+    def test_marathon_stub_api(self):
+        stub = MarathonStub(generate_cluster(5, seed=1)).start()
+        try:
+            marathon = marathon_lb.Marathon([stub.url], False, None)
+            apps = marathon.list()
+            self.assertEqual(len(apps), 5)
+            app = marathon.get_app(apps[0]['id'])
+            self.assertEqual(app['id'], apps[0]['id'])
+            self.assertEqual(len(marathon.tasks()),
+                             sum(len(a['tasks']) for a in apps))
+
+            callback_url = "http://127.0.0.1:1/events"
+            marathon.add_subscriber(callback_url)
+            self.assertEqual(stub.callbacks(), [callback_url])
+            marathon.remove_subscriber(callback_url)
+            self.assertEqual(stub.callbacks(), [])
+        finally:
+            stub.stop()
+
+    def test_poll_marathon_apps_cache(self):
+        stub = MarathonStub(generate_cluster(5, seed=1)).start()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            marathon = marathon_lb.Marathon([stub.url], False, None)
+            config_file = os.path.join(tmpdir, 'haproxy.cfg')
+            apps_cache = os.path.join(tmpdir, 'apps.json')
+            rendered = []
+
+            def regenerate_config(apps, config_file, *args, **kwargs):
+                rendered.append(len(apps))
+                with open(config_file, 'w') as f:
+                    f.write(str(len(apps)))
+
+            def poll(templater=None):
+                return marathon_lb.poll_marathon(
+                    marathon, marathon_lb.MarathonAppsCache(apps_cache),
+                    config_file, ['external'], True, [],
+                    templater or marathon_lb.ConfigTemplater())
+
+            with mock.patch('marathon_lb.regenerate_config',
+                            side_effect=regenerate_config):
+                self.assertEqual(poll(), 'fetched')
+                self.assertEqual(poll(), 'skipped')
+                self.assertEqual(stub.requests['/v2/apps'], 1)
+                self.assertEqual(len(rendered), 1)
+
+                # Other inputs changing re-renders the cached apps
+                templater = marathon_lb.ConfigTemplater()
+                templater.t['HEAD'].value += '  # changed\n'
+                self.assertEqual(poll(templater), 'rendered')
+                self.assertEqual(stub.requests['/v2/apps'], 1)
+                self.assertEqual(rendered[-1], rendered[0])
+
+                # As does the config having been changed under us
+                with open(config_file, 'w') as f:
+                    f.write('')
+                self.assertEqual(poll(templater), 'rendered')
+
+                # A task changing is picked up
+                stub.kill_tasks([stub.tasks()[0]['id']], False)
+                self.assertEqual(poll(templater), 'fetched')
+                self.assertEqual(stub.requests['/v2/apps'], 2)
+        finally:
+            stub.stop()
+            shutil.rmtree(tmpdir)
+
+    def test_template_profiles(self):
+        templater = marathon_lb.ConfigTemplater()
+        apps = []
+        for i, labels in enumerate([
+                {},
+                {},
+                {"HAPROXY_{0}_FRONTEND_HEAD": "frontend custom\n",
+                 "HAPROXY_{0}_VHOST": "custom.example.com"}]):
+            app = marathon_lb.MarathonService('/app%d' % i, 10000 + i, None)
+            app.labels = labels
+            apps.append(app)
+
+        default, same, custom = [templater.profile(app) for app in apps]
+        self.assertIs(default, same)
+        self.assertEqual(default, marathon_lb.ConfigTemplater().profile(
+            marathon_lb.MarathonService('/other', 10003, None)))
+        self.assertNotEqual(default, custom)
+        self.assertEqual(templater.haproxy_frontend_head(apps[2]),
+                         "frontend custom\n")
+        self.assertEqual(templater.haproxy_frontend_head(apps[0]),
+                         templater.t['FRONTEND_HEAD'].value)
+
+        # Profiles are made again once the templates change
+        templater.t['BACKEND_HEAD'].value = 'backend {backend}\n'
+        templater.generation += 1
+        self.assertEqual(templater.haproxy_backend_head(apps[0]),
+                         'backend {backend}\n')
+        self.assertIsNot(templater.profile(apps[1]), default)
+
+    def test_config_frontend_head_label(self):
+        templater = marathon_lb.ConfigTemplater()
+        app = marathon_lb.MarathonService('/nginx', 10000, None)
+        app.groups = frozenset(['external'])
+        app.labels = {"HAPROXY_{0}_FRONTEND_HEAD":
+                      "\nfrontend custom_{backend}\n  bind {bindAddr}:"
+                      "{servicePort}\n  mode {mode}\n"}
+        app.add_backend("1.1.1.1", 1024, False)
+
+        config = marathon_lb.config([app], ['external'], True, None,
+                                    templater)
+        self.assertIn('''
+frontend custom_nginx_10000
+  bind *:10000
+  mode tcp
+  use_backend nginx_10000
+''', config)
+        self.assertNotIn('frontend nginx_10000\n', config)
+
+        # Profiles no service has any more are dropped on the next pass
+        self.assertEqual(templater.cached_profiles(), 1)
+        app.labels = {}
+        app.template_profile = None
+        config = marathon_lb.config([app], ['external'], True, None,
+                                    templater)
+        self.assertIn('frontend nginx_10000\n', config)
+        self.assertEqual(templater.cached_profiles(), 1)
+
+    def test_template_overrides(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'HAPROXY_HEAD'), 'w') as f:
+                f.write('global\n')
+            with open(os.path.join(tmpdir, 'unrelated'), 'w') as f:
+                f.write('\n')
+            templater = marathon_lb.ConfigTemplater(tmpdir)
+            self.assertEqual(templater.haproxy_head, 'global\n')
+            self.assertEqual(templater.t['FRONTEND_HEAD'].value,
+                             templater.t['FRONTEND_HEAD'].default_value)
+
+            templater = marathon_lb.ConfigTemplater(
+                os.path.join(tmpdir, 'missing'))
+            self.assertEqual(templater.t['HEAD'].value,
+                             templater.t['HEAD'].default_value)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_poll_marathon_apps_cache_features(self):
+        stub = MarathonStub(generate_cluster(5, seed=1)).start()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            marathon = marathon_lb.Marathon([stub.url], False, None)
+            config_file = os.path.join(tmpdir, 'haproxy.cfg')
+            apps_cache = os.path.join(tmpdir, 'apps.json')
+            cert = os.path.join(tmpdir, 'cert.pem')
+            with open(cert, 'w') as f:
+                f.write('cert')
+            cert_list = marathon_lb.CertList(
+                os.path.join(tmpdir, 'crt-list'))
+            cert_list.reset([cert])
+            cert_list.write()
+
+            def regenerate_config(apps, config_file, *args, **kwargs):
+                with open(config_file, 'w') as f:
+                    f.write(str(len(apps)))
+
+            def poll(**kwargs):
+                return marathon_lb.poll_marathon(
+                    marathon, marathon_lb.MarathonAppsCache(apps_cache),
+                    config_file, ['external'], True, [],
+                    marathon_lb.ConfigTemplater(), cert_list=cert_list,
+                    **kwargs)
+
+            with mock.patch('marathon_lb.regenerate_config',
+                            side_effect=regenerate_config):
+                self.assertEqual(poll(), 'fetched')
+                self.assertEqual(poll(), 'skipped')
+
+                # A certificate in the crt-list being renewed
+                with open(cert, 'w') as f:
+                    f.write('renewed')
+                self.assertEqual(poll(), 'rendered')
+                self.assertEqual(poll(), 'skipped')
+
+                # Being restarted with different options
+                self.assertEqual(
+                    poll(server_slots=marathon_lb.ServerSlots(4)),
+                    'rendered')
+                self.assertEqual(
+                    poll(server_slots=marathon_lb.ServerSlots(4)),
+                    'skipped')
+                self.assertEqual(
+                    poll(server_slots=marathon_lb.ServerSlots(8)),
+                    'rendered')
+                self.assertEqual(stub.requests['/v2/apps'], 1)
+        finally:
+            stub.stop()
+            shutil.rmtree(tmpdir)
+
+    def test_run_poll_loop(self):
+        stub = MarathonStub(generate_cluster(5, seed=1)).start()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            marathon = marathon_lb.Marathon([stub.url], False, None)
+            config_file = os.path.join(tmpdir, 'haproxy.cfg')
+            apps_cache = marathon_lb.MarathonAppsCache(
+                os.path.join(tmpdir, 'apps.json'))
+
+            def regenerate_config(apps, config_file, *args, **kwargs):
+                with open(config_file, 'w') as f:
+                    f.write(str(len(apps)))
+
+            with mock.patch('marathon_lb.regenerate_config',
+                            side_effect=regenerate_config) as regenerate:
+                marathon_lb.run_poll_loop(marathon, 0, 0, config_file,
+                                          ['external'], True, [],
+                                          cycles=2)
+                self.assertEqual(stub.requests['/v2/apps'], 2)
+                self.assertEqual(regenerate.call_count, 2)
+
+                marathon_lb.run_poll_loop(marathon, 0, 0, config_file,
+                                          ['external'], True, [],
+                                          apps_cache, cycles=3)
+                self.assertEqual(stub.requests['/v2/apps'], 3)
+                self.assertEqual(stub.requests['/v2/tasks'], 3)
+                self.assertEqual(regenerate.call_count, 3)
+        finally:
+            stub.stop()
+            shutil.rmtree(tmpdir)
+
+    def test_model_snapshot(self):
+        def backends(app):
+            return sorted((backend.host, backend.port, backend.draining)
+                          for backend in app.backends)
+
+        stub = MarathonStub(generate_cluster(5, seed=1)).start()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            marathon = marathon_lb.Marathon([stub.url], False, None)
+            apps = marathon_lb.get_apps(marathon, groups=['external'])
+            expected = marathon_lb.config(apps, ['external'], True, [],
+                                          marathon_lb.ConfigTemplater())
+            path = os.path.join(tmpdir, 'model.json.gz')
+            snapshot = marathon_lb.ModelSnapshot(path)
+            self.assertTrue(snapshot.save(apps, 'hash'))
+            self.assertFalse(snapshot.save(apps, 'hash'))
+
+            restored = marathon_lb.ModelSnapshot(path)
+            self.assertTrue(restored.load())
+            self.assertEqual(restored.config_hash, 'hash')
+            self.assertEqual(
+                marathon_lb.config(restored.apps, ['external'], True, [],
+                                   marathon_lb.ConfigTemplater()),
+                expected)
+            for app, restored_app in zip(apps, restored.apps):
+                self.assertEqual(backends(restored_app), backends(app))
+                self.assertEqual(restored_app.groups, set(app.groups))
+            self.assertFalse(marathon_lb.ModelSnapshot(
+                os.path.join(tmpdir, 'missing')).load())
+        finally:
+            stub.stop()
+            shutil.rmtree(tmpdir)
+
+    def test_restore_model_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config_file = os.path.join(tmpdir, 'haproxy.cfg')
+            routing_maps = marathon_lb.RoutingMaps(tmpdir)
+            app = marathon_lb.MarathonService('/nginx', 10000, None)
+            app.groups = frozenset(['external'])
+            app.add_backend('1.1.1.1', 31000, False)
+            path = os.path.join(tmpdir, 'model.json.gz')
+
+            def restore():
+                return marathon_lb.restore_model_snapshot(
+                    marathon_lb.ModelSnapshot(path), config_file,
+                    ['external'], True, [], routing_maps=routing_maps)
+
+            with mock.patch('marathon_lb.regenerate_config') as regenerate:
+                self.assertFalse(restore())
+                self.assertEqual(regenerate.call_count, 0)
+
+                # The config doesn't match the snapshot, so it's rendered
+                # from it without waiting for Marathon
+                marathon_lb.ModelSnapshot(path).save([app], 'hash')
+                self.assertTrue(restore())
+                self.assertEqual(regenerate.call_count, 1)
+                restored = regenerate.call_args[0][0][0]
+                self.assertEqual([(backend.host, backend.port)
+                                  for backend in restored.backends],
+                                 [('1.1.1.1', 31000)])
+
+                with open(config_file, 'w') as f:
+                    f.write('config')
+                marathon_lb.ModelSnapshot(path).save(
+                    [app], marathon_lb.hash_outputs(config_file,
+                                                    routing_maps))
+                regenerate.reset_mock()
+                self.assertTrue(restore())
+                self.assertEqual(regenerate.call_count, 0)
+
+                # The map files are part of what's compared
+                with open(routing_maps.path(routing_maps.HOST_MAP),
+                          'w') as f:
+                    f.write('example.com nginx_10000\n')
+                self.assertTrue(restore())
+                self.assertEqual(regenerate.call_count, 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_processor_rerenders_changed_templates(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            app = marathon_lb.MarathonService('/nginx', 10000, None)
+            app.groups = frozenset(['external'])
+            app.add_backend('1.1.1.1', 31000, False)
+            templater = marathon_lb.ConfigTemplater(tmpdir)
+            heads = []
+            regenerated = threading.Event()
+
+            def regenerate_config(apps, config_file, groups,
+                                  bind_http_https, ssl_certs, templater,
+                                  *args):
+                heads.append(templater.haproxy_head)
+                regenerated.set()
+
+            with mock.patch('marathon_lb.ConfigTemplater',
+                            return_value=templater), \
+                    mock.patch('marathon_lb.get_apps',
+                               return_value=[app]) as get_apps, \
+                    mock.patch('marathon_lb.regenerate_config',
+                               side_effect=regenerate_config):
+                processor = marathon_lb.MarathonEventProcessor(
+                    None, os.path.join(tmpdir, 'haproxy.cfg'),
+                    ['external'], True, [], watch_templates=True)
+                try:
+                    self.assertTrue(regenerated.wait(5))
+                    regenerated.clear()
+                    with open(os.path.join(tmpdir, 'HAPROXY_HEAD'),
+                              'w') as f:
+                        f.write('global\n  daemon\n')
+                    self.assertTrue(regenerated.wait(10))
+                finally:
+                    processor.stop()
+            self.assertEqual(heads[-1], 'global\n  daemon\n')
+            # The apps already fetched were rendered again
+            self.assertEqual(get_apps.call_count, 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_processor_saves_model_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config_file = os.path.join(tmpdir, 'haproxy.cfg')
+            routing_maps = marathon_lb.RoutingMaps(tmpdir)
+            app = marathon_lb.MarathonService('/nginx', 10000, None)
+            app.groups = frozenset(['external'])
+            app.add_backend('1.1.1.1', 31000, False)
+            snapshot = marathon_lb.ModelSnapshot(
+                os.path.join(tmpdir, 'model.json.gz'))
+            hosts = ['a.example.com', 'b.example.com', 'c.example.com']
+            regenerated = threading.Event()
+
+            def regenerate_config(apps, config_file, *args, **kwargs):
+                # Only the maps change, not the config
+                with open(config_file, 'w') as f:
+                    f.write('config')
+                with open(routing_maps.path(routing_maps.HOST_MAP),
+                          'w') as f:
+                    f.write('%s nginx_10000\n' % hosts.pop(0))
+                regenerated.set()
+
+            with mock.patch('marathon_lb.get_apps', return_value=[app]), \
+                    mock.patch('marathon_lb.regenerate_config',
+                               side_effect=regenerate_config):
+                processor = marathon_lb.MarathonEventProcessor(
+                    None, config_file, ['external'], True, [],
+                    routing_maps=routing_maps, model_snapshot=snapshot)
+                try:
+                    for _ in range(2):
+                        self.assertTrue(regenerated.wait(5))
+                        regenerated.clear()
+                        expected = marathon_lb.hash_outputs(config_file,
+                                                            routing_maps)
+                        # Let the processor save the snapshot
+                        for _ in range(50):
+                            restored = marathon_lb.ModelSnapshot(
+                                snapshot.path)
+                            if restored.load() and \
+                                    restored.config_hash == expected:
+                                break
+                            time.sleep(0.1)
+                        self.assertEqual(restored.config_hash, expected)
+                        processor.reset_from_tasks()
+                finally:
+                    processor.stop()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_reload_haproxy_master_saves_server_state(self):
+        config = marathon_lb.config([], ['external'], True, None,
+                                    marathon_lb.ConfigTemplater())
+        self.assertEqual(marathon_lb.get_server_state_file(config),
+                         '/var/state/haproxy/global')
+        self.assertIsNone(marathon_lb.get_server_state_file(''))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            state_file = os.path.join(tmpdir, 'global')
+            new_worker = '1300            worker          1               ' \
+                '0               0d00h00m00s'
+            master = FakeHAProxyMaster([new_worker])
+            self.assertTrue(marathon_lb.reload_haproxy_master(
+                master, FakeHAProxySocket(), state_file))
+            self.assertEqual(master.reloads, 1)
+            with open(state_file) as f:
+                self.assertIn('10_0_0_1_31000', f.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_write_config_hash(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config_file = os.path.join(tmpdir, 'haproxy.cfg')
+            marathon_lb.write_config_hash(u'global\n  daemon\n', config_file)
+            with open(config_file + '.hash') as f:
+                self.assertEqual(
+                    f.read(), hashlib.sha1(b'global\n  daemon\n')
+                    .hexdigest() + ' 16\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_get_desired_servers(self):
+        apps = dict()
+        for appId, port, labels in [
+                ("/nginx", 10000, {}),
+                ("/internal", 10001, {}),
+                ("/custom", 10002, {
+                    "HAPROXY_{0}_BACKEND_SERVER_OPTIONS":
+                        "  server backend {host_ipv4}:{port}\n"})]:
+            app = marathon_lb.MarathonService(appId, port, None)
+            app.groups = frozenset(
+                ['internal' if appId == "/internal" else 'external'])
+            app.labels = labels
+            app.add_backend("1.1.1.1", 31000, False)
+            app.add_backend("1.1.1.2", 31001, True)
+            apps[appId] = app
+
+        servers = marathon_lb.get_desired_servers(
+            apps.values(), ['external'], marathon_lb.ConfigTemplater())
+        self.assertEqual(servers, {
+            'nginx_10000': {
+                '1_1_1_1_31000': ('1.1.1.1', 31000, False),
+                '1_1_1_2_31001': ('1.1.1.2', 31001, True)
+            }
+        })
+
+    def test_config_haproxy_map(self):
+        apps = []
+        for appId, port, hostname, path, redirect in [
+                ('/web', 10000, 'A.example.com,b.example.com', None, False),
+                ('/api', 10001, 'a.example.com', '/api', False),
+                ('/api/v2', 10002, 'a.example.com', '/API/v2', False),
+                ('/secure', 10003, 'secure.example.com', None, True)]:
+            app = marathon_lb.MarathonService(appId, port, None)
+            app.groups = frozenset(['external'])
+            app.hostname = hostname
+            app.path = path
+            app.redirectHttpToHttps = redirect
+            app.add_backend("1.1.1.1", 1024, False)
+            apps.append(app)
+
+        routing_maps = marathon_lb.RoutingMaps('/etc/haproxy')
+        config = marathon_lb.config(apps, ['external'], True, None,
+                                    marathon_lb.ConfigTemplater(),
+                                    routing_maps=routing_maps)
+
+        self.assertEqual(routing_maps.render(), {
+            'domain2backend.map':
+                'a.example.com web_10000\n'
+                'b.example.com web_10000\n',
+            'domainpath2backend.map':
+                'a.example.com/api/v2 api_v2_10002\n'
+                'a.example.com/api api_10001\n'})
+
+        # Only the service which redirects to HTTPS is routed with ACLs
+        self.assertIn('acl host_secure_example_com_secure', config)
+        self.assertNotIn('acl host_a_example_com', config)
+        self.assertNotIn('acl host_b_example_com', config)
+        self.assertEqual(config.count(
+            'base,lower,regsub(:[0-9]+/,/),'
+            'map_beg(/etc/haproxy/domainpath2backend.map)'), 4)
+        self.assertIn(
+            '  use_backend %[ssl_fc_sni,lower,'
+            'map_str(/etc/haproxy/domain2backend.map)] '
+            'if { ssl_fc_sni,lower,'
+            'map_str(/etc/haproxy/domain2backend.map) -m found }\n',
+            config)
+
+        # Overriding an ACL template keeps a service out of the maps
+        apps[0].labels = {'HAPROXY_{0}_HTTP_FRONTEND_ACL':
+                          '  acl custom hdr(host) {hostname}\n'}
+        marathon_lb.config(apps, ['external'], True, None,
+                           marathon_lb.ConfigTemplater(),
+                           routing_maps=routing_maps)
+        self.assertEqual(routing_maps.hosts, [])
+
+    def test_update_routing_maps(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config_file = os.path.join(tmpdir, 'haproxy.cfg')
+            routing_maps = marathon_lb.RoutingMaps(tmpdir)
+
+            def render(vhosts):
+                apps = []
+                for i, (hostname, path) in enumerate(vhosts):
+                    app = marathon_lb.MarathonService(
+                        '/app%d' % i, 10000 + i, None)
+                    app.groups = frozenset(['external'])
+                    app.hostname = hostname
+                    app.path = path
+                    apps.append(app)
+                return marathon_lb.config(apps, ['external'], True, None,
+                                          marathon_lb.ConfigTemplater(),
+                                          routing_maps=routing_maps)
+
+            config = render([('a.example.com', None),
+                             ('b.example.com', None),
+                             ('a.example.com', '/api')])
+            # The config is new too, so reloading picks the maps up
+            haproxy = FakeHAProxySocket()
+            self.assertTrue(marathon_lb.update_routing_maps(
+                routing_maps, config, config_file, haproxy))
+            self.assertEqual(haproxy.commands, [])
+            with open(config_file, 'w') as f:
+                f.write(config)
+
+            # b.example.com moves to c.example.com, and a longer path is
+            # added; the config stays the same, so the maps are updated at
+            # runtime
+            config = render([('a.example.com', None),
+                             ('c.example.com', None),
+                             ('a.example.com', '/api')])
+            self.assertFalse(marathon_lb.update_routing_maps(
+                routing_maps, config, config_file, haproxy))
+            host_map = os.path.join(tmpdir, 'domain2backend.map')
+            self.assertEqual(haproxy.commands, [
+                'del map %s b.example.com' % host_map,
+                'add map %s c.example.com app1_10001' % host_map])
+            with open(host_map) as f:
+                self.assertEqual(f.read(), 'a.example.com app0_10000\n'
+                                           'c.example.com app1_10001\n')
+
+            # A path which would come after a prefix of it needs a reload
+            config = render([('a.example.com', None),
+                             ('c.example.com', None),
+                             ('a.example.com', '/api'),
+                             ('a.example.com', '/api/v2')])
+            self.assertIsNone(routing_maps.get_changes())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_config_cert_list(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            certs = dict()
+            for name in ['default.pem', 'a.pem']:
+                certs[name] = os.path.join(tmpdir, name)
+                with open(certs[name], 'w') as f:
+                    f.write(name)
+            cert_list = marathon_lb.CertList(
+                os.path.join(tmpdir, 'crt-list'))
+
+            apps = []
+            for appId, hostname, cert in [
+                    ('/a', 'a.example.com,A2.example.com', certs['a.pem']),
+                    ('/b', 'b.example.com', certs['default.pem']),
+                    ('/c', 'c.example.com', certs['a.pem']),
+                    ('/d', None, certs['a.pem'])]:
+                app = marathon_lb.MarathonService(appId, 10000, None)
+                app.groups = frozenset(['external'])
+                app.hostname = hostname
+                app.sslCert = cert
+                apps.append(app)
+
+            config = marathon_lb.config(apps, ['external'], True,
+                                        certs['default.pem'],
+                                        marathon_lb.ConfigTemplater(),
+                                        cert_list=cert_list)
+            self.assertIn('  bind *:443 ssl crt-list %s\n' % cert_list.path,
+                          config)
+            self.assertEqual(cert_list.render(), (
+                '# sha1 %s\n%s\n'
+                '# sha1 %s\n%s a.example.com a2.example.com c.example.com\n'
+            ) % (hashlib.sha1(b'default.pem').hexdigest(),
+                 certs['default.pem'],
+                 hashlib.sha1(b'a.pem').hexdigest(), certs['a.pem']))
+
+            self.assertTrue(cert_list.write())
+            self.assertFalse(cert_list.write())
+            # Touching a certificate doesn't change the crt-list, changing
+            # it does
+            os.utime(certs['a.pem'], None)
+            self.assertFalse(cert_list.write())
+            with open(certs['a.pem'], 'w') as f:
+                f.write('renewed')
+            self.assertTrue(cert_list.write())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_config_shared_frontends(self):
+        apps = []
+        for appId, port, bindAddr, labels in [
+                ('/a', 10001, '*', {}),
+                ('/b', 10000, '*', {}),
+                ('/c', 10002, '*', {}),
+                ('/d', 10005, '*', {}),
+                ('/e', 10006, '10.0.0.1', {}),
+                ('/f', 10007, '*', {"HAPROXY_{0}_BIND_OPTIONS": "v4v6"}),
+                ('/g', 10008, '*',
+                 {"HAPROXY_{0}_FRONTEND_HEAD": "frontend custom\n"})]:
+            app = marathon_lb.MarathonService(appId, port, None)
+            app.groups = frozenset(['external'])
+            app.bindAddr = bindAddr
+            app.labels = labels
+            app.bindOptions = labels.get("HAPROXY_{0}_BIND_OPTIONS")
+            apps.append(app)
+        web = marathon_lb.MarathonService('/web', 10009, None)
+        web.groups = frozenset(['external'])
+        web.hostname = 'web.example.com'
+        apps.append(web)
+
+        config = marathon_lb.config(apps, ['external'], True, None,
+                                    marathon_lb.ConfigTemplater(),
+                                    shared_frontends=marathon_lb
+                                    .SharedFrontends())
+        self.assertIn('''
+frontend marathon_shared_tcp
+  mode tcp
+  bind *:10000-10002,*:10005
+  use_backend b_10000 if { dst_port 10000 }
+  use_backend a_10001 if { dst_port 10001 }
+  use_backend c_10002 if { dst_port 10002 }
+  use_backend d_10005 if { dst_port 10005 }
+
+frontend marathon_shared_tcp_10_0_0_1
+  mode tcp
+  bind 10.0.0.1:10006
+  use_backend e_10006 if { dst_port 10006 }
+''', config)
+        for backend in ['a_10001', 'b_10000', 'e_10006']:
+            self.assertNotIn('frontend %s\n' % backend, config)
+        # Services which can't share a frontend keep their own
+        self.assertIn('''
+frontend f_10007
+  bind *:10007 v4v6
+  mode tcp
+  use_backend f_10007
+''', config)
+        self.assertIn('frontend custom\n  use_backend g_10008\n', config)
+        self.assertIn('''
+frontend web_10009
+  bind *:10009
+  mode http
+''', config)
+
+        shared = marathon_lb.SharedFrontends()
+        shared.frontends[('*', 'tcp')] = [
+            (port, 'app_%d' % port) for port in range(10000, 10100, 2)]
+        binds = [line for line in shared.render(
+            marathon_lb.ConfigTemplater()).splitlines()
+            if line.startswith('  bind ')]
+        self.assertEqual([line.count(',') + 1 for line in binds], [32, 18])
+
+        # A global frontend template override applies to every service
+        templater = marathon_lb.ConfigTemplater()
+        templater.t['FRONTEND_HEAD'].value = \
+            '\nfrontend {backend}\n  bind {bindAddr}:{servicePort}\n' \
+            '  mode {mode}\n  option tcplog\n'
+        with mock.patch('marathon_lb.logger.warning') as warning:
+            config = marathon_lb.config(apps[:2], ['external'], True, None,
+                                        templater,
+                                        shared_frontends=marathon_lb
+                                        .SharedFrontends())
+        self.assertNotIn('marathon_shared_tcp', config)
+        self.assertIn('frontend a_10001\n  bind *:10001\n  mode tcp\n'
+                      '  option tcplog\n', config)
+        warning.assert_called_once_with(
+            "not sharing frontends, as %s %s overridden",
+            'HAPROXY_FRONTEND_HEAD', 'is')
+
+    def test_config_server_slots(self):
+        def render(backends, running_config=''):
+            app = marathon_lb.MarathonService('/nginx', 10000, None)
+            app.groups = frozenset(['external'])
+            for host, port, draining in backends:
+                app.add_backend(host, port, draining)
+            slots = marathon_lb.ServerSlots(4)
+            slots.load(running_config)
+            return marathon_lb.config([app], ['external'], False, None,
+                                      marathon_lb.ConfigTemplater(), slots)
+
+        running = render([("1.1.1.1", 1024, False),
+                          ("1.1.1.2", 1025, False)])
+        self.assertIn('''backend nginx_10000
+  balance roundrobin
+  mode tcp
+  server slot1 1.1.1.1:1024
+  server slot2 1.1.1.2:1025
+  server slot3 127.0.0.1:1 disabled
+  server slot4 127.0.0.1:1 disabled
+''', running)
+
+        # 1.1.1.1 goes away, 1.1.1.2 keeps its slot and starts draining,
+        # and 1.1.1.3 takes the first free slot
+        config = render([("1.1.1.2", 1025, True),
+                         ("1.1.1.3", 1026, False)], running)
+        self.assertIn('''  server slot1 1.1.1.3:1026
+  server slot2 1.1.1.2:1025 disabled
+  server slot3 127.0.0.1:1 disabled
+  server slot4 127.0.0.1:1 disabled
+''', config)
+        self.assertEqual(marathon_lb.get_slot_changes(running, config), [
+            ('nginx_10000', 'slot1', 'state', 'maint'),
+            ('nginx_10000', 'slot1', 'addr', '1.1.1.3 port 1026'),
+            ('nginx_10000', 'slot1', 'state', 'ready'),
+            ('nginx_10000', 'slot2', 'state', 'maint')])
+
+        # Which are applied without a reload
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config_file = os.path.join(tmpdir, 'haproxy.cfg')
+            with open(config_file, 'w') as f:
+                f.write(running)
+            haproxy = FakeHAProxySocket()
+            with mock.patch('marathon_lb.writeConfigAndValidate',
+                            return_value=True), \
+                    mock.patch('marathon_lb.reloadConfig') as reload:
+                marathon_lb.compareWriteAndReloadConfig(
+                    config, config_file, haproxy_socket=haproxy)
+            self.assertEqual(reload.call_count, 0)
+            self.assertIn(
+                'set server nginx_10000/slot1 addr 1.1.1.3 port 1026',
+                haproxy.commands)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # Outgrowing the slots needs a reload
+        config = render([("1.1.1.%d" % i, 1024, False) for i in range(4)],
+                        running)
+        self.assertIn("  server slot8 127.0.0.1:1 disabled\n", config)
+        self.assertIsNone(marathon_lb.get_slot_changes(running, config))
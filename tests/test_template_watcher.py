@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from config import ConfigTemplater
+from template_watcher import TemplateWatcher
+
+
+class TestTemplateWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, value):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(value)
+
+    def test_check(self):
+        self.write('HAPROXY_HEAD', 'global\n')
+        templater = ConfigTemplater(self.directory)
+        watcher = TemplateWatcher(templater)
+        self.assertEqual(watcher.check(), [])
+
+        self.write('HAPROXY_HEAD', 'global\n  daemon\n')
+        self.write('HAPROXY_HTTPS_FRONTEND_HEAD', 'frontend https\n')
+        self.write('unrelated', 'ignored\n')
+        self.assertEqual(watcher.check(), ['HEAD', 'HTTPS_FRONTEND_HEAD'])
+        self.assertEqual(templater.haproxy_head, 'global\n  daemon\n')
+        self.assertEqual(templater.generation, 1)
+
+        os.remove(os.path.join(self.directory, 'HAPROXY_HEAD'))
+        self.assertEqual(watcher.check(), ['HEAD'])
+        self.assertEqual(templater.haproxy_head,
+                         templater.t['HEAD'].default_value)
+        self.assertEqual(watcher.check(), [])
+        self.assertEqual(templater.generation, 2)
+
+    def test_watch(self):
+        templater = ConfigTemplater(self.directory)
+        watcher = TemplateWatcher(templater, interval=0.5, settle=0.1)
+        changes = []
+        changed = threading.Event()
+
+        def on_change(names):
+            changes.append(names)
+            changed.set()
+
+        watcher.start(on_change)
+        try:
+            self.write('HAPROXY_HEAD', 'global\n')
+            self.write('HAPROXY_HEAD', 'global\n  daemon\n')
+            self.assertTrue(changed.wait(5))
+            self.assertEqual(changes, [['HEAD']])
+            self.assertEqual(templater.haproxy_head, 'global\n  daemon\n')
+        finally:
+            watcher.stop()